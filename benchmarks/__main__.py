@@ -0,0 +1,148 @@
+"""Load-test the wallet API and report throughput, latency and DB round trips per scenario.
+
+Starts the app under Granian against the database configured in the environment
+(the same variables the app reads) and writes the results as JSON:
+
+    python -m benchmarks run --output results.json
+    python -m benchmarks run --scenarios withdraw_race,read_mix --scale 0.2
+    python -m benchmarks run --url http://localhost:8000   # an already running server
+
+Compare two runs, e.g. from before and after a change:
+
+    python -m benchmarks compare base.json head.json
+
+Exits non-zero if a scenario's correctness check fails or a wallet's balance does
+not equal the sum of its ledger.
+"""
+import argparse
+import asyncio
+import contextlib
+import dataclasses
+import json
+import logging
+import subprocess
+import sys
+import time
+import typing
+import uuid
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.custom_types import FAST_API_SCHEME
+from app.db.resource import build_engine
+from app.settings import Settings
+from benchmarks.harness import Client, granian_server
+from benchmarks.scenarios import SCENARIOS, Config, ledger_mismatches
+
+
+async def run(args: argparse.Namespace) -> dict[str, typing.Any]:
+    config = Config(run_id=uuid.uuid4().hex[:8], seed=args.seed, concurrency=args.concurrency).scaled(args.scale)
+    engine = build_engine(Settings(scheme=FAST_API_SCHEME))
+    report: dict[str, typing.Any] = {
+        "meta": {
+            "commit": _git_commit(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "workers": args.workers,
+            "config": dataclasses.asdict(config),
+        },
+        "scenarios": {},
+    }
+
+    with contextlib.ExitStack() as stack:
+        base_url = args.url or stack.enter_context(granian_server(args.port, args.workers))
+        client = Client(base_url, config.concurrency)
+        try:
+            async with AsyncSession(engine) as session:
+                for name in args.scenarios:
+                    logging.info("Running %s", name)
+                    result = await SCENARIOS[name](client, config, session)
+                    report["scenarios"][name] = result.summary()
+                mismatches = await ledger_mismatches(session, config.run_id)
+        finally:
+            await client.aclose()
+            await engine.dispose()
+
+    report["ledger"] = {"ok": not mismatches, "mismatches": mismatches}
+    return report
+
+
+def compare(base: dict[str, typing.Any], head: dict[str, typing.Any]) -> str:
+    lines = [f"{'scenario':<16}{'metric':<30}{'base':>12}{'head':>12}{'change':>10}"]
+    for name, head_summary in head["scenarios"].items():
+        base_summary = base["scenarios"].get(name)
+        if base_summary is None:
+            continue
+        metrics = {
+            "throughput_rps": (base_summary["throughput_rps"], head_summary["throughput_rps"]),
+            "db_round_trips_per_request": (
+                base_summary["db_round_trips_per_request"], head_summary["db_round_trips_per_request"],
+            ),
+            **{
+                f"latency_ms.{percentile}": (
+                    base_summary["latency_ms"][percentile], head_summary["latency_ms"][percentile],
+                )
+                for percentile in ("p50", "p95", "p99")
+            },
+        }
+        for metric, (before, after) in metrics.items():
+            change = f"{(after - before) / before:+.1%}" if before and after is not None else ""
+            lines.append(f"{name:<16}{metric:<30}{before!s:>12}{after!s:>12}{change:>10}")
+    return "\n".join(lines)
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _passed(report: dict[str, typing.Any]) -> bool:
+    return report["ledger"]["ok"] and all(summary["checks"]["ok"] for summary in report["scenarios"].values())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Wallet API benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run scenarios and write a JSON report")
+    run_parser.add_argument("--scenarios", type=lambda value: value.split(","), default=list(SCENARIOS))
+    run_parser.add_argument("--scale", type=float, default=1.0, help="multiply every scenario's size")
+    run_parser.add_argument("--concurrency", type=int, default=32)
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument("--workers", type=int, default=1, help="Granian worker processes")
+    run_parser.add_argument("--port", type=int, default=8765)
+    run_parser.add_argument("--url", help="benchmark this server instead of starting one")
+    run_parser.add_argument("--output", help="write the report here instead of stdout")
+
+    compare_parser = commands.add_parser("compare", help="show the change between two reports")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("head")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if args.command == "compare":
+        with open(args.base) as base, open(args.head) as head:
+            sys.stdout.write(compare(json.load(base), json.load(head)) + "\n")
+        return
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+    sys.exit(0 if _passed(report) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import asyncio
+import contextlib
+import dataclasses
+import os
+import subprocess
+import sys
+import time
+import typing
+
+import httpx
+
+
+@dataclasses.dataclass
+class Sample:
+    latency: float
+    status: int
+    round_trips: int | None
+
+
+@dataclasses.dataclass
+class ScenarioResult:
+    samples: list[Sample] = dataclasses.field(default_factory=list)
+    elapsed: float = 0.0
+    checks: dict[str, typing.Any] = dataclasses.field(default_factory=dict)
+
+    def summary(self) -> dict[str, typing.Any]:
+        latencies = sorted(sample.latency for sample in self.samples)
+        round_trips = [sample.round_trips for sample in self.samples if sample.round_trips is not None]
+        statuses: dict[str, int] = {}
+        for sample in self.samples:
+            statuses[str(sample.status)] = statuses.get(str(sample.status), 0) + 1
+        return {
+            "requests": len(self.samples),
+            "elapsed_seconds": round(self.elapsed, 3),
+            "throughput_rps": round(len(self.samples) / self.elapsed, 1) if self.elapsed else None,
+            "latency_ms": {
+                "p50": _percentile_ms(latencies, 50),
+                "p95": _percentile_ms(latencies, 95),
+                "p99": _percentile_ms(latencies, 99),
+                "max": _percentile_ms(latencies, 100),
+            },
+            "db_round_trips_per_request": round(sum(round_trips) / len(round_trips), 2) if round_trips else None,
+            "statuses": statuses,
+            "checks": self.checks,
+        }
+
+
+def _percentile_ms(sorted_values: list[float], percentile: int) -> float | None:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, -(-len(sorted_values) * percentile // 100) - 1))
+    return round(sorted_values[index] * 1000, 2)
+
+
+class Client:
+    """httpx client that records latency, status and DB round trips of every call it makes."""
+
+    def __init__(self, base_url: str, concurrency: int) -> None:
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        self.http = httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60)
+        self.result: ScenarioResult | None = None
+
+    async def request(self, method: str, url: str, **kwargs: typing.Any) -> httpx.Response:
+        started = time.perf_counter()
+        response = await self.http.request(method, url, **kwargs)
+        if self.result is not None:
+            round_trips = response.headers.get("x-db-round-trips")
+            self.result.samples.append(Sample(
+                latency=time.perf_counter() - started,
+                status=response.status_code,
+                round_trips=int(round_trips) if round_trips is not None else None,
+            ))
+        return response
+
+    @contextlib.contextmanager
+    def recording(self) -> typing.Iterator[ScenarioResult]:
+        """Record the calls made inside the block; setup calls outside it are not measured."""
+        self.result = ScenarioResult()
+        started = time.perf_counter()
+        try:
+            yield self.result
+        finally:
+            self.result.elapsed = time.perf_counter() - started
+            self.result = None
+
+    async def aclose(self) -> None:
+        await self.http.aclose()
+
+
+async def run_concurrently(
+    concurrency: int, operations: typing.Iterable[typing.Callable[[], typing.Awaitable[typing.Any]]],
+) -> None:
+    """Run the operations with at most concurrency of them in flight."""
+    pending = iter(operations)
+
+    async def worker() -> None:
+        for operation in pending:
+            await operation()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+@contextlib.contextmanager
+def granian_server(port: int, workers: int) -> typing.Iterator[str]:
+    """Serve the app with Granian, as in production, for the duration of the block."""
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "granian",
+            "--interface", "asgi",
+            "--host", "127.0.0.1",
+            "--port", str(port),
+            "--workers", str(workers),
+            "--loop", "uvloop",
+            "app.application:application",
+        ],
+        env=os.environ.copy(),
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        _wait_until_ready(base_url, process)
+        yield base_url
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def _wait_until_ready(base_url: str, process: subprocess.Popen[bytes], timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Granian exited with code {process.returncode}")
+        try:
+            if httpx.get(f"{base_url}/metrics", timeout=1).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not become ready in {timeout}s")
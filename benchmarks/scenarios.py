@@ -0,0 +1,239 @@
+import dataclasses
+import json
+import random
+import typing
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from jose import jwt
+from sqlalchemy import BigInteger, cast, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.commands.checkpoints import run as run_checkpoints
+from app.custom_types import FAST_API_SCHEME
+from app.models import Transaction, User
+from app.money import from_minor_units
+from app.repositories.balance_slots import total_balance
+from app.repositories.utils import signed_amount
+from app.settings import Settings
+from benchmarks.harness import Client, ScenarioResult, run_concurrently
+
+
+PASSWORD: typing.Final = "bench-password"
+
+
+@dataclasses.dataclass
+class Config:
+    run_id: str
+    seed: int = 42
+    concurrency: int = 32
+    users: int = 20
+    deposits_per_user: int = 50
+    race_balance: int = 100
+    race_withdrawals: int = 300
+    read_mix_requests: int = 2000
+    read_mix_write_ratio: float = 0.1
+    history_transactions: int = 20_000
+    history_days: int = 300
+    history_reads: int = 500
+    login_burst: int = 200
+
+    def scaled(self, scale: float) -> "Config":
+        sizes = (
+            "users", "deposits_per_user", "race_withdrawals", "read_mix_requests",
+            "history_transactions", "history_reads", "login_burst",
+        )
+        return dataclasses.replace(self, **{name: max(1, int(getattr(self, name) * scale)) for name in sizes})
+
+
+@dataclasses.dataclass
+class Wallet:
+    id: int
+    email: str
+    headers: dict[str, str]
+
+
+async def create_wallets(client: Client, config: Config, count: int, name: str) -> list[Wallet]:
+    wallets: list[Wallet] = []
+
+    async def create(index: int) -> None:
+        email = f"bench-{config.run_id}-{name}-{index}@example.com"
+        response = await client.request("POST", "/api/user/", json={"name": name, "email": email, "password": PASSWORD})
+        response.raise_for_status()
+        response = await client.request("POST", "/api/token", json={"email": email, "password": PASSWORD})
+        response.raise_for_status()
+        token = response.json()["access_token"]
+        user_id = jwt.get_unverified_claims(token)["uid"]
+        wallets.append(Wallet(id=user_id, email=email, headers={"Authorization": f"Bearer {token}"}))
+
+    # bcrypt-bound; stay within the password pool's queue
+    await run_concurrently(min(config.concurrency, 16), (lambda index=index: create(index) for index in range(count)))
+    return sorted(wallets, key=lambda wallet: wallet.id)
+
+
+async def deposit(client: Client, wallet: Wallet, amount: str) -> int:
+    response = await client.request(
+        "POST", "/api/transaction/", json={"amount": amount, "type": "DEPOSIT"}, headers=wallet.headers,
+    )
+    return response.status_code
+
+
+async def deposit_storm(client: Client, config: Config, session: AsyncSession) -> ScenarioResult:
+    """Many wallets depositing at once: the write path end to end."""
+    wallets = await create_wallets(client, config, config.users, "storm")
+    operations = [
+        lambda wallet=wallet: deposit(client, wallet, "1.00")
+        for _ in range(config.deposits_per_user) for wallet in wallets
+    ]
+    with client.recording() as result:
+        await run_concurrently(config.concurrency, operations)
+
+    balances = await _balances(session, [wallet.id for wallet in wallets])
+    expected = Decimal(config.deposits_per_user)
+    result.checks = {
+        "ok": all(from_minor_units(balance, "USD") == expected for balance in balances.values()),
+        "expected_balance": str(expected),
+    }
+    return result
+
+
+async def withdraw_race(client: Client, config: Config, session: AsyncSession) -> ScenarioResult:
+    """Concurrent withdrawals against one wallet: exactly balance / amount of them may succeed."""
+    wallet, = await create_wallets(client, config, 1, "race")
+    if await deposit(client, wallet, str(config.race_balance)) != 200:
+        raise RuntimeError("Could not fund the race wallet")
+
+    async def withdraw() -> None:
+        await client.request(
+            "POST", "/api/transaction/", json={"amount": "1.00", "type": "WITHDRAW"}, headers=wallet.headers,
+        )
+
+    with client.recording() as result:
+        await run_concurrently(config.concurrency, [withdraw] * config.race_withdrawals)
+
+    succeeded = sum(sample.status == 200 for sample in result.samples)
+    expected = min(config.race_balance, config.race_withdrawals)
+    final = (await _balances(session, [wallet.id]))[wallet.id]
+    result.checks = {
+        "ok": succeeded == expected and final == config.race_balance - expected,
+        "succeeded": succeeded,
+        "expected": expected,
+        "final_balance": str(final),
+    }
+    return result
+
+
+async def read_mix(client: Client, config: Config, session: AsyncSession) -> ScenarioResult:
+    """Mostly balance reads with some deposits, spread over many wallets."""
+    wallets = await create_wallets(client, config, config.users, "mix")
+    rng = random.Random(config.seed)
+
+    async def read(wallet: Wallet) -> None:
+        await client.request("GET", f"/api/user/{wallet.id}/balance/", headers=wallet.headers)
+
+    operations = []
+    for _ in range(config.read_mix_requests):
+        wallet = rng.choice(wallets)
+        if rng.random() < config.read_mix_write_ratio:
+            operations.append(lambda wallet=wallet: deposit(client, wallet, "1.00"))
+        else:
+            operations.append(lambda wallet=wallet: read(wallet))
+
+    with client.recording() as result:
+        await run_concurrently(config.concurrency, operations)
+    result.checks = {"ok": all(sample.status == 200 for sample in result.samples)}
+    return result
+
+
+async def point_in_time(client: Client, config: Config, session: AsyncSession) -> ScenarioResult:
+    """Balances at past timestamps of a wallet with a long, checkpointed history."""
+    wallet, = await create_wallets(client, config, 1, "history")
+    rng = random.Random(config.seed)
+    now = datetime.now(timezone.utc)
+    start = now - timedelta(days=config.history_days)
+    body = "\n".join(
+        json.dumps({
+            "user_id": wallet.id,
+            "type": "DEPOSIT",
+            "amount": f"{rng.randint(1, 10000) / 100:.2f}",
+            "created_at": (start + (now - start) * index / config.history_transactions).isoformat(),
+        })
+        for index in range(config.history_transactions)
+    )
+    response = await client.request("POST", "/api/transaction/bulk/", content=body.encode(), headers=wallet.headers)
+    if response.status_code != 200 or response.json()["rejected"]:
+        raise RuntimeError(f"Could not load the history: {response.text[:500]}")
+    await run_checkpoints(Settings(scheme=FAST_API_SCHEME), backfill=True, interval_days=1)
+
+    timestamps = [int(rng.uniform(start.timestamp(), now.timestamp())) for _ in range(config.history_reads)]
+    answers: dict[int, str] = {}
+
+    async def read(ts: int) -> None:
+        response = await client.request("GET", f"/api/user/{wallet.id}/balance/?ts={ts}", headers=wallet.headers)
+        answers[ts] = response.json()["amount"]
+
+    with client.recording() as result:
+        await run_concurrently(config.concurrency, [lambda ts=ts: read(ts) for ts in timestamps])
+
+    # Spot-check against a full scan of the ledger
+    wrong = []
+    for ts in timestamps[:20]:
+        expected = await session.scalar(
+            select(func.coalesce(cast(func.sum(signed_amount), BigInteger), 0))
+            .where(Transaction.user_id == wallet.id)
+            .where(Transaction.created_at <= datetime.fromtimestamp(ts, timezone.utc))
+        )
+        if Decimal(answers[ts]) != from_minor_units(expected, "USD"):
+            wrong.append({"ts": ts, "answer": answers[ts], "ledger": str(expected)})
+    result.checks = {"ok": not wrong, "checked": min(20, len(timestamps)), "wrong": wrong}
+    return result
+
+
+async def login_burst(client: Client, config: Config, session: AsyncSession) -> ScenarioResult:
+    """A burst of logins; beyond the bcrypt pool's capacity these should fail fast with 503."""
+    wallets = await create_wallets(client, config, min(config.users, config.login_burst), "login")
+
+    async def login(wallet: Wallet) -> None:
+        await client.request("POST", "/api/token", json={"email": wallet.email, "password": PASSWORD})
+
+    with client.recording() as result:
+        await run_concurrently(
+            config.login_burst,
+            [lambda index=index: login(wallets[index % len(wallets)]) for index in range(config.login_burst)],
+        )
+    result.checks = {"ok": all(sample.status in (200, 503) for sample in result.samples)}
+    return result
+
+
+async def _balances(session: AsyncSession, user_ids: list[int]) -> dict[int, int]:
+    result = await session.execute(select(User.id, total_balance).where(User.id.in_(user_ids)))
+    await session.rollback()
+    return dict(result.all())
+
+
+async def ledger_mismatches(session: AsyncSession, run_id: str) -> list[dict[str, str]]:
+    """Wallets of this run whose stored balance differs from the sum of their ledger."""
+    ledger = func.coalesce(func.sum(signed_amount), 0)
+    balances = select(User.id, total_balance.label("balance"))\
+        .where(User.email.like(f"bench-{run_id}-%"))\
+        .subquery()
+    result = await session.execute(
+        select(balances.c.id, balances.c.balance, ledger)
+        .outerjoin(Transaction, Transaction.user_id == balances.c.id)
+        .group_by(balances.c.id, balances.c.balance)
+        .having(func.coalesce(balances.c.balance, 0) != ledger)
+    )
+    return [
+        {"user_id": str(user_id), "balance": str(balance), "ledger": str(total)}
+        for user_id, balance, total in result
+    ]
+
+
+SCENARIOS: typing.Final = {
+    "deposit_storm": deposit_storm,
+    "withdraw_race": withdraw_race,
+    "read_mix": read_mix,
+    "point_in_time": point_in_time,
+    "login_burst": login_burst,
+}
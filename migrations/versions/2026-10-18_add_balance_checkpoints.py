@@ -0,0 +1,36 @@
+"""Add balance checkpoints
+
+Revision ID: 3c5e0d1f7a42
+Revises: 709423d38222
+Create Date: 2026-10-18 10:12:31.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c5e0d1f7a42'
+down_revision = '709423d38222'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('balance_checkpoints',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('balance', sa.Numeric(precision=10, scale=2), nullable=False),
+    sa.Column('as_of', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_balance_checkpoints_user_id_as_of', 'balance_checkpoints', ['user_id', 'as_of'], unique=True)
+    op.create_index('ix_transactions_user_id_created_at', 'transactions', ['user_id', 'created_at'], unique=False)
+    # Existing data: run `python -m app.commands.checkpoints --backfill` after upgrading
+
+
+def downgrade():
+    op.drop_index('ix_transactions_user_id_created_at', table_name='transactions')
+    op.drop_index('ix_balance_checkpoints_user_id_as_of', table_name='balance_checkpoints')
+    op.drop_table('balance_checkpoints')
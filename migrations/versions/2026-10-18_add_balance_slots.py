@@ -0,0 +1,38 @@
+"""Add balance slots
+
+Revision ID: 9a4c6e2b8d15
+Revises: 5d7f2a9c1e36
+Create Date: 2026-10-18 19:02:44.517230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4c6e2b8d15'
+down_revision = '5d7f2a9c1e36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('balance_slots',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('slot', sa.Integer(), nullable=False),
+    sa.Column('balance', sa.Numeric(precision=10, scale=2), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'slot')
+    )
+    op.add_column('users', sa.Column('balance_slots', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    # Fold the slots back into users.balance before dropping them
+    op.execute(
+        'UPDATE users SET balance = users.balance + slots.balance '
+        'FROM (SELECT user_id, sum(balance) AS balance FROM balance_slots GROUP BY user_id) AS slots '
+        'WHERE users.id = slots.user_id'
+    )
+    op.drop_column('users', 'balance_slots')
+    op.drop_table('balance_slots')
@@ -0,0 +1,46 @@
+"""Add daily user rollups
+
+Revision ID: 5e9a2c7b4d18
+Revises: c3e7a1d94f52
+Create Date: 2026-10-18 23:41:09.218364
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e9a2c7b4d18'
+down_revision = 'c3e7a1d94f52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('daily_user_rollups',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('deposits_minor', sa.BigInteger(), nullable=False),
+    sa.Column('withdrawals_minor', sa.BigInteger(), nullable=False),
+    sa.Column('deposit_count', sa.Integer(), nullable=False),
+    sa.Column('withdrawal_count', sa.Integer(), nullable=False),
+    sa.Column('closing_balance_minor', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'day')
+    )
+    op.create_table('rollup_runs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('started_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('since_watermark', sa.BigInteger(), nullable=True),
+    sa.Column('since_through', sa.Date(), nullable=True),
+    sa.Column('watermark', sa.BigInteger(), nullable=False),
+    sa.Column('through', sa.Date(), nullable=False),
+    sa.Column('days', sa.BigInteger(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('rollup_runs')
+    op.drop_table('daily_user_rollups')
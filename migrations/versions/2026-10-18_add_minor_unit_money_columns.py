@@ -0,0 +1,109 @@
+"""Add minor unit money columns
+
+Expand step of moving money from NUMERIC(10, 2) to BIGINT minor units:
+
+1. this revision adds users.currency and a BIGINT *_minor column next to every
+   money column, and triggers that keep each pair in step, so instances running
+   the previous release keep working during the rollout;
+2. `python -m app.commands.minor_units` backfills the new columns in batches;
+3. the next revision drops the NUMERIC columns and the triggers.
+
+Every statement here only changes the catalog; no table is rewritten.
+
+Revision ID: 6e3a9f1c4b27
+Revises: 2f8b5d3e9c71
+Create Date: 2026-10-18 20:14:37.290518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e3a9f1c4b27'
+down_revision = '2f8b5d3e9c71'
+branch_labels = None
+depends_on = None
+
+# app.money.CURRENCY_SCALES when this revision was written
+CURRENCY_SCALES = {'USD': 2, 'EUR': 2, 'GBP': 2, 'CHF': 2, 'JPY': 0, 'KRW': 0, 'KWD': 3, 'BHD': 3, 'BTC': 8}
+
+# Scale of the currency of the wallet a row belongs to
+WALLET_SCALE = 'currency_scale((SELECT currency FROM users WHERE id = NEW.user_id))'
+# (table, numeric column, minor unit column, scale of the row's currency)
+MONEY_COLUMNS = [
+    ('users', 'balance', 'balance_minor', 'currency_scale(NEW.currency)'),
+    ('transactions', 'amount', 'amount_minor', WALLET_SCALE),
+    ('balance_checkpoints', 'balance', 'balance_minor', WALLET_SCALE),
+    ('balance_slots', 'balance', 'balance_minor', WALLET_SCALE),
+]
+
+
+def upgrade():
+    op.add_column('users', sa.Column('currency', sa.String(length=3), server_default='USD', nullable=False))
+    for table, _, minor, _ in MONEY_COLUMNS:
+        op.add_column(table, sa.Column(minor, sa.BigInteger(), nullable=True))
+
+    cases = ' '.join(f"WHEN '{code}' THEN {scale}" for code, scale in CURRENCY_SCALES.items())
+    op.execute(f"""
+        CREATE FUNCTION currency_scale(code text) RETURNS integer AS $$
+            SELECT CASE code {cases} END
+        $$ LANGUAGE sql IMMUTABLE
+    """)
+    # Whichever column of a pair a statement wrote is copied to the other one: the
+    # previous release writes the NUMERIC column, this one the minor unit column
+    for table, numeric, minor, scale in MONEY_COLUMNS:
+        op.execute(f"""
+            CREATE FUNCTION sync_{table}_minor_units() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    IF NEW.{minor} IS NULL THEN
+                        NEW.{minor} := round(NEW.{numeric} * power(10::numeric, {scale}));
+                    ELSIF NEW.{numeric} IS NULL OR NEW.{numeric} = 0 THEN
+                        NEW.{numeric} := NEW.{minor} / power(10::numeric, {scale});
+                    END IF;
+                ELSIF NEW.{numeric} IS DISTINCT FROM OLD.{numeric} THEN
+                    NEW.{minor} := round(NEW.{numeric} * power(10::numeric, {scale}));
+                ELSIF NEW.{minor} IS DISTINCT FROM OLD.{minor} THEN
+                    NEW.{numeric} := NEW.{minor} / power(10::numeric, {scale});
+                END IF;
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        op.execute(
+            f'CREATE TRIGGER {table}_sync_minor_units BEFORE INSERT OR UPDATE ON {table} '
+            f'FOR EACH ROW EXECUTE FUNCTION sync_{table}_minor_units()'
+        )
+
+    # Writes from either release have to announce balance changes
+    op.execute('DROP TRIGGER users_balance_changed ON users')
+    op.execute("""
+        CREATE TRIGGER users_balance_changed
+        BEFORE UPDATE OF balance, balance_minor, balance_slots ON users
+        FOR EACH ROW
+        WHEN (
+            OLD.balance IS DISTINCT FROM NEW.balance
+            OR OLD.balance_minor IS DISTINCT FROM NEW.balance_minor
+            OR OLD.balance_slots <> NEW.balance_slots
+        )
+        EXECUTE FUNCTION notify_balance_changed()
+    """)
+    # Then run `python -m app.commands.minor_units`
+
+
+def downgrade():
+    op.execute('DROP TRIGGER users_balance_changed ON users')
+    op.execute("""
+        CREATE TRIGGER users_balance_changed
+        BEFORE UPDATE OF balance, balance_slots ON users
+        FOR EACH ROW
+        WHEN (OLD.balance IS DISTINCT FROM NEW.balance OR OLD.balance_slots <> NEW.balance_slots)
+        EXECUTE FUNCTION notify_balance_changed()
+    """)
+    for table, _, minor, _ in MONEY_COLUMNS:
+        op.execute(f'DROP TRIGGER {table}_sync_minor_units ON {table}')
+        op.execute(f'DROP FUNCTION sync_{table}_minor_units()')
+        op.drop_column(table, minor)
+    op.execute('DROP FUNCTION currency_scale(text)')
+    op.drop_column('users', 'currency')
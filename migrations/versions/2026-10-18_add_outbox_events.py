@@ -0,0 +1,62 @@
+"""Add outbox events
+
+Revision ID: c3e7a1d94f52
+Revises: 8d2b5f7e1a64
+Create Date: 2026-10-18 23:02:51.637284
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e7a1d94f52'
+down_revision = '8d2b5f7e1a64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('outbox_events',
+    sa.Column('id', sa.BigInteger(), sa.Identity(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('payload', postgresql.JSONB(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    # Like users_balance_changed, one trigger covers every write path. It runs once per
+    # statement, over all the rows the statement inserted into any partition, and after
+    # the statement's own work, so ids are drawn once the wallets' row locks are held.
+    op.execute("""
+        CREATE FUNCTION write_outbox_events() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO outbox_events (user_id, payload)
+            SELECT inserted.user_id, jsonb_build_object(
+                'transaction_id', inserted.transaction_id,
+                'correlation_id', inserted.correlation_id,
+                'user_id', inserted.user_id,
+                'type', inserted.type,
+                'amount_minor', inserted.amount_minor,
+                'currency', users.currency,
+                'created_at', inserted.created_at
+            )
+            FROM inserted JOIN users ON users.id = inserted.user_id
+            ORDER BY inserted.id;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER transactions_outbox
+        AFTER INSERT ON transactions
+        REFERENCING NEW TABLE AS inserted
+        FOR EACH STATEMENT
+        EXECUTE FUNCTION write_outbox_events()
+    """)
+
+
+def downgrade():
+    op.execute('DROP TRIGGER transactions_outbox ON transactions')
+    op.execute('DROP FUNCTION write_outbox_events()')
+    op.drop_table('outbox_events')
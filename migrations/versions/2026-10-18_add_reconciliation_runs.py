@@ -0,0 +1,43 @@
+"""Add reconciliation runs
+
+Revision ID: 4c8e1f6a2d93
+Revises: b71d0e5a3f48
+Create Date: 2026-10-18 21:07:12.904116
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c8e1f6a2d93'
+down_revision = 'b71d0e5a3f48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('reconciliation_runs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('started_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('since_watermark', sa.BigInteger(), nullable=True),
+    sa.Column('watermark', sa.BigInteger(), nullable=False),
+    sa.Column('users_checked', sa.BigInteger(), nullable=True),
+    sa.Column('mismatches', sa.BigInteger(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('reconciliation_mismatches',
+    sa.Column('run_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('balance_minor', sa.BigInteger(), nullable=True),
+    sa.Column('ledger_minor', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['run_id'], ['reconciliation_runs.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('run_id', 'user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('reconciliation_mismatches')
+    op.drop_table('reconciliation_runs')
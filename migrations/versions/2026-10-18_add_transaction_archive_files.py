@@ -0,0 +1,32 @@
+"""Add transaction archive files
+
+Revision ID: 9b3f6d1e8a27
+Revises: 5e9a2c7b4d18
+Create Date: 2026-10-18 23:58:14.502917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b3f6d1e8a27'
+down_revision = '5e9a2c7b4d18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('transaction_archives', sa.Column('file_path', sa.String(), nullable=True))
+    op.add_column('transaction_archives', sa.Column('row_count', sa.BigInteger(), nullable=True))
+    op.add_column('transaction_archives', sa.Column('min_created_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('transaction_archives', sa.Column('max_created_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('transaction_archives', sa.Column('exported_at', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade():
+    op.drop_column('transaction_archives', 'exported_at')
+    op.drop_column('transaction_archives', 'max_created_at')
+    op.drop_column('transaction_archives', 'min_created_at')
+    op.drop_column('transaction_archives', 'row_count')
+    op.drop_column('transaction_archives', 'file_path')
@@ -0,0 +1,25 @@
+"""Add transaction correlation ids
+
+Revision ID: 8d2b5f7e1a64
+Revises: 4c8e1f6a2d93
+Create Date: 2026-10-18 22:14:38.250913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2b5f7e1a64'
+down_revision = '4c8e1f6a2d93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Nullable without a default, so adding it doesn't rewrite the partitions
+    op.add_column('transactions', sa.Column('correlation_id', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('transactions', 'correlation_id')
@@ -0,0 +1,25 @@
+"""Disable outbox until enabled
+
+Revision ID: 6d1f8b3a5c29
+Revises: 9b3f6d1e8a27
+Create Date: 2026-10-19 00:12:47.502916
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '6d1f8b3a5c29'
+down_revision = '9b3f6d1e8a27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Nothing delivers the events until outbox_sinks are configured, so they'd only pile
+    # up; python -m app.commands.outbox enable turns the trigger on once there are sinks
+    op.execute('ALTER TABLE transactions DISABLE TRIGGER transactions_outbox')
+
+
+def downgrade():
+    op.execute('ALTER TABLE transactions ENABLE TRIGGER transactions_outbox')
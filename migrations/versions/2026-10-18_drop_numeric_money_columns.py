@@ -0,0 +1,139 @@
+"""Drop numeric money columns
+
+Contract step: once no instance of the previous release is left, the minor unit
+columns become the only money columns. Rows the backfill command hasn't reached
+yet are converted here, inside this migration's transaction, so on a large ledger
+run the command first.
+
+Revision ID: b71d0e5a3f48
+Revises: 6e3a9f1c4b27
+Create Date: 2026-10-18 20:15:02.611843
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b71d0e5a3f48'
+down_revision = '6e3a9f1c4b27'
+branch_labels = None
+depends_on = None
+
+MONEY_COLUMNS = [
+    ('users', 'balance', 'balance_minor'),
+    ('transactions', 'amount', 'amount_minor'),
+    ('balance_checkpoints', 'balance', 'balance_minor'),
+    ('balance_slots', 'balance', 'balance_minor'),
+]
+
+# As in the previous revision, for the downgrade
+CURRENCY_SCALES = {'USD': 2, 'EUR': 2, 'GBP': 2, 'CHF': 2, 'JPY': 0, 'KRW': 0, 'KWD': 3, 'BHD': 3, 'BTC': 8}
+OWNER_SCALE = 'currency_scale((SELECT currency FROM users WHERE id = NEW.user_id))'
+SCALES = {
+    'users': 'currency_scale(NEW.currency)',
+    'transactions': OWNER_SCALE,
+    'balance_checkpoints': OWNER_SCALE,
+    'balance_slots': OWNER_SCALE,
+}
+
+
+def upgrade():
+    op.execute(
+        'UPDATE users SET balance_minor = round(balance * power(10::numeric, currency_scale(currency))) '
+        'WHERE balance_minor IS NULL AND balance IS NOT NULL'
+    )
+    for table, numeric, minor in MONEY_COLUMNS[1:]:
+        op.execute(
+            f'UPDATE {table} '
+            f'SET {minor} = round({table}.{numeric} * power(10::numeric, currency_scale(users.currency))) '
+            f'FROM users WHERE users.id = {table}.user_id AND {table}.{minor} IS NULL AND {table}.{numeric} IS NOT NULL'
+        )
+
+    op.execute('DROP TRIGGER users_balance_changed ON users')
+    for table, numeric, _minor in MONEY_COLUMNS:
+        op.execute(f'DROP TRIGGER {table}_sync_minor_units ON {table}')
+        op.execute(f'DROP FUNCTION sync_{table}_minor_units()')
+        op.drop_column(table, numeric)
+    op.execute('DROP FUNCTION currency_scale(text)')
+    op.execute("""
+        CREATE TRIGGER users_balance_changed
+        BEFORE UPDATE OF balance_minor, balance_slots ON users
+        FOR EACH ROW
+        WHEN (OLD.balance_minor IS DISTINCT FROM NEW.balance_minor OR OLD.balance_slots <> NEW.balance_slots)
+        EXECUTE FUNCTION notify_balance_changed()
+    """)
+
+    op.alter_column('balance_slots', 'balance_minor', server_default='0', nullable=False)
+    # A validated CHECK lets SET NOT NULL skip its full scan under an exclusive lock
+    op.execute(
+        'ALTER TABLE balance_checkpoints ADD CONSTRAINT balance_checkpoints_balance_minor_not_null '
+        'CHECK (balance_minor IS NOT NULL) NOT VALID'
+    )
+    op.execute('ALTER TABLE balance_checkpoints VALIDATE CONSTRAINT balance_checkpoints_balance_minor_not_null')
+    op.alter_column('balance_checkpoints', 'balance_minor', nullable=False)
+    op.drop_constraint('balance_checkpoints_balance_minor_not_null', 'balance_checkpoints')
+
+
+def downgrade():
+    # Back to the expand step: NUMERIC columns filled from the minor units, kept in step by the triggers
+    op.alter_column('balance_checkpoints', 'balance_minor', nullable=True)
+    op.alter_column('balance_slots', 'balance_minor', server_default=None, nullable=True)
+    op.execute('DROP TRIGGER users_balance_changed ON users')
+
+    cases = ' '.join(f"WHEN '{code}' THEN {scale}" for code, scale in CURRENCY_SCALES.items())
+    op.execute(f"""
+        CREATE FUNCTION currency_scale(code text) RETURNS integer AS $$
+            SELECT CASE code {cases} END
+        $$ LANGUAGE sql IMMUTABLE
+    """)
+    op.add_column('users', sa.Column('balance', sa.Numeric(precision=10, scale=2), nullable=True))
+    op.add_column('transactions', sa.Column('amount', sa.Numeric(precision=10, scale=2), nullable=True))
+    op.add_column('balance_checkpoints', sa.Column('balance', sa.Numeric(precision=10, scale=2), nullable=True))
+    op.add_column(
+        'balance_slots', sa.Column('balance', sa.Numeric(precision=10, scale=2), server_default='0', nullable=True),
+    )
+    op.execute('UPDATE users SET balance = balance_minor / power(10::numeric, currency_scale(currency))')
+    for table, numeric, minor in MONEY_COLUMNS[1:]:
+        op.execute(
+            f'UPDATE {table} SET {numeric} = {table}.{minor} / power(10::numeric, currency_scale(users.currency)) '
+            f'FROM users WHERE users.id = {table}.user_id'
+        )
+    op.alter_column('balance_checkpoints', 'balance', nullable=False)
+    op.alter_column('balance_slots', 'balance', nullable=False)
+
+    for table, numeric, minor in MONEY_COLUMNS:
+        scale = SCALES[table]
+        op.execute(f"""
+            CREATE FUNCTION sync_{table}_minor_units() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    IF NEW.{minor} IS NULL THEN
+                        NEW.{minor} := round(NEW.{numeric} * power(10::numeric, {scale}));
+                    ELSIF NEW.{numeric} IS NULL OR NEW.{numeric} = 0 THEN
+                        NEW.{numeric} := NEW.{minor} / power(10::numeric, {scale});
+                    END IF;
+                ELSIF NEW.{numeric} IS DISTINCT FROM OLD.{numeric} THEN
+                    NEW.{minor} := round(NEW.{numeric} * power(10::numeric, {scale}));
+                ELSIF NEW.{minor} IS DISTINCT FROM OLD.{minor} THEN
+                    NEW.{numeric} := NEW.{minor} / power(10::numeric, {scale});
+                END IF;
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        op.execute(
+            f'CREATE TRIGGER {table}_sync_minor_units BEFORE INSERT OR UPDATE ON {table} '
+            f'FOR EACH ROW EXECUTE FUNCTION sync_{table}_minor_units()'
+        )
+    op.execute("""
+        CREATE TRIGGER users_balance_changed
+        BEFORE UPDATE OF balance, balance_minor, balance_slots ON users
+        FOR EACH ROW
+        WHEN (
+            OLD.balance IS DISTINCT FROM NEW.balance
+            OR OLD.balance_minor IS DISTINCT FROM NEW.balance_minor
+            OR OLD.balance_slots <> NEW.balance_slots
+        )
+        EXECUTE FUNCTION notify_balance_changed()
+    """)
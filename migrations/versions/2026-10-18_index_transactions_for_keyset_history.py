@@ -0,0 +1,29 @@
+"""Index transactions for keyset history
+
+Revision ID: 8e1b4c07d2f9
+Revises: 3c5e0d1f7a42
+Create Date: 2026-10-18 14:03:52.610934
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8e1b4c07d2f9'
+down_revision = '3c5e0d1f7a42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # (user_id, created_at, id) serves both keyset history pages and the
+    # point-in-time balance range scans, so it replaces the narrower index
+    op.create_index(
+        'ix_transactions_user_id_created_at_id', 'transactions', ['user_id', 'created_at', 'id'], unique=False,
+    )
+    op.drop_index('ix_transactions_user_id_created_at', table_name='transactions')
+
+
+def downgrade():
+    op.create_index('ix_transactions_user_id_created_at', 'transactions', ['user_id', 'created_at'], unique=False)
+    op.drop_index('ix_transactions_user_id_created_at_id', table_name='transactions')
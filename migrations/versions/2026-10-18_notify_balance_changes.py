@@ -0,0 +1,45 @@
+"""Notify balance changes
+
+Revision ID: 2f8b5d3e9c71
+Revises: 9a4c6e2b8d15
+Create Date: 2026-10-18 19:41:12.804326
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f8b5d3e9c71'
+down_revision = '9a4c6e2b8d15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('balance_version', sa.BigInteger(), server_default='0', nullable=False))
+    # Every write path updates users through its own statement, so the version bump and
+    # the notification live in one trigger rather than in each of them. NOTIFY is only
+    # delivered on commit, and not at all on rollback.
+    op.execute("""
+        CREATE FUNCTION notify_balance_changed() RETURNS trigger AS $$
+        BEGIN
+            NEW.balance_version := OLD.balance_version + 1;
+            PERFORM pg_notify('balance_changed', NEW.id || ':' || NEW.balance_version);
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER users_balance_changed
+        BEFORE UPDATE OF balance, balance_slots ON users
+        FOR EACH ROW
+        WHEN (OLD.balance IS DISTINCT FROM NEW.balance OR OLD.balance_slots <> NEW.balance_slots)
+        EXECUTE FUNCTION notify_balance_changed()
+    """)
+
+
+def downgrade():
+    op.execute('DROP TRIGGER users_balance_changed ON users')
+    op.execute('DROP FUNCTION notify_balance_changed()')
+    op.drop_column('users', 'balance_version')
@@ -0,0 +1,123 @@
+"""Partition transactions by month
+
+Revision ID: 5d7f2a9c1e36
+Revises: 8e1b4c07d2f9
+Create Date: 2026-10-18 16:21:07.118503
+
+"""
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5d7f2a9c1e36'
+down_revision = '8e1b4c07d2f9'
+branch_labels = None
+depends_on = None
+
+MONTHS_AHEAD = 3
+
+
+def add_months(month, months):
+    year, month_index = divmod(month.year * 12 + month.month - 1 + months, 12)
+    return month.replace(year=year, month=month_index + 1)
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    op.create_table('transaction_keys',
+    sa.Column('transaction_id', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('transaction_id')
+    )
+    op.create_table('transaction_archives',
+    sa.Column('partition_name', sa.String(), nullable=False),
+    sa.Column('range_start', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('range_end', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('archived_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('partition_name')
+    )
+    op.execute('CREATE SCHEMA IF NOT EXISTS archive')
+
+    # The sequence belongs to the old table's id column and would be dropped with it
+    op.execute('ALTER SEQUENCE transactions_id_seq OWNED BY NONE')
+    op.create_table('transactions_partitioned',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('transactions_id_seq')"), nullable=False),
+    sa.Column('amount', sa.Numeric(precision=10, scale=2), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('type', postgresql.ENUM(name='transactiontype', create_type=False), nullable=False),
+    sa.Column('transaction_id', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    postgresql_partition_by='RANGE (created_at)',
+    )
+
+    # Monthly partitions from the oldest dated row to MONTHS_AHEAD months from now.
+    # Rows from before created_at existed are dated at the epoch and, with anything
+    # older than the first month, go to transactions_legacy.
+    now = datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    oldest = bind.scalar(sa.text("SELECT date_trunc('month', min(created_at), 'UTC') FROM transactions"))
+    first = min(oldest.astimezone(timezone.utc), now) if oldest is not None else now
+    op.execute(
+        'CREATE TABLE transactions_legacy PARTITION OF transactions_partitioned '
+        f"FOR VALUES FROM (MINVALUE) TO ('{first.isoformat()}')"
+    )
+    month = first
+    while month <= add_months(now, MONTHS_AHEAD):
+        op.execute(
+            f'CREATE TABLE transactions_y{month.year:04d}m{month.month:02d} PARTITION OF transactions_partitioned '
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+        )
+        month = add_months(month, 1)
+
+    op.execute(
+        'INSERT INTO transactions_partitioned (id, amount, user_id, type, transaction_id, created_at) '
+        "SELECT id, amount, user_id, type, transaction_id, coalesce(created_at, 'epoch') FROM transactions"
+    )
+    op.execute(
+        'INSERT INTO transaction_keys (transaction_id, created_at) '
+        'SELECT transaction_id, created_at FROM transactions_partitioned'
+    )
+    op.drop_table('transactions')
+    op.rename_table('transactions_partitioned', 'transactions')
+    op.execute('ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id')
+
+    op.create_primary_key('transactions_pkey', 'transactions', ['id', 'created_at'])
+    op.create_foreign_key('transactions_user_id_fkey', 'transactions', 'users', ['user_id'], ['id'])
+    op.create_index('ix_transactions_transaction_id', 'transactions', ['transaction_id'], unique=False)
+    op.create_index(
+        'ix_transactions_user_id_created_at_id', 'transactions', ['user_id', 'created_at', 'id'], unique=False,
+    )
+
+
+def downgrade():
+    # Archived partitions are not brought back
+    op.execute('ALTER SEQUENCE transactions_id_seq OWNED BY NONE')
+    op.create_table('transactions_unpartitioned',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('transactions_id_seq')"), nullable=False),
+    sa.Column('amount', sa.Numeric(precision=10, scale=2), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('type', postgresql.ENUM(name='transactiontype', create_type=False), nullable=False),
+    sa.Column('transaction_id', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    )
+    op.execute(
+        'INSERT INTO transactions_unpartitioned (id, amount, user_id, type, transaction_id, created_at) '
+        'SELECT id, amount, user_id, type, transaction_id, created_at FROM transactions'
+    )
+    op.drop_table('transactions')
+    op.rename_table('transactions_unpartitioned', 'transactions')
+    op.execute('ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id')
+
+    op.create_primary_key('transactions_pkey', 'transactions', ['id'])
+    op.create_unique_constraint('transactions_transaction_id_key', 'transactions', ['transaction_id'])
+    op.create_foreign_key('transactions_user_id_fkey', 'transactions', 'users', ['user_id'], ['id'])
+    op.create_index('ix_transactions_id', 'transactions', ['id'], unique=False)
+    op.create_index(
+        'ix_transactions_user_id_created_at_id', 'transactions', ['user_id', 'created_at', 'id'], unique=False,
+    )
+    op.drop_table('transaction_archives')
+    op.drop_table('transaction_keys')
@@ -0,0 +1,112 @@
+import enum
+import math
+import time
+import typing
+
+from app.cache import TTLCache
+
+
+class Priority(enum.IntEnum):
+    """Request classes, in the order they are shed: bulk writes first, reads last."""
+    BULK = 0
+    WRITE = 1
+    READ = 2
+
+
+class Shed(typing.NamedTuple):
+    status: int
+    detail: str
+    retry_after: int
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float) -> None:
+        self.tokens = tokens
+        self.updated = time.monotonic()
+
+    def take(self, rate: float, burst: float) -> float:
+        """Take a token if there is one; returns 0, or the seconds until there will be one."""
+        now = time.monotonic()
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / rate
+
+
+class AdmissionController:
+    """Decides, without queueing, whether a request may start.
+
+    A request is admitted while fewer than its priority's limit are in flight in
+    total: max_in_flight for reads, and the write_share and bulk_share fractions of
+    it for writes and bulk writes, so lower priorities are turned away first and
+    always leave headroom for the higher ones. Each user also has a token bucket
+    refilled at user_rate per second, up to user_burst. Buckets idle long enough to
+    be full again are forgotten, so only recently active users take memory.
+
+    Not thread-safe; meant to be used from a single event loop.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int,
+        write_share: float,
+        bulk_share: float,
+        user_rate: float,
+        user_burst: int,
+        max_users: int,
+        retry_after: int,
+    ) -> None:
+        self.limits = {
+            Priority.READ: max_in_flight,
+            Priority.WRITE: max(1, int(max_in_flight * write_share)),
+            Priority.BULK: max(1, int(max_in_flight * bulk_share)),
+        }
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed_overloaded = 0
+        self.shed_rate_limited = 0
+        self._buckets: TTLCache[str, TokenBucket] = TTLCache(
+            maxsize=max_users, ttl=user_burst / user_rate if user_rate else 0,
+        )
+
+    def admit(self, priority: Priority, user: str | None) -> Shed | None:
+        """None if the request may start, in which case release() must follow; else why it was shed."""
+        if self.in_flight >= self.limits[priority]:
+            self.shed_overloaded += 1
+            return Shed(503, "Server is at capacity", self.retry_after)
+        if user is not None and self.user_rate:
+            bucket = self._buckets.get(user)
+            if bucket is None:
+                bucket = TokenBucket(self.user_burst)
+            wait = bucket.take(self.user_rate, self.user_burst)
+            # Stored again on every request, which restarts its expiry
+            self._buckets.set(user, bucket)
+            if wait:
+                self.shed_rate_limited += 1
+                return Shed(429, "Too many requests", math.ceil(wait))
+
+        self.in_flight += 1
+        self.admitted += 1
+        return None
+
+    def release(self) -> None:
+        self.in_flight -= 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.limits[Priority.READ],
+            "max_writes_in_flight": self.limits[Priority.WRITE],
+            "max_bulk_in_flight": self.limits[Priority.BULK],
+            "tracked_users": len(self._buckets),
+            "admitted": self.admitted,
+            "shed_overloaded": self.shed_overloaded,
+            "shed_rate_limited": self.shed_rate_limited,
+        }
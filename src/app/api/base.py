@@ -1,20 +1,43 @@
 from sqlalchemy.ext.asyncio import (
     async_sessionmaker,
-    create_async_engine,
+    AsyncEngine,
     AsyncSession as AsyncSessionType,
 )
+import hmac
+import time
+import typing
+
 from sqlalchemy import URL
-from sqlalchemy.orm import Session
 from jose import JWTError, jwt
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, Header, HTTPException, status
 
+from app import schemas
+from app.admission import AdmissionController
+from app.cache import TTLCache, VersionedCache
+from app.db.replicas import ReplicaRouter
+from app.metrics import Metrics
+from app.middleware import RoundTripStats
+from app.money import DEFAULT_CURRENCY, Balance
+from app.passwords import PasswordHasher
 from app.settings import Settings
 from app.repositories import PaymentRepository
-from app.custom_types import FAST_API_SCHEME
+from app.repositories.group_commit import GroupCommitter
 from app.repositories.utils import SECRET_KEY, ALGORITHM, oauth2_scheme, get_user
 
 
+Endpoint = typing.TypeVar("Endpoint", bound=typing.Callable[..., typing.Any])
+
+
+def read_only(endpoint: Endpoint) -> Endpoint:
+    """Route a POST endpoint's sessions like a GET's: to a replica, without marking its client as a writer.
+
+    For reads whose input is too large for a query string.
+    """
+    endpoint.read_only = True  # type: ignore[attr-defined]
+    return endpoint
+
+
 def get_dsn(scheme: str | None = None) -> URL:
     settings = Settings(scheme=scheme)
     return settings.db_dsn
@@ -24,26 +47,89 @@ def get_settings() -> Settings:
     raise NotImplementedError
 
 
-engine = create_async_engine(get_dsn(scheme=FAST_API_SCHEME), echo=True)
-async_session = async_sessionmaker(
-    autocommit=False, autoflush=False, bind=engine, class_=AsyncSessionType
-)
+def get_principal_cache() -> TTLCache[str, schemas.Principal]:
+    raise NotImplementedError
+
+
+def get_balance_cache() -> VersionedCache[int, Balance] | None:
+    raise NotImplementedError
 
 
-async def get_db() -> async_sessionmaker[AsyncSessionType]:
-    async with async_session() as session:
-        yield session
+def get_password_hasher() -> PasswordHasher:
+    raise NotImplementedError
+
+
+def get_engine() -> AsyncEngine:
+    raise NotImplementedError
+
+
+def get_round_trip_stats() -> RoundTripStats:
+    raise NotImplementedError
+
+
+def get_replica_router() -> ReplicaRouter:
+    raise NotImplementedError
+
+
+def get_metrics() -> Metrics:
+    raise NotImplementedError
+
+
+def get_group_committer() -> GroupCommitter | None:
+    raise NotImplementedError
+
+
+def get_admission_controller() -> AdmissionController:
+    raise NotImplementedError
+
+
+def get_session_maker() -> async_sessionmaker[AsyncSessionType]:
+    raise NotImplementedError
+
+
+async def get_db(
+    session_maker: async_sessionmaker[AsyncSessionType] = Depends(get_session_maker),
+) -> typing.AsyncIterator[AsyncSessionType]:
+    """One session and one DB transaction per request, shared by every dependency.
+
+    Committed once after the endpoint returns, rolled back if it raises.
+    """
+    async with session_maker() as session:
+        async with session.begin():
+            yield session
+
+
+def require_operator(
+    x_operator_key: str | None = Header(None),
+    settings: Settings = Depends(get_settings),
+) -> None:
+    """Admit only callers with the operator key, for endpoints over other users' wallets.
+
+    Every call is refused while operator_api_key is empty.
+    """
+    if not settings.operator_api_key or x_operator_key is None or not hmac.compare_digest(
+        x_operator_key.encode(), settings.operator_api_key.encode(),
+    ):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Operator credentials required")
 
 
 def get_payment_repo(
-    db: async_sessionmaker[AsyncSessionType] = Depends(get_db),
+    db: AsyncSessionType = Depends(get_db),
 ) -> PaymentRepository:
     return PaymentRepository(
-        db_session_maker=db,
+        db_session=db,
     )
 
 
-async def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
+async def get_current_user(
+    db: AsyncSessionType = Depends(get_db),
+    token: str = Depends(oauth2_scheme),
+    principal_cache: TTLCache[str, schemas.Principal] = Depends(get_principal_cache),
+) -> schemas.Principal:
+    principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -56,7 +142,38 @@ async def get_current_user(db: Session = Depends(get_db), token: str = Depends(o
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = await get_user(db, email)
-    if user is None:
-        raise credentials_exception
-    return user
+
+    user_id: int | None = payload.get("uid")
+    if user_id is not None:
+        # Tokens without the currency claim predate currencies, when every wallet was USD
+        principal = schemas.Principal(id=user_id, email=email, currency=payload.get("cur", DEFAULT_CURRENCY))
+    else:
+        # Tokens issued before the user id claim was added still need the lookup
+        user = await get_user(db, email)
+        if user is None:
+            raise credentials_exception
+        principal = schemas.Principal.model_validate(user)
+
+    # Never keep a principal cached past its token's expiry; tokens without one get the cache's TTL
+    expires = payload.get("exp")
+    principal_cache.set(token, principal, ttl=expires - time.time() if expires is not None else None)
+    return principal
+
+
+async def get_wallet_owner(
+    user_id: int,
+    current_user: schemas.Principal = Depends(get_current_user),
+) -> schemas.Principal:
+    """The current user, for endpoints on the wallet user_id; other users' wallets are not found."""
+    if user_id != current_user.id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    return current_user
+
+
+def invalidate_principal(principal_cache: TTLCache[str, schemas.Principal], user: schemas.Principal) -> int:
+    """Drop every cached principal of a user, by id or by email, e.g. after their account changed.
+
+    Tokens without the user id claim are resolved by email, so a principal cached for
+    one may belong to a former holder of the user's email.
+    """
+    return principal_cache.invalidate(lambda principal: principal.id == user.id or principal.email == user.email)
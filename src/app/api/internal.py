@@ -0,0 +1,37 @@
+import typing
+
+import fastapi
+from fastapi import Depends
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app import schemas
+from app.admission import AdmissionController
+from app.api.base import (
+    get_admission_controller, get_engine, get_password_hasher, get_principal_cache, get_replica_router,
+    get_round_trip_stats, require_operator,
+)
+from app.cache import TTLCache
+from app.db.replicas import ReplicaRouter
+from app.middleware import RoundTripStats
+from app.passwords import PasswordHasher
+
+ROUTER: typing.Final = fastapi.APIRouter()
+
+
+@ROUTER.get("/stats/", dependencies=[Depends(require_operator)])
+async def get_stats(
+    hasher: PasswordHasher = Depends(get_password_hasher),
+    principal_cache: TTLCache[str, schemas.Principal] = Depends(get_principal_cache),
+    engine: AsyncEngine = Depends(get_engine),
+    round_trip_stats: RoundTripStats = Depends(get_round_trip_stats),
+    replica_router: ReplicaRouter = Depends(get_replica_router),
+    admission_controller: AdmissionController = Depends(get_admission_controller),
+) -> dict[str, dict[str, typing.Any]]:
+    return {
+        "admission": admission_controller.stats(),
+        "db_pool": engine.pool.stats(),
+        "db_replicas": replica_router.stats(),
+        "db_round_trips": round_trip_stats.stats(),
+        "password_pool": hasher.stats(),
+        "principal_cache": principal_cache.stats(),
+    }
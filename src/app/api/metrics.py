@@ -0,0 +1,15 @@
+import typing
+
+import fastapi
+from fastapi import Depends
+from fastapi.responses import PlainTextResponse
+
+from app.api.base import get_metrics
+from app.metrics import Metrics
+
+ROUTER: typing.Final = fastapi.APIRouter()
+
+
+@ROUTER.get("/metrics", include_in_schema=False)
+async def get_prometheus_metrics(metrics: Metrics = Depends(get_metrics)) -> PlainTextResponse:
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
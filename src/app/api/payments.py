@@ -1,25 +1,67 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
 import typing
 
 import fastapi
 from fastapi import Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from starlette import status
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
 from app import schemas
-from app.exceptions import PaymentError, UserExistsError
+from app.cache import TTLCache, VersionedCache
+from app.custom_types import TransactionType
+from app.exceptions import PaymentError, UserExistsError, PasswordPoolSaturatedError
+from app.money import Balance, from_minor_units, to_minor_units
 from app.repositories import PaymentRepository
-from app.api.base import get_payment_repo, get_current_user, get_db
-from app.models import User
+from app.api.base import (
+    get_payment_repo, get_current_user, get_db, get_settings, get_password_hasher, get_session_maker,
+    get_group_committer, get_balance_cache, get_principal_cache, get_wallet_owner, invalidate_principal, read_only,
+    require_operator,
+)
+from app.passwords import PasswordHasher
 from app.repositories.utils import authenticate_user, ACCESS_TOKEN_EXPIRE_MINUTES, create_access_token
-from schemas import TokenRequestForm
+from app.repositories.group_commit import GroupCommitter
+from app.repositories.archive import get_archive_horizon
+from app.repositories.balances import balances_query, stream_balances
+from app.repositories.history import get_archived_history, history_query, stream_history
+from app.repositories.ingest import ingest_ndjson, iter_lines
+from app.repositories.rollups import get_day_balance, get_statement
+from app.repositories.transfers import settle_transfers
+from app.schemas import TokenRequestForm
+from app.settings import Settings
 
 ROUTER: typing.Final = fastapi.APIRouter()
 
 
+def service_unavailable(e: Exception) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail=str(e),
+        headers={"Retry-After": "1"},
+    )
+
+
+def minor_units(amount: Decimal, currency: str) -> int:
+    try:
+        return to_minor_units(amount, currency)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(e),
+        )
+
+
 @ROUTER.post("/token", response_model=dict)
-async def login_for_access_token(form_data: TokenRequestForm, db: Session = Depends(get_db)):
-    user = await authenticate_user(db, form_data.email, form_data.password)
+async def login_for_access_token(
+    form_data: TokenRequestForm,
+    db: AsyncSession = Depends(get_db),
+    hasher: PasswordHasher = Depends(get_password_hasher),
+):
+    try:
+        user = await authenticate_user(db, form_data.email, form_data.password, hasher)
+    except PasswordPoolSaturatedError as e:
+        raise service_unavailable(e)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -28,7 +70,7 @@ async def login_for_access_token(form_data: TokenRequestForm, db: Session = Depe
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+        data={"sub": user.email, "uid": user.id, "cur": user.currency}, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -37,14 +79,22 @@ async def login_for_access_token(form_data: TokenRequestForm, db: Session = Depe
 async def create_user(
     data: schemas.UserCreate,
     payment_repo: PaymentRepository = fastapi.Depends(get_payment_repo),
+    hasher: PasswordHasher = Depends(get_password_hasher),
+    principal_cache: TTLCache[str, schemas.Principal] = Depends(get_principal_cache),
 ) -> schemas.User:
     try:
-        user = await payment_repo.create_user(payment_repo, data)
+        hashed_password = await hasher.hash(data.password)
+    except PasswordPoolSaturatedError as e:
+        raise service_unavailable(e)
+    try:
+        user = await payment_repo.create_user(payment_repo, data, hashed_password)
     except UserExistsError as e:
         raise fastapi.HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail=str(e),
         )
+    # The email may have belonged to an account since removed, whose principals are still cached
+    invalidate_principal(principal_cache, schemas.Principal.model_validate(user))
     return typing.cast(schemas.User, user)
 
 
@@ -52,31 +102,213 @@ async def create_user(
 async def get_user_balance(
     user_id: int,
     ts: int | None = None,
-    current_user: User = Depends(get_current_user),
+    day: date | None = None,
+    current_user: schemas.Principal = Depends(get_current_user),
     payment_repo: PaymentRepository = fastapi.Depends(get_payment_repo),
+    balance_cache: VersionedCache[int, Balance] | None = Depends(get_balance_cache),
 ) -> schemas.UserBalance:
-    balance = await payment_repo.get_user_balance(payment_repo, user_id=user_id, ts=ts)
+    """The balance now, as of the unix timestamp ts, or at the end of the UTC day, from its rollup."""
+    if day is not None:
+        balance = await get_day_balance(payment_repo.db_session, user_id, day)
+    elif not ts and balance_cache is not None:
+        balance = await payment_repo.get_cached_balance(payment_repo, user_id, balance_cache)
+    else:
+        balance = await payment_repo.get_user_balance(payment_repo, user_id=user_id, ts=ts)
     if balance is None:
         raise fastapi.HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    return typing.cast(schemas.UserBalance, {"amount": balance})
+    return schemas.UserBalance(amount=from_minor_units(balance.amount, balance.currency), currency=balance.currency)
+
+
+@ROUTER.post("/user/balances/", dependencies=[Depends(require_operator)])
+@read_only
+async def get_user_balances(
+    query: schemas.BalancesQuery,
+    db: AsyncSession = Depends(get_db),
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker),
+    settings: Settings = Depends(get_settings),
+) -> StreamingResponse:
+    """Balances of many wallets, now or at ts, as NDJSON UserBalanceEntry lines in user id order.
+
+    One query however many ids are asked for; unknown ids, and at ts wallets with no
+    history by then, are left out. Being over other users' wallets, it's an operator endpoint.
+    A ts before the archive horizon is refused: the ledger rows up to it are no longer
+    in transactions but in archive files or detached partitions, which only the
+    single-wallet endpoint reads.
+    """
+    user_ids = sorted(set(query.user_ids))
+    if len(user_ids) > settings.balance_batch_max_ids:
+        raise fastapi.HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"At most {settings.balance_batch_max_ids} user ids per request",
+        )
+    if query.ts:
+        horizon = await get_archive_horizon(db)
+        if horizon is not None and datetime.fromtimestamp(query.ts, timezone.utc) < horizon:
+            raise fastapi.HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Batch balances are only available from {horizon.isoformat()}",
+            )
+    stmt = balances_query(user_ids, query.ts)
+    return StreamingResponse(stream_balances(session_maker, stmt), media_type="application/x-ndjson")
+
+
+@ROUTER.get("/user/{user_id}/transactions/")
+async def get_transaction_history(
+    user_id: int,
+    limit: int = fastapi.Query(100, ge=1, le=1000),
+    cursor: str | None = None,
+    type: TransactionType | None = None,
+    since: int | None = None,
+    until: int | None = None,
+    stream: bool = False,
+    current_user: schemas.Principal = Depends(get_wallet_owner),
+    payment_repo: PaymentRepository = fastapi.Depends(get_payment_repo),
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker),
+) -> schemas.TransactionPage:
+    """A user's ledger, oldest first, paginated by an opaque cursor.
+
+    With stream=true the whole remaining history (from cursor, ignoring limit) is
+    sent as NDJSON without being held in memory.
+    """
+    filters = {
+        "type_": type,
+        "since": datetime.fromtimestamp(since) if since is not None else None,
+        "until": datetime.fromtimestamp(until) if until is not None else None,
+        "cursor": cursor,
+    }
+    stmt = history_query(user_id, **filters)
+    # Rows of archived months, read from their archive files or tables ahead of the live ones
+    archived = await get_archived_history(payment_repo.db_session, session_maker, user_id, **filters)
+    if stream:
+        return StreamingResponse(stream_history(session_maker, stmt, archived), media_type="application/x-ndjson")
+
+    return await payment_repo.get_transaction_history(payment_repo, stmt, limit, archived)
+
+
+@ROUTER.get("/user/{user_id}/statement/")
+async def get_user_statement(
+    user_id: int,
+    since: int,
+    until: int | None = None,
+    current_user: schemas.Principal = Depends(get_wallet_owner),
+    db: AsyncSession = Depends(get_db),
+) -> schemas.Statement:
+    """Opening and closing balance, and deposit and withdrawal totals, between unix timestamps since and until.
+
+    until defaults to now. Whole UTC days come from the daily rollups, so the cost
+    doesn't grow with the length of the range.
+    """
+    _since = datetime.fromtimestamp(since, timezone.utc)
+    _until = datetime.fromtimestamp(until, timezone.utc) if until is not None else datetime.now(timezone.utc)
+    if _until <= _since:
+        raise fastapi.HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="until must be after since",
+        )
+    statement = await get_statement(db, user_id, _since, _until)
+    if statement is None:
+        raise fastapi.HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    return statement
 
 
 @ROUTER.post("/transaction/")
 async def add_transaction(
     data: schemas.TransactionAdd,
-    current_user: User = Depends(get_current_user),
+    idempotency_key: str | None = fastapi.Header(None),
+    current_user: schemas.Principal = Depends(get_current_user),
     payment_repo: PaymentRepository = fastapi.Depends(get_payment_repo),
+    group_committer: GroupCommitter | None = Depends(get_group_committer),
 ) -> schemas.Transaction:
+    if data.uid is None and idempotency_key is not None:
+        data.uid = idempotency_key
+    amount = minor_units(data.amount, current_user.currency)
+    entry = schemas.TransactionEntry(amount=amount, type=data.type, uid=data.uid)
+    try:
+        if group_committer is not None:
+            transaction = await group_committer.add_transaction(entry, current_user)
+        else:
+            transaction = await payment_repo.add_transaction(payment_repo, entry, current_user)
+    except PaymentError as e:
+        raise fastapi.HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e),
+        )
+
+    return schemas.Transaction.from_ledger(transaction, current_user.currency)
+
+
+@ROUTER.post("/transfer/")
+async def add_transfer(
+    data: schemas.TransferAdd,
+    idempotency_key: str | None = fastapi.Header(None),
+    current_user: schemas.Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+) -> schemas.Transfer:
+    """Move money from the caller's wallet to another of the same currency, in one DB transaction.
+
+    Writes a WITHDRAW and a DEPOSIT leg sharing a correlation id, which is the uid
+    (or Idempotency-Key) if given.
+    """
+    if data.uid is None and idempotency_key is not None:
+        data.uid = idempotency_key
+    transfers = await _settle(db, [data], current_user)
+    return transfers[0]
+
+
+@ROUTER.post("/transfer/batch/")
+async def add_transfers(
+    data: schemas.TransferBatch,
+    current_user: schemas.Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    settings: Settings = Depends(get_settings),
+) -> list[schemas.Transfer]:
+    """Many transfers from the caller's wallet, settled together in one statement: all of them or none.
+
+    The caller's balance only has to cover their total.
+    """
+    if len(data.transfers) > settings.transfer_batch_max_size:
+        raise fastapi.HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"At most {settings.transfer_batch_max_size} transfers per request",
+        )
+    return await _settle(db, data.transfers, current_user)
+
+
+async def _settle(
+    db: AsyncSession, transfers: list[schemas.TransferAdd], current_user: schemas.Principal,
+) -> list[schemas.Transfer]:
+    entries = [
+        schemas.TransferEntry(
+            from_user_id=current_user.id,
+            to_user_id=transfer.to_user_id,
+            amount=minor_units(transfer.amount, current_user.currency),
+            uid=transfer.uid,
+        )
+        for transfer in transfers
+    ]
     try:
-        transaction = await payment_repo.add_transaction(payment_repo, data, await current_user)
+        legs = await settle_transfers(db, entries)
     except PaymentError as e:
         raise fastapi.HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail=str(e),
         )
+    return [schemas.Transfer.from_legs(debit, credit, current_user.currency) for debit, credit in legs]
+
+
+@ROUTER.post("/transaction/bulk/", dependencies=[Depends(require_operator)])
+async def ingest_transactions(
+    request: fastapi.Request,
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_session_maker),
+    settings: Settings = Depends(get_settings),
+) -> schemas.IngestReport:
+    """Stream an NDJSON body of transactions (one TransactionIngest per line) into the ledger.
 
-    return typing.cast(schemas.Transaction, transaction)
+    Rows may be for any wallet, so this is an operator endpoint, like the ingest command.
+    Every batch commits on its own, so this bypasses the request-scoped session.
+    """
+    return await ingest_ndjson(session_maker, iter_lines(request.stream()), settings.bulk_ingest_batch_size)
 
 
 @ROUTER.get("/transaction/{transaction_id}")
@@ -84,8 +316,8 @@ async def get_transaction(
     transaction_id: str,
     payment_repo: PaymentRepository = fastapi.Depends(get_payment_repo),
 ) -> schemas.Transaction:
-    transaction = await payment_repo.get_transaction(transaction_id, payment_repo)
+    transaction = await payment_repo.get_transaction(payment_repo, transaction_id)
     if transaction is None:
         raise fastapi.HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Transaction not found")
-    return typing.cast(schemas.Transaction, transaction)
+    return transaction
 
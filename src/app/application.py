@@ -1,28 +1,69 @@
+import asyncio
 import contextlib
 import typing
 
 import fastapi
+from fastapi.routing import APIRoute
 
 
 from sqlalchemy.ext.asyncio import (
     async_sessionmaker,
-    create_async_engine,
     AsyncSession as AsyncSessionType,
     AsyncEngine,
 )
 
-from app.api.payments import ROUTER
+from app.admission import AdmissionController
+from app.api import internal, metrics, payments
 from app.settings import Settings
-from app.api.base import get_db
+from app.api.base import (
+    get_session_maker, get_engine, get_settings, get_principal_cache, get_password_hasher, get_round_trip_stats,
+    get_replica_router, get_metrics, get_group_committer, get_balance_cache, get_admission_controller,
+)
+from app.cache import TTLCache, VersionedCache
+from app.db.notifications import BalanceListener
+from app.db.replicas import Replica, ReplicaRouter, get_current_lsn, parse_lsn
+from app.db.resource import build_engine
+from app.metrics import Metric, Metrics, instrument_engine, stats_gauges
+from app.middleware import (
+    READ_AFTER_COOKIE, AdmissionMiddleware, MetricsMiddleware, ReadYourWritesMiddleware, RoundTripCounterMiddleware,
+    RoundTripStats,
+)
+from app.money import Balance
+from app.outbox import OutboxDispatcher, load_sink
+from app.passwords import PasswordHasher
+from app.repositories.outbox import is_outbox_enabled
+from app.repositories.group_commit import GroupCommitter
+
+
+READ_ONLY_METHODS: typing.Final = frozenset(("GET", "HEAD", "OPTIONS"))
 
 
 def include_routers(app: fastapi.FastAPI) -> None:
-    app.include_router(ROUTER, prefix="/api")
+    app.include_router(payments.ROUTER, prefix="/api")
+    app.include_router(internal.ROUTER, prefix="/api/internal")
+    app.include_router(metrics.ROUTER)
+
+
+def read_only_paths(app: fastapi.FastAPI) -> list[str]:
+    """Paths of the app's routes whose endpoints are marked read_only."""
+    return [
+        route.path for route in app.routes
+        if isinstance(route, APIRoute) and getattr(route.endpoint, "read_only", False)
+    ]
 
 
 class AppBuilder:
     _async_engine: AsyncEngine
     _session_maker: async_sessionmaker[AsyncSessionType]
+    _read_only_session_maker: async_sessionmaker[AsyncSessionType]
+    _health_checks: asyncio.Task[None] | None
+    _balance_listener_task: asyncio.Task[None] | None
+    _outbox_task: asyncio.Task[None] | None
+    balance_listener: BalanceListener | None
+    replica_router: ReplicaRouter
+    password_hasher: PasswordHasher
+    group_committer: GroupCommitter | None
+    outbox_dispatcher: OutboxDispatcher | None
 
     def __init__(self) -> None:
         self.settings = Settings()
@@ -31,19 +72,230 @@ class AppBuilder:
             debug=self.settings.debug,
             lifespan=self.lifespan_manager,
         )
+        self.principal_cache = TTLCache(
+            maxsize=self.settings.principal_cache_size,
+            ttl=self.settings.principal_cache_ttl_seconds,
+        )
+        self.balance_cache: VersionedCache[int, Balance] = VersionedCache(maxsize=self.settings.balance_cache_size)
+
+        self.admission_controller = AdmissionController(
+            max_in_flight=self.settings.admission_max_in_flight or self._pool_capacity(),
+            write_share=self.settings.admission_write_share,
+            bulk_share=self.settings.admission_bulk_share,
+            user_rate=self.settings.admission_user_rate,
+            user_burst=self.settings.admission_user_burst,
+            max_users=self.settings.principal_cache_size,
+            retry_after=self.settings.admission_retry_after_seconds,
+        )
 
-        self.app.dependency_overrides[get_db] = self.get_async_session_maker
         include_routers(self.app)
 
-    async def get_async_session_maker(self) -> AsyncSessionType:
-        return self._session_maker
+        self.round_trip_stats = RoundTripStats()
+        self.app.add_middleware(RoundTripCounterMiddleware, stats=self.round_trip_stats)
+        self.metrics = Metrics()
+        self.metrics.register_collector(self.collect_metrics)
+        # Inside MetricsMiddleware, so shed requests are counted and timed too
+        self.app.add_middleware(
+            AdmissionMiddleware,
+            controller=self.admission_controller,
+            principal_cache=self.principal_cache,
+            metrics=self.metrics,
+            bulk_paths=self.settings.admission_bulk_paths,
+            read_paths=read_only_paths(self.app),
+            exempt_paths=tuple(self.settings.admission_exempt_paths),
+        )
+        self.app.add_middleware(ReadYourWritesMiddleware, max_age=self.settings.db_read_your_writes_seconds)
+        # Added last so it is outermost and times the whole request
+        self.app.add_middleware(MetricsMiddleware, metrics=self.metrics)
+
+        self.app.dependency_overrides[get_session_maker] = self.get_async_session_maker
+        self.app.dependency_overrides[get_engine] = self.get_engine
+        self.app.dependency_overrides[get_round_trip_stats] = self.get_round_trip_stats
+        self.app.dependency_overrides[get_replica_router] = self.get_replica_router
+        self.app.dependency_overrides[get_metrics] = self.get_metrics
+        self.app.dependency_overrides[get_group_committer] = self.get_group_committer
+        self.app.dependency_overrides[get_balance_cache] = self.get_balance_cache
+        self.app.dependency_overrides[get_admission_controller] = self.get_admission_controller
+        self.app.dependency_overrides[get_settings] = self.get_settings
+        self.app.dependency_overrides[get_principal_cache] = self.get_principal_cache
+        self.app.dependency_overrides[get_password_hasher] = self.get_password_hasher
+
+    def get_settings(self) -> Settings:
+        return self.settings
+
+    def get_principal_cache(self) -> TTLCache:
+        return self.principal_cache
+
+    def get_password_hasher(self) -> PasswordHasher:
+        return self.password_hasher
+
+    def get_engine(self) -> AsyncEngine:
+        return self._async_engine
+
+    def get_round_trip_stats(self) -> RoundTripStats:
+        return self.round_trip_stats
+
+    def get_replica_router(self) -> ReplicaRouter:
+        return self.replica_router
+
+    def get_metrics(self) -> Metrics:
+        return self.metrics
+
+    def get_group_committer(self) -> GroupCommitter | None:
+        return self.group_committer
+
+    def get_admission_controller(self) -> AdmissionController:
+        return self.admission_controller
+
+    def _pool_capacity(self) -> int:
+        """Connections the primary's pool can open, and each replica's as well."""
+        return (self.settings.db_pool_size + self.settings.db_max_overflow) * (1 + len(self.settings.db_replica_dsns))
+
+    def get_balance_cache(self, request: fastapi.Request) -> VersionedCache[int, Balance] | None:
+        """The balance cache, unless it can't be trusted: not listening, or this client wrote recently.
+
+        A client's own write notifies asynchronously, so it could otherwise read its
+        old balance from the cache right after the write.
+        """
+        if self.balance_listener is None or not self.balance_listener.connected:
+            return None
+        if self._read_after(request) is not None:
+            return None
+        return self.balance_cache
+
+    def collect_metrics(self) -> list[Metric]:
+        """The stats() of long-lived resources, read on each scrape."""
+        replicas = self.replica_router.stats()["replicas"]
+        pools = {("primary",): self._async_engine.pool.stats()}
+        pools.update({(name,): replica["pool"] for name, replica in replicas.items()})
+        return [
+            *stats_gauges("db_pool", "Connection pool", pools, ("db",)),
+            *stats_gauges(
+                "db_replica", "Read replica", {(name,): replica for name, replica in replicas.items()}, ("db",),
+            ),
+            *stats_gauges("password_pool", "bcrypt worker pool", {(): self.password_hasher.stats()}),
+            *stats_gauges("principal_cache", "Resolved token cache", {(): self.principal_cache.stats()}),
+            *stats_gauges("balance_cache", "Balance cache", {(): self.balance_cache.stats()}),
+            *stats_gauges("admission", "Admission control", {(): self.admission_controller.stats()}),
+            *(
+                stats_gauges("outbox", "Outbox dispatcher", {(): self.outbox_dispatcher.stats()})
+                if self.outbox_dispatcher is not None else []
+            ),
+        ]
+
+    @staticmethod
+    def _read_after(request: fastapi.Request) -> int | None:
+        """The WAL position of the client's last write, from its cookie; None if it has none."""
+        try:
+            return parse_lsn(request.cookies[READ_AFTER_COOKIE])
+        except (KeyError, ValueError):
+            return None
+
+    async def get_async_session_maker(
+        self, request: fastapi.Request,
+    ) -> typing.AsyncIterator[async_sessionmaker[AsyncSessionType]]:
+        """Writes go to the primary; reads go to a healthy replica that has this client's last write."""
+        read_only = getattr(request.scope.get("endpoint"), "read_only", False)
+        if request.method not in READ_ONLY_METHODS and not read_only:
+            yield self._session_maker
+            # Runs after get_db has committed, so the position is at or past the write's.
+            # Without replicas there's nothing to compare it with, but the cookie still
+            # keeps the client off the balance cache
+            request.state.commit_lsn = (
+                await get_current_lsn(self._async_engine) if self.replica_router.replicas else 0
+            )
+            return
+
+        if (replica := self.replica_router.pick(self._read_after(request) or 0)) is not None:
+            yield replica.session_maker
+        else:
+            yield self._read_only_session_maker
 
     async def init_async_resources(self) -> None:
-        self._async_engine = create_async_engine(self.settings.db_dsn)
+        self._async_engine = build_engine(self.settings)
+        instrument_engine(self._async_engine, self.metrics, "primary")
         self._session_maker = async_sessionmaker(bind=self._async_engine, expire_on_commit=False)
+        # BEGIN READ ONLY is sent as part of the same BEGIN, so it costs no extra round trip
+        self._read_only_session_maker = async_sessionmaker(
+            bind=self._async_engine.execution_options(postgresql_readonly=True),
+            expire_on_commit=False,
+        )
+        self.replica_router = ReplicaRouter(
+            [
+                Replica(engine.url.render_as_string(hide_password=True), engine)
+                for engine in (build_engine(self.settings, dsn) for dsn in self.settings.db_replica_dsns)
+            ],
+            max_lag_seconds=self.settings.db_replica_max_lag_seconds,
+            timeout=self.settings.db_replica_health_check_timeout,
+        )
+        for replica in self.replica_router.replicas:
+            instrument_engine(replica.engine, self.metrics, replica.name)
+        self._health_checks = None
+        if self.replica_router.replicas:
+            # Check once up front so replicas take reads from the first request
+            await self.replica_router.check()
+            self._health_checks = asyncio.create_task(
+                self.replica_router.run_health_checks(self.settings.db_replica_health_check_seconds)
+            )
+        self.password_hasher = PasswordHasher(
+            workers=self.settings.password_pool_workers,
+            queue_size=self.settings.password_pool_queue_size,
+            duration=self.metrics.password_duration,
+        )
+        self.balance_listener = None
+        self._balance_listener_task = None
+        if self.settings.balance_cache_size:
+            self.balance_listener = BalanceListener(
+                self._async_engine.url.set(drivername="postgresql").render_as_string(hide_password=False),
+                self.balance_cache,
+                reconnect_seconds=self.settings.balance_listener_reconnect_seconds,
+            )
+            self._balance_listener_task = asyncio.create_task(self.balance_listener.run())
+        self.group_committer = None
+        if self.settings.group_commit_enabled:
+            self.group_committer = GroupCommitter(
+                self._session_maker,
+                window=self.settings.group_commit_window_ms / 1000,
+                max_items=self.settings.group_commit_max_items,
+                metrics=self.metrics,
+            )
+
+        self.outbox_dispatcher = None
+        self._outbox_task = None
+        # With the outbox on but no sinks, the dispatcher only watches the backlog grow
+        if self.settings.outbox_sinks or await self._outbox_enabled():
+            self.outbox_dispatcher = OutboxDispatcher(
+                self._session_maker,
+                [load_sink(spec, self.settings) for spec in self.settings.outbox_sinks],
+                batch_size=self.settings.outbox_batch_size,
+                poll_seconds=self.settings.outbox_poll_seconds,
+                metrics=self.metrics,
+            )
+            self._outbox_task = asyncio.create_task(self.outbox_dispatcher.run())
+
+    async def _outbox_enabled(self) -> bool:
+        async with self._session_maker() as session:
+            return await is_outbox_enabled(session)
 
     async def tear_down(self) -> None:
+        if self.group_committer is not None:
+            await self.group_committer.close()
+        if self._outbox_task is not None:
+            self._outbox_task.cancel()
+            # A batch being delivered is rolled back, and delivered again later
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._outbox_task
+            await self.outbox_dispatcher.close()
+        if self._health_checks is not None:
+            self._health_checks.cancel()
+        if self._balance_listener_task is not None:
+            self._balance_listener_task.cancel()
+            # Lets it close its connection
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._balance_listener_task
+        await self.replica_router.dispose()
         await self._async_engine.dispose()
+        self.password_hasher.shutdown()
 
     @contextlib.asynccontextmanager
     async def lifespan_manager(self, _: fastapi.FastAPI) -> typing.AsyncIterator[dict[str, typing.Any]]:
@@ -0,0 +1,214 @@
+"""Columnar files of archived ledger partitions.
+
+An archived partition is exported to one Parquet file, zstd-compressed and sorted
+by (user_id, created_at, id), in row groups of a fixed number of rows. Each row
+group's footer statistics give the range of user ids in it, so a user's rows are
+read from the one or two row groups that can hold them, through a memory map of
+the file: their pages come straight from the OS page cache instead of being read
+into buffers first, and only they are decompressed.
+
+Needs pyarrow, from the service's optional archive extra (poetry install -E archive):
+without it, anything touching an archive file raises ArchiveUnavailableError.
+"""
+import asyncio
+import functools
+import os
+import typing
+from datetime import datetime
+
+from app.custom_types import TransactionType
+from app.exceptions import ArchiveUnavailableError
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pq = None
+
+
+# Columns of a file, in order; the same as the archived partition's, with amounts in minor units
+COLUMNS: typing.Final = ("id", "transaction_id", "user_id", "type", "amount_minor", "created_at", "correlation_id")
+COMPRESSION: typing.Final = "zstd"
+# Files whose footers are kept parsed, so a read only maps the file and decodes its row groups
+CACHED_FOOTERS: typing.Final = 256
+
+
+class ArchivedTransaction(typing.NamedTuple):
+    """A ledger row read from an archive file, with the wallet's currency, like a history_query row."""
+    id: int
+    transaction_id: str
+    user_id: int
+    type: TransactionType
+    amount: int
+    created_at: datetime
+    correlation_id: str | None
+    currency: str
+
+
+class ArchiveSummary(typing.NamedTuple):
+    rows: int
+    min_created_at: datetime | None
+    max_created_at: datetime | None
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise ArchiveUnavailableError("Reading or writing ledger archive files needs pyarrow, from the archive extra")
+
+
+def _schema() -> typing.Any:
+    return pa.schema([
+        ("id", pa.int64()),
+        ("transaction_id", pa.string()),
+        ("user_id", pa.int32()),
+        ("type", pa.string()),
+        ("amount_minor", pa.int64()),
+        ("created_at", pa.timestamp("us", tz="UTC")),
+        ("correlation_id", pa.string()),
+    ])
+
+
+class ArchiveWriter:
+    """Writes rows, already in (user_id, created_at, id) order, to a new archive file.
+
+    Each write() call becomes one row group, so the caller's batch size is the row
+    group size. The file is written under a temporary name and only renamed to path
+    by close(), once synced to disk, so a path that exists is a complete file.
+    """
+
+    def __init__(self, path: str) -> None:
+        _require_pyarrow()
+        self.path = path
+        self._partial = f"{path}.partial"
+        self._writer = pq.ParquetWriter(self._partial, _schema(), compression=COMPRESSION)
+        self._rows = 0
+        self._min: datetime | None = None
+        self._max: datetime | None = None
+
+    def write(self, rows: typing.Sequence[typing.Sequence[typing.Any]]) -> None:
+        if not rows:
+            return
+        columns = zip(*rows, strict=True)
+        table = pa.Table.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, _schema(), strict=True)],
+            schema=_schema(),
+        )
+        self._writer.write_table(table, row_group_size=len(rows))
+        created_at = pc.min_max(table["created_at"]).as_py()
+        self._min = created_at["min"] if self._min is None else min(self._min, created_at["min"])
+        self._max = created_at["max"] if self._max is None else max(self._max, created_at["max"])
+        self._rows += len(rows)
+
+    def close(self) -> ArchiveSummary:
+        self._writer.close()
+        with open(self._partial, "rb") as file:
+            os.fsync(file.fileno())
+        os.replace(self._partial, self.path)
+        return ArchiveSummary(self._rows, self._min, self._max)
+
+    def abort(self) -> None:
+        self._writer.close()
+        os.remove(self._partial)
+
+
+def count_rows(path: str) -> int:
+    """Rows in an archive file, from its footer."""
+    _require_pyarrow()
+    return pq.read_metadata(path).num_rows
+
+
+@functools.lru_cache(maxsize=CACHED_FOOTERS)
+def _footer(path: str) -> tuple[typing.Any, list[tuple[int, int]]]:
+    """The file's parsed footer, and the (min, max) user_id of each of its row groups."""
+    metadata = pq.read_metadata(path, memory_map=True)
+    user_id = COLUMNS.index("user_id")
+    ranges = []
+    for index in range(metadata.num_row_groups):
+        statistics = metadata.row_group(index).column(user_id).statistics
+        ranges.append((statistics.min, statistics.max))
+    return metadata, ranges
+
+
+def _read_user(path: str, user_id: int) -> typing.Any:
+    """The user's rows of one file, in (created_at, id) order, as an Arrow table."""
+    metadata, ranges = _footer(path)
+    groups = [index for index, (low, high) in enumerate(ranges) if low <= user_id <= high]
+    if not groups:
+        return _schema().empty_table()
+    table = pq.ParquetFile(path, metadata=metadata, memory_map=True).read_row_groups(groups, use_threads=False)
+    return table.filter(pc.equal(table["user_id"], user_id))
+
+
+def _where(table: typing.Any, compare: typing.Callable[..., typing.Any], moment: datetime | None) -> typing.Any:
+    """table's rows whose created_at compares true to moment; all of them if moment is None."""
+    if moment is None:
+        return table
+    return table.filter(compare(table["created_at"], pa.scalar(moment, table.schema.field("created_at").type)))
+
+
+def read_history(
+    path: str,
+    user_id: int,
+    currency: str,
+    type_: TransactionType | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    after: tuple[datetime, int] | None = None,
+) -> list[ArchivedTransaction]:
+    """The user's rows of one file in [since, until), and after the (created_at, id) position, in order.
+
+    Filters like history_query does.
+    """
+    _require_pyarrow()
+    table = _read_user(path, user_id)
+    table = _where(_where(table, pc.greater_equal, since), pc.less, until)
+    table = _where(table, pc.greater_equal, after[0] if after is not None else None)
+    if type_ is not None:
+        table = table.filter(pc.equal(table["type"], type_.value))
+    rows = (
+        ArchivedTransaction(
+            id=row["id"],
+            transaction_id=row["transaction_id"],
+            user_id=row["user_id"],
+            type=TransactionType(row["type"]),
+            amount=row["amount_minor"],
+            created_at=row["created_at"],
+            correlation_id=row["correlation_id"],
+            currency=currency,
+        )
+        for row in table.to_pylist()
+    )
+    return [row for row in rows if after is None or (row.created_at, row.id) > after]
+
+
+def read_delta(path: str, user_id: int, after: datetime | None, until: datetime) -> int | None:
+    """The signed sum of the user's rows of one file in (after, until], in minor units; None without any."""
+    _require_pyarrow()
+    table = _where(_where(_read_user(path, user_id), pc.greater, after), pc.less_equal, until)
+    signed = pc.if_else(
+        pc.equal(table["type"], TransactionType.WITHDRAW.value),
+        pc.negate(table["amount_minor"]),
+        table["amount_minor"],
+    )
+    return pc.sum(signed).as_py()
+
+
+async def iter_history(
+    paths: list[str], user_id: int, currency: str, **filters: typing.Any,
+) -> typing.AsyncIterator[ArchivedTransaction]:
+    """read_history over files covering consecutive periods, in order; one file in memory at a time.
+
+    Files are read on a worker thread, so the event loop isn't held up by page faults
+    or decompression.
+    """
+    for path in paths:
+        for row in await asyncio.to_thread(read_history, path, user_id, currency, **filters):
+            yield row
+
+
+async def get_delta(paths: list[str], user_id: int, after: datetime | None, until: datetime) -> int | None:
+    """read_delta summed over the files, each read on a worker thread; None if none has any rows."""
+    deltas = await asyncio.gather(*(asyncio.to_thread(read_delta, path, user_id, after, until) for path in paths))
+    found = [delta for delta in deltas if delta is not None]
+    return sum(found) if found else None
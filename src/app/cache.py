@@ -0,0 +1,133 @@
+import collections
+import time
+import typing
+
+
+K = typing.TypeVar("K")
+V = typing.TypeVar("V")
+
+
+class TTLCache(typing.Generic[K, V]):
+    """In-process LRU mapping with a size bound and per-entry expiry.
+
+    Not thread-safe; meant to be used from a single event loop.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: collections.OrderedDict[K, tuple[float, V]] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> V | None:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def peek(self, key: K) -> V | None:
+        """Like get, but leaves recency and the hit and miss counts alone."""
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None and entry[0] > time.monotonic() else None
+
+    def set(self, key: K, value: V, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: K) -> None:
+        self._entries.pop(key, None)
+
+    def invalidate(self, predicate: typing.Callable[[V], bool]) -> int:
+        stale = [key for key, (_, value) in self._entries.items() if predicate(value)]
+        for key in stale:
+            del self._entries[key]
+        return len(stale)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+class VersionedCache(typing.Generic[K, V]):
+    """In-process LRU mapping of versioned values, kept fresh by change notifications.
+
+    A value is only stored, and a notification only applies, if its version is at
+    least the one already known for the key, so a late read or a late notification
+    can never replace newer state. A notified key keeps its version without a value
+    until a read at that version or later fills it in. clear() starts a new
+    generation, and values read during an older one are not stored.
+
+    Not thread-safe; meant to be used from a single event loop.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.notifications = 0
+        self.generation = 0
+        self._entries: collections.OrderedDict[K, tuple[int, V | None]] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> V | None:
+        entry = self._entries.get(key)
+        if entry is None or entry[1] is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: K, value: V, version: int, generation: int) -> None:
+        entry = self._entries.get(key)
+        if generation != self.generation or (entry is not None and entry[0] > version):
+            return
+        self._put(key, (version, value))
+
+    def notify(self, key: K, version: int) -> None:
+        """Drop the value of key unless it is already at version or later."""
+        self.notifications += 1
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] >= version:
+            return
+        self._put(key, (version, None))
+
+    def _put(self, key: K, entry: tuple[int, V | None]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.generation += 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "notifications": self.notifications,
+        }
@@ -0,0 +1,64 @@
+"""Export archived transaction partitions to columnar files and drop them from Postgres.
+
+Run after app.commands.partitions has archived partitions (e.g. from the same cron job):
+
+    python -m app.commands.archive
+
+Each partition in the archive schema becomes one Parquet file in archive_dir, which
+history and point-in-time balance reads then combine with the live ledger. Needs
+pyarrow installed.
+"""
+import argparse
+import asyncio
+import logging
+import os
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.custom_types import FAST_API_SCHEME
+from app.db.resource import build_engine
+from app.repositories.archive import export_archive, get_unexported
+from app.settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+
+async def run(settings: Settings, directory: str, row_group_size: int) -> None:
+    engine = build_engine(settings)
+    session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+    os.makedirs(directory, exist_ok=True)
+
+    try:
+        async with session_maker() as session:
+            async with session.begin():
+                archives = await get_unexported(session)
+
+        exported = []
+        # One DB transaction per partition, so each is dropped as soon as its file is complete
+        for archive in archives:
+            async with session_maker() as session:
+                async with session.begin():
+                    summary = await export_archive(session, archive, directory, row_group_size)
+            if summary is None:
+                logger.warning("%s is not in the archive schema, skipped", archive.partition_name)
+            else:
+                exported.append(archive.partition_name)
+        logger.info("Exported partitions: %s", ", ".join(exported) or "none")
+    finally:
+        await engine.dispose()
+
+
+def main() -> None:
+    settings = Settings(scheme=FAST_API_SCHEME)
+    parser = argparse.ArgumentParser(description="Export archived transaction partitions to files")
+    parser.add_argument("--dir", default=settings.archive_dir, help="directory to write the files to")
+    parser.add_argument("--row-group-size", type=int, default=settings.archive_row_group_size)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(settings, args.dir, args.row_group_size))
+
+
+if __name__ == "__main__":
+    main()
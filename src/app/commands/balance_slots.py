@@ -0,0 +1,58 @@
+"""Shard hot wallets over balance slots and keep their slots even.
+
+Shard a wallet over 16 slots, re-shard it, or (--slots 0) fold it back into users.balance:
+
+    python -m app.commands.balance_slots --user-id 42 --slots 16
+
+Run periodically (e.g. from cron) to even out the slots of every sharded wallet:
+
+    python -m app.commands.balance_slots
+"""
+import argparse
+import asyncio
+import logging
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.custom_types import FAST_API_SCHEME
+from app.db.resource import build_engine
+from app.repositories.balance_slots import rebalance_slots, set_balance_slots
+from app.settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+
+async def run(settings: Settings, user_id: int | None, slots: int | None) -> None:
+    engine = build_engine(settings)
+    session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+    try:
+        async with session_maker() as session:
+            async with session.begin():
+                if user_id is not None:
+                    await set_balance_slots(session, user_id, slots)
+                    logger.info("User %s now has %s balance slots", user_id, slots)
+                else:
+                    rebalanced = await rebalance_slots(session)
+                    logger.info("Rebalanced the slots of %s wallets", rebalanced)
+    finally:
+        await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Shard wallets over balance slots and rebalance them")
+    parser.add_argument("--user-id", type=int, help="wallet to shard; rebalance every sharded wallet if omitted")
+    parser.add_argument("--slots", type=int, help="number of slots for --user-id, 0 to unshard")
+    args = parser.parse_args()
+    if (args.user_id is None) != (args.slots is None):
+        parser.error("--user-id and --slots go together")
+    if args.slots is not None and args.slots < 0:
+        parser.error("--slots can't be negative")
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(Settings(scheme=FAST_API_SCHEME), args.user_id, args.slots))
+
+
+if __name__ == "__main__":
+    main()
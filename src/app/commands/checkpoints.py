@@ -0,0 +1,61 @@
+"""Create ledger balance checkpoints.
+
+Run periodically (e.g. from cron) to snapshot the balances that changed since the last run:
+
+    python -m app.commands.checkpoints
+
+Backfill checkpoints for the existing history, one per interval with activity:
+
+    python -m app.commands.checkpoints --backfill --interval-days 7
+"""
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.custom_types import FAST_API_SCHEME
+from app.db.resource import build_engine
+from app.repositories.checkpoints import backfill_checkpoints, create_checkpoints
+from app.repositories.utils import get_settled_watermark
+from app.settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+
+async def run(settings: Settings, backfill: bool, interval_days: int) -> None:
+    engine = build_engine(settings)
+    session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+    until = datetime.now(timezone.utc) - timedelta(seconds=settings.checkpoint_lag_seconds)
+
+    try:
+        async with session_maker() as session:
+            async with session.begin():
+                # Wait for the writers in flight, e.g. a bulk ingest, whose rows are dated from when
+                # it began however long it runs, so every row dated up to until is seen; any
+                # transaction writing from here on began after until, or had been idle for the lag
+                await get_settled_watermark(session)
+                if backfill:
+                    created = await backfill_checkpoints(session, timedelta(days=interval_days), until)
+                else:
+                    created = await create_checkpoints(session, until)
+        logger.info("Wrote %s balance checkpoints up to %s", created, until.isoformat())
+    finally:
+        await engine.dispose()
+
+
+def main() -> None:
+    settings = Settings(scheme=FAST_API_SCHEME)
+    parser = argparse.ArgumentParser(description="Create ledger balance checkpoints")
+    parser.add_argument("--backfill", action="store_true", help="rebuild checkpoints for the whole history")
+    parser.add_argument("--interval-days", type=int, default=settings.checkpoint_backfill_interval_days)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(settings, args.backfill, args.interval_days))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Bulk-load an NDJSON settlement file into the ledger.
+
+Each line is a transaction object: {"uid", "user_id", "type", "amount", "created_at"}.
+
+    python -m app.commands.ingest settlement.ndjson
+    cat settlement.ndjson | python -m app.commands.ingest -
+
+Prints the ingestion report (accepted count and per-line rejections) as JSON.
+"""
+import argparse
+import asyncio
+import sys
+import typing
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.custom_types import FAST_API_SCHEME
+from app.db.resource import build_engine
+from app.repositories.ingest import ingest_ndjson, iter_lines
+from app.settings import Settings
+
+
+CHUNK_SIZE: typing.Final = 1 << 20
+
+
+async def read_chunks(stream: typing.BinaryIO) -> typing.AsyncIterator[bytes]:
+    while chunk := stream.read(CHUNK_SIZE):
+        yield chunk
+
+
+async def run(settings: Settings, stream: typing.BinaryIO, batch_size: int) -> None:
+    engine = build_engine(settings)
+    session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+    try:
+        report = await ingest_ndjson(session_maker, iter_lines(read_chunks(stream)), batch_size)
+    finally:
+        await engine.dispose()
+
+    sys.stdout.write(report.model_dump_json() + "\n")
+
+
+def main() -> None:
+    settings = Settings(scheme=FAST_API_SCHEME)
+    parser = argparse.ArgumentParser(description="Bulk-load NDJSON transactions")
+    parser.add_argument("path", help="NDJSON file, or - for stdin")
+    parser.add_argument("--batch-size", type=int, default=settings.bulk_ingest_batch_size)
+    args = parser.parse_args()
+
+    if args.path == "-":
+        asyncio.run(run(settings, sys.stdin.buffer, args.batch_size))
+        return
+    with open(args.path, "rb") as stream:
+        asyncio.run(run(settings, stream, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
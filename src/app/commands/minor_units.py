@@ -0,0 +1,86 @@
+"""Backfill the minor unit money columns between the expand and contract migrations.
+
+Fills every *_minor column still NULL from its NUMERIC column, one short DB
+transaction per batch of ids, so it can run against a live database:
+
+    alembic upgrade 6e3a9f1c4b27
+    python -m app.commands.minor_units --batch-size 50000
+    alembic upgrade head
+
+Safe to interrupt and rerun; rows already converted are skipped.
+"""
+import argparse
+import asyncio
+import logging
+import typing
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.custom_types import FAST_API_SCHEME
+from app.db.resource import build_engine
+from app.settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+# Table, the column batches are ranges of, and the conversion of rows in [start, end)
+BACKFILLS: typing.Final = [
+    (
+        "users", "id",
+        "UPDATE users SET balance_minor = round(balance * power(10::numeric, currency_scale(currency))) "
+        "WHERE id >= :start AND id < :end AND balance_minor IS NULL AND balance IS NOT NULL",
+    ),
+    *(
+        (
+            table, key,
+            f"UPDATE {table} SET {minor} = "
+            f"round({table}.{numeric} * power(10::numeric, currency_scale(users.currency))) "
+            f"FROM users WHERE users.id = {table}.user_id AND {table}.{key} >= :start AND {table}.{key} < :end "
+            f"AND {table}.{minor} IS NULL AND {table}.{numeric} IS NOT NULL",
+        )
+        for table, key, numeric, minor in (
+            ("transactions", "id", "amount", "amount_minor"),
+            ("balance_checkpoints", "id", "balance", "balance_minor"),
+            ("balance_slots", "user_id", "balance", "balance_minor"),
+        )
+    ),
+]
+
+
+async def backfill(engine: AsyncEngine, table: str, key: str, statement: str, batch_size: int) -> int:
+    async with engine.connect() as connection:
+        bounds = (await connection.execute(sa.text(f"SELECT min({key}), max({key}) FROM {table}"))).one()
+    if bounds[0] is None:
+        return 0
+
+    converted = 0
+    for start in range(bounds[0], bounds[1] + 1, batch_size):
+        async with engine.begin() as connection:
+            result = await connection.execute(sa.text(statement), {"start": start, "end": start + batch_size})
+        converted += result.rowcount
+        logger.info("%s: converted %s rows up to %s %s", table, converted, key, start + batch_size - 1)
+    return converted
+
+
+async def run(settings: Settings, batch_size: int) -> None:
+    engine = build_engine(settings)
+    try:
+        for table, key, statement in BACKFILLS:
+            converted = await backfill(engine, table, key, statement, batch_size)
+            logger.info("%s: done, %s rows converted", table, converted)
+    finally:
+        await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Backfill the minor unit money columns")
+    parser.add_argument("--batch-size", type=int, default=10_000, help="ids per DB transaction")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(Settings(scheme=FAST_API_SCHEME), args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Turn the outbox of ledger events on or off.
+
+Ledger writes only add outbox events while it's on, and nothing delivers them
+until outbox_sinks are configured, so enable it once they are:
+
+    python -m app.commands.outbox enable
+
+Turn it off, deleting the events not delivered yet with --purge:
+
+    python -m app.commands.outbox disable --purge
+"""
+import argparse
+import asyncio
+import logging
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.custom_types import FAST_API_SCHEME
+from app.db.resource import build_engine
+from app.repositories.outbox import get_backlog, is_outbox_enabled, purge_events, set_outbox_enabled
+from app.settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+
+async def run(settings: Settings, action: str, purge: bool) -> None:
+    engine = build_engine(settings)
+    session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+    try:
+        async with session_maker() as session:
+            async with session.begin():
+                if action != "status":
+                    await set_outbox_enabled(session, action == "enable")
+                if purge:
+                    logger.info("Deleted %s undelivered events", await purge_events(session))
+                enabled = await is_outbox_enabled(session)
+                backlog, oldest = await get_backlog(session)
+        logger.info(
+            "Outbox is %s, about %s events to deliver%s",
+            "on" if enabled else "off", backlog, f" since {oldest.isoformat()}" if oldest else "",
+        )
+        if enabled and not settings.outbox_sinks:
+            logger.warning("No outbox_sinks are configured, so nothing will deliver the events")
+    finally:
+        await engine.dispose()
+
+
+def main() -> None:
+    settings = Settings(scheme=FAST_API_SCHEME)
+    parser = argparse.ArgumentParser(description="Turn the outbox of ledger events on or off")
+    parser.add_argument("action", choices=("enable", "disable", "status"))
+    parser.add_argument("--purge", action="store_true", help="delete the events not delivered yet")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(settings, args.action, args.purge))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Maintain the monthly partitions of the transactions table.
+
+Run daily (e.g. from cron) to create upcoming partitions and archive cold ones:
+
+    python -m app.commands.partitions
+
+Archived partitions are moved to the archive schema, from where app.commands.archive
+exports them to files and drops them.
+"""
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.custom_types import FAST_API_SCHEME
+from app.db.resource import build_engine
+from app.repositories.partitions import archive_partitions, ensure_partitions
+from app.settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+
+async def run(settings: Settings, months_ahead: int, hot_months: int | None) -> None:
+    engine = build_engine(settings)
+    session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+    now = datetime.now(timezone.utc)
+
+    try:
+        async with session_maker() as session:
+            async with session.begin():
+                created = await ensure_partitions(session, now, months_ahead)
+        logger.info("Created partitions: %s", ", ".join(created) or "none")
+
+        if hot_months is not None:
+            async with session_maker() as session:
+                archived = await archive_partitions(engine, session, now, hot_months)
+            logger.info("Archived partitions: %s", ", ".join(archived) or "none")
+    finally:
+        await engine.dispose()
+
+
+def main() -> None:
+    settings = Settings(scheme=FAST_API_SCHEME)
+    parser = argparse.ArgumentParser(description="Create upcoming and archive cold transaction partitions")
+    parser.add_argument("--months-ahead", type=int, default=settings.transaction_partitions_ahead)
+    parser.add_argument("--hot-months", type=int, default=settings.transaction_hot_months)
+    parser.add_argument("--no-archive", action="store_true", help="only create upcoming partitions")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(settings, args.months_ahead, None if args.no_archive else args.hot_months))
+
+
+if __name__ == "__main__":
+    main()
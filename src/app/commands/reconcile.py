@@ -0,0 +1,132 @@
+"""Check every wallet's balance against the sum of its ledger.
+
+Splits the user id space into ranges and checks them in parallel worker
+processes, each with its own event loop and DB connection:
+
+    python -m app.commands.reconcile --workers 8
+
+Only recheck the wallets with transactions since the last finished run:
+
+    python -m app.commands.reconcile --incremental
+
+Mismatches are logged and kept in reconciliation_mismatches under the run's id.
+Exits with status 1 if there were any.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import sys
+import typing
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.future import select
+
+from app.custom_types import FAST_API_SCHEME
+from app.db.resource import build_engine
+from app.models import ReconciliationMismatch, User
+from app.repositories.reconciliation import finish_run, reconcile_range, start_run
+from app.settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+# Mismatches logged individually at the end of a run; the rest are only in the table
+LOGGED_MISMATCHES: typing.Final = 100
+
+
+class _Worker:
+    """Per-process state: the event loop ranges run on, and sessions on the process' own connection.
+
+    Ranges of a worker run one after another, so its pool only ever opens one connection.
+    """
+    loop: asyncio.AbstractEventLoop
+    session_maker: async_sessionmaker[AsyncSession]
+
+
+def _init_worker(settings: Settings) -> None:
+    logging.basicConfig(level=logging.INFO)
+    _Worker.loop = asyncio.new_event_loop()
+    _Worker.session_maker = async_sessionmaker(bind=build_engine(settings), expire_on_commit=False)
+
+
+def _reconcile_range(run_id: int, start: int, end: int, since: int | None) -> tuple[int, int]:
+    async def reconcile() -> tuple[int, int]:
+        async with _Worker.session_maker() as session:
+            async with session.begin():
+                return await reconcile_range(session, run_id, start, end, since)
+
+    return _Worker.loop.run_until_complete(reconcile())
+
+
+async def run(settings: Settings, workers: int, range_size: int, incremental: bool) -> int:
+    """Returns the number of mismatched wallets."""
+    engine = build_engine(settings)
+    session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+    try:
+        async with session_maker() as session:
+            async with session.begin():
+                reconciliation = await start_run(session, incremental)
+                first, last = (await session.execute(select(func.min(User.id), func.max(User.id)))).one()
+        run_id, since = reconciliation.id, reconciliation.since_watermark
+        logger.info("Run %s: up to transaction %s, since %s", run_id, reconciliation.watermark, since)
+
+        checked = mismatched = 0
+        if first is not None:
+            loop = asyncio.get_running_loop()
+            # Spawned rather than forked, so no worker inherits this process' loop or connections
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(settings,),
+            ) as pool:
+                ranges = [
+                    loop.run_in_executor(pool, _reconcile_range, run_id, start, start + range_size, since)
+                    for start in range(first, last + 1, range_size)
+                ]
+                for done in asyncio.as_completed(ranges):
+                    range_checked, range_mismatched = await done
+                    checked += range_checked
+                    mismatched += range_mismatched
+                    logger.info("Run %s: %s wallets checked, %s mismatched", run_id, checked, mismatched)
+
+        async with session_maker() as session:
+            async with session.begin():
+                await finish_run(session, run_id, checked, mismatched)
+                result = await session.execute(
+                    select(ReconciliationMismatch)
+                    .where(ReconciliationMismatch.run_id == run_id)
+                    .order_by(ReconciliationMismatch.user_id)
+                    .limit(LOGGED_MISMATCHES)
+                )
+                for mismatch in result.scalars():
+                    logger.warning(
+                        "User %s: balance %s, ledger %s (minor units)",
+                        mismatch.user_id, mismatch.balance, mismatch.ledger,
+                    )
+        logger.info("Run %s finished: %s wallets checked, %s mismatched", run_id, checked, mismatched)
+        return mismatched
+    finally:
+        await engine.dispose()
+
+
+def main() -> None:
+    settings = Settings(scheme=FAST_API_SCHEME)
+    parser = argparse.ArgumentParser(description="Check wallet balances against their ledger")
+    parser.add_argument("--workers", type=int, default=settings.reconcile_workers, help="worker processes")
+    parser.add_argument("--range-size", type=int, default=settings.reconcile_range_size, help="user ids per range")
+    parser.add_argument(
+        "--incremental", action="store_true", help="only wallets with transactions since the last finished run",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    mismatched = asyncio.run(run(settings, args.workers, args.range_size, args.incremental))
+    sys.exit(1 if mismatched else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Maintain the daily per-user ledger rollups statements are answered from.
+
+Run periodically (e.g. from cron, at least daily) to roll up the days that ended
+and the days of transactions written since the last run:
+
+    python -m app.commands.rollups
+
+Rebuild every day from the live ledger:
+
+    python -m app.commands.rollups --full
+"""
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.custom_types import FAST_API_SCHEME
+from app.db.resource import build_engine
+from app.repositories.rollups import ONE_DAY, finish_run, roll_up, start_run
+from app.settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+
+async def run(settings: Settings, full: bool) -> None:
+    engine = build_engine(settings)
+    session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+    # The last UTC day that ended at least the lag ago, so its in-flight transactions are in
+    through = (datetime.now(timezone.utc) - timedelta(seconds=settings.rollup_lag_seconds)).date() - ONE_DAY
+
+    try:
+        async with session_maker() as session:
+            async with session.begin():
+                rollup_run = await start_run(session, through, not full)
+                days = await roll_up(session, rollup_run)
+                await finish_run(session, rollup_run.id, days)
+        logger.info(
+            "Run %s: rolled up %s days through %s, from transaction %s",
+            rollup_run.id, days, through.isoformat(), rollup_run.since_watermark,
+        )
+    finally:
+        await engine.dispose()
+
+
+def main() -> None:
+    settings = Settings(scheme=FAST_API_SCHEME)
+    parser = argparse.ArgumentParser(description="Maintain the daily ledger rollups")
+    parser.add_argument("--full", action="store_true", help="roll up every day of the live ledger again")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(settings, args.full))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,5 +6,14 @@ class TransactionType(enum.Enum):
     DEPOSIT = 'DEPOSIT'
 
 
+class RejectionReason(enum.Enum):
+    INVALID = 'INVALID'
+    UNKNOWN_USER = 'UNKNOWN_USER'
+    DUPLICATE = 'DUPLICATE'
+    INSUFFICIENT_FUNDS = 'INSUFFICIENT_FUNDS'
+    # Dated in the future or in an archived partition
+    OUT_OF_RANGE = 'OUT_OF_RANGE'
+
+
 ALEMBIC_SCHEME = "postgresql"
 FAST_API_SCHEME = "postgresql+asyncpg"
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+import typing
+
+import asyncpg
+
+from app.cache import VersionedCache
+from app.money import Balance
+
+
+logger = logging.getLogger(__name__)
+
+# Sent by the users_balance_changed trigger as "<user id>:<balance_version>"
+BALANCE_CHANNEL: typing.Final = "balance_changed"
+
+
+class BalanceListener:
+    """Keeps a worker's balance cache in step with balance_changed notifications.
+
+    Holds one dedicated connection to the primary, outside the pool. The cache is
+    only usable while that connection is up: notifications sent while it is down
+    are lost, so the cache is cleared on every (re)connect.
+    """
+
+    def __init__(self, dsn: str, cache: VersionedCache[int, Balance], reconnect_seconds: float) -> None:
+        self.dsn = dsn
+        self.cache = cache
+        self.reconnect_seconds = reconnect_seconds
+        self.connected = False
+        self.reconnects = 0
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self._listen()
+            except Exception as e:
+                logger.warning("Balance notification listener failed: %r", e)
+            self.connected = False
+            self.cache.clear()
+            await asyncio.sleep(self.reconnect_seconds)
+            self.reconnects += 1
+
+    async def _listen(self) -> None:
+        closed = asyncio.Event()
+        connection = await asyncpg.connect(self.dsn)
+        try:
+            connection.add_termination_listener(lambda _: closed.set())
+            await connection.add_listener(BALANCE_CHANNEL, self._on_notification)
+            self.cache.clear()
+            self.connected = True
+            await closed.wait()
+        finally:
+            self.connected = False
+            await connection.close()
+
+    def _on_notification(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        user_id, version = payload.split(":")
+        self.cache.notify(int(user_id), int(version))
+
+    def stats(self) -> dict[str, typing.Any]:
+        return {"connected": self.connected, "reconnects": self.reconnects, **self.cache.stats()}
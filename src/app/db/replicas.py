@@ -0,0 +1,128 @@
+import asyncio
+import itertools
+import logging
+import typing
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds the replica is behind the primary, 0 when it has replayed everything it
+# received, and the WAL position it has replayed up to. Run against a primary, the lag
+# is NULL (read as 0) and the position is its own
+REPLICA_STATUS: typing.Final = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END, "
+    "CAST(CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END AS text)"
+)
+CURRENT_LSN: typing.Final = text("SELECT CAST(pg_current_wal_lsn() AS text)")
+
+
+def parse_lsn(lsn: str) -> int:
+    """A WAL position as Postgres prints it, e.g. 16/B374D848, as a number to compare."""
+    high, separator, low = lsn.partition("/")
+    if not separator:
+        raise ValueError(f"Not a WAL position: {lsn!r}")
+    return int(high, 16) << 32 | int(low, 16)
+
+
+def format_lsn(lsn: int) -> str:
+    return f"{lsn >> 32:X}/{lsn & 0xFFFFFFFF:X}"
+
+
+async def get_current_lsn(engine: AsyncEngine) -> int:
+    """The primary's WAL position; read after a commit, it's at or past the commit's."""
+    async with engine.connect() as connection:
+        return parse_lsn(await connection.scalar(CURRENT_LSN))
+
+
+class Replica:
+    __slots__ = ("name", "engine", "session_maker", "healthy", "lag_seconds", "replay_lsn", "selected")
+
+    def __init__(self, name: str, engine: AsyncEngine) -> None:
+        self.name = name
+        self.engine = engine
+        # Replicas refuse writes anyway; READ ONLY keeps the primary fallback honest too
+        self.session_maker = async_sessionmaker(
+            bind=engine.execution_options(postgresql_readonly=True),
+            expire_on_commit=False,
+        )
+        self.healthy = False
+        self.lag_seconds: float | None = None
+        # As of the last health check, so it's never ahead of the replica
+        self.replay_lsn: int | None = None
+        self.selected = 0
+
+
+class ReplicaRouter:
+    """Round-robin over the replicas that passed their last health check.
+
+    A replica is healthy when it answers within timeout seconds and is at most
+    max_lag_seconds behind. pick() can also ask for one that has replayed the WAL
+    up to a position, e.g. a client's last write. With no such replica, it returns
+    None and reads go to the primary.
+    """
+
+    def __init__(self, replicas: list[Replica], max_lag_seconds: float, timeout: float) -> None:
+        self.replicas = replicas
+        self.max_lag_seconds = max_lag_seconds
+        self.timeout = timeout
+        self.primary_fallbacks = 0
+        self._cycle = itertools.cycle(replicas)
+
+    def pick(self, min_lsn: int = 0) -> Replica | None:
+        for _ in range(len(self.replicas)):
+            replica = next(self._cycle)
+            if replica.healthy and replica.replay_lsn is not None and replica.replay_lsn >= min_lsn:
+                replica.selected += 1
+                return replica
+
+        self.primary_fallbacks += 1
+        return None
+
+    async def check(self) -> None:
+        await asyncio.gather(*(self._check(replica) for replica in self.replicas))
+
+    async def _check(self, replica: Replica) -> None:
+        try:
+            async with asyncio.timeout(self.timeout):
+                async with replica.engine.connect() as connection:
+                    lag, replay_lsn = (await connection.execute(REPLICA_STATUS)).one()
+        except Exception as e:
+            if replica.healthy:
+                logger.warning("Replica %s failed its health check: %r", replica.name, e)
+            replica.healthy = False
+            replica.lag_seconds = None
+            return
+
+        replica.lag_seconds = float(lag or 0)
+        replica.replay_lsn = parse_lsn(replay_lsn) if replay_lsn is not None else None
+        healthy = replica.lag_seconds <= self.max_lag_seconds
+        if healthy != replica.healthy:
+            log = logger.info if healthy else logger.warning
+            log("Replica %s is now %s (lag %.1fs)", replica.name, "up" if healthy else "down", replica.lag_seconds)
+        replica.healthy = healthy
+
+    async def run_health_checks(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.check()
+
+    async def dispose(self) -> None:
+        await asyncio.gather(*(replica.engine.dispose() for replica in self.replicas))
+
+    def stats(self) -> dict[str, typing.Any]:
+        return {
+            "primary_fallbacks": self.primary_fallbacks,
+            "replicas": {
+                replica.name: {
+                    "healthy": replica.healthy,
+                    "lag_seconds": replica.lag_seconds,
+                    "selected": replica.selected,
+                    "pool": replica.engine.pool.stats(),
+                }
+                for replica in self.replicas
+            },
+        }
@@ -1,7 +1,11 @@
+import contextvars
 import logging
+import time
 import typing
 
+from sqlalchemy import event
 from sqlalchemy.ext import asyncio as sa
+from sqlalchemy.pool import AsyncAdaptedQueuePool, PoolProxiedConnection
 
 from app.settings import Settings
 
@@ -9,6 +13,85 @@ from app.settings import Settings
 logger = logging.getLogger(__name__)
 
 
+class RoundTripCounter:
+    __slots__ = ("count",)
+
+    def __init__(self) -> None:
+        self.count = 0
+
+
+# Set per request by RoundTripCounterMiddleware; None outside of a request
+round_trips: contextvars.ContextVar[RoundTripCounter | None] = contextvars.ContextVar("round_trips", default=None)
+
+
+def _count_round_trip(*_: typing.Any) -> None:
+    counter = round_trips.get()
+    if counter is not None:
+        counter.count += 1
+
+
+def count_round_trips(engine: sa.AsyncEngine) -> None:
+    """Count every statement, BEGIN, COMMIT and ROLLBACK against the current request."""
+    for name in ("before_cursor_execute", "begin", "commit", "rollback"):
+        event.listen(engine.sync_engine, name, _count_round_trip)
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that also tracks how many callers wait for a connection and for how long."""
+
+    # Set by app.metrics.instrument_engine
+    wait_histogram: typing.Any = None
+
+    def __init__(self, *args: typing.Any, **kwargs: typing.Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.waiting = 0
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def connect(self) -> PoolProxiedConnection:
+        self.waiting += 1
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            waited = time.perf_counter() - started
+            self.waiting -= 1
+            self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            if self.wait_histogram is not None:
+                self.wait_histogram.observe(waited)
+
+    def stats(self) -> dict[str, typing.Any]:
+        return {
+            "size": self.size(),
+            "checked_out": self.checkedout(),
+            "checked_in": self.checkedin(),
+            "overflow": self.overflow(),
+            "waiting": self.waiting,
+            "checkouts": self.checkouts,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_max": self.wait_seconds_max,
+        }
+
+
+def build_engine(settings: Settings, dsn: str | None = None) -> sa.AsyncEngine:
+    engine = sa.create_async_engine(
+        dsn or settings.db_dsn,
+        echo=settings.debug and settings.db_echo,
+        poolclass=InstrumentedQueuePool,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=settings.db_pool_pre_ping,
+        connect_args={"prepared_statement_cache_size": settings.db_statement_cache_size},
+    )
+    count_round_trips(engine)
+    return engine
+
+
 async def create_session(engine: sa.AsyncEngine) -> typing.AsyncIterator[sa.AsyncSession]:
     async with sa.AsyncSession(engine, expire_on_commit=False, autoflush=False) as session:
         yield session
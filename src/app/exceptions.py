@@ -4,3 +4,15 @@ class PaymentError(Exception):
 
 class UserExistsError(Exception):
     pass
+
+
+class PasswordPoolSaturatedError(Exception):
+    pass
+
+
+class ArchiveUnavailableError(Exception):
+    pass
+
+
+class ArchiveMovedError(Exception):
+    pass
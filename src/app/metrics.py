@@ -0,0 +1,229 @@
+import bisect
+import re
+import time
+import typing
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+LabelValues = tuple[str, ...]
+
+# Seconds; wide enough for a pool timeout at the top and a cached lookup at the bottom
+DEFAULT_BUCKETS: typing.Final = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+BATCH_SIZE_BUCKETS: typing.Final = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+def _format_labels(names: LabelValues, values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    type: typing.ClassVar[str]
+
+    def __init__(self, name: str, documentation: str, labelnames: LabelValues = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def render(self) -> typing.Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args: typing.Any, **kwargs: typing.Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.values: dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> typing.Iterator[str]:
+        yield from super().render()
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class HistogramChild:
+    __slots__ = ("upper_bounds", "counts", "sum")
+
+    def __init__(self, upper_bounds: tuple[float, ...]) -> None:
+        self.upper_bounds = upper_bounds
+        # One count per bucket plus +Inf; made cumulative only when rendered
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: LabelValues = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        self.children: dict[LabelValues, HistogramChild] = {}
+
+    def labels(self, *labels: str) -> HistogramChild:
+        child = self.children.get(labels)
+        if child is None:
+            child = self.children[labels] = HistogramChild(self.buckets)
+        return child
+
+    def observe(self, value: float, *labels: str) -> None:
+        self.labels(*labels).observe(value)
+
+    def render(self) -> typing.Iterator[str]:
+        yield from super().render()
+        for labels, child in self.children.items():
+            cumulative = 0
+            for upper_bound, count in zip((*self.buckets, "+Inf"), child.counts, strict=True):
+                cumulative += count
+                le = f'le="{upper_bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {child.sum}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Metrics:
+    """Process-local metrics, rendered in the Prometheus text format.
+
+    Updates are plain dict and list operations on the event loop thread, so the
+    hot path pays no locking and no formatting; all of that happens on scrape.
+    Each Granian worker keeps its own numbers.
+    """
+
+    def __init__(self) -> None:
+        self.request_duration = Histogram(
+            "http_request_duration_seconds", "Time to the end of the response body.", ("method", "route", "status"),
+        )
+        self.requests_in_flight = Gauge("http_requests_in_flight", "Requests being served.")
+        self.query_duration = Histogram(
+            "db_query_duration_seconds", "Statement execution time by normalized query.", ("db", "query"),
+        )
+        self.pool_wait = Histogram("db_pool_wait_seconds", "Time spent waiting for a pool connection.", ("db",))
+        self.password_duration = Histogram(
+            "password_hash_seconds", "bcrypt time including the wait for a worker.", ("operation",),
+        )
+        self.group_commit_batch_size = Histogram(
+            "group_commit_batch_size", "Transactions per group commit.", buckets=BATCH_SIZE_BUCKETS,
+        )
+        self.group_commit_wait_seconds = Histogram(
+            "group_commit_wait_seconds", "Time a transaction waited for its group commit to start.",
+        )
+        self.group_commit_flush_seconds = Histogram("group_commit_flush_seconds", "Time to apply and commit a batch.")
+        self.outbox_delivered = Counter("outbox_events_delivered_total", "Ledger events delivered.", ("sink",))
+        self.outbox_delivery_seconds = Histogram(
+            "outbox_delivery_seconds", "Time a sink took to take a batch of events.", ("sink",),
+        )
+        self.requests_shed = Counter(
+            "http_requests_shed_total", "Requests turned away by admission control.", ("reason", "priority"),
+        )
+        self._collectors: list[typing.Callable[[], typing.Iterable[Metric]]] = []
+
+    def register_collector(self, collector: typing.Callable[[], typing.Iterable[Metric]]) -> None:
+        """Add metrics computed at scrape time, e.g. from existing stats() methods."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        metrics: list[Metric] = [
+            self.request_duration, self.requests_in_flight, self.query_duration, self.pool_wait, self.password_duration,
+            self.group_commit_batch_size, self.group_commit_wait_seconds, self.group_commit_flush_seconds,
+            self.requests_shed, self.outbox_delivered, self.outbox_delivery_seconds,
+        ]
+        for collector in self._collectors:
+            metrics.extend(collector())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+_TARGET = re.compile(
+    r"\s*(?:UPDATE|INSERT\s+INTO|DELETE\s+FROM|LOCK\s+TABLE|CREATE\s+(?:\w+\s+)*?TABLE)\s+([\w.\"]+)", re.I,
+)
+# Skips FROM inside function calls such as extract(epoch FROM now())
+_FIRST_FROM = re.compile(r"\bFROM\s+([\w.\"]+)(?![\w.\"]|\s*\()", re.I)
+# A recursive CTE comes with its column names, e.g. walk(user_id, seq) AS (
+_CTE_NAME = re.compile(r"\b(\w+)(?:\s*\([\w\s,\"]*\))?\s+AS\s+(?:(?:NOT\s+)?MATERIALIZED\s+)?\(", re.I)
+_QUERY_NAMES_MAX: typing.Final = 1024
+
+
+def _parse_query_name(statement: str) -> str:
+    verb = statement.split(None, 1)[0].upper()
+    if verb == "WITH":
+        return "WITH " + ",".join(_CTE_NAME.findall(statement))
+    match = _TARGET.match(statement) or _FIRST_FROM.search(statement)
+    return verb + " " + match[1].replace('"', "") if match else verb
+
+
+def query_name(statement: str, names: dict[str, str]) -> str:
+    """'SELECT users', 'INSERT transaction_keys', 'WITH key,inserted,credited', ...
+
+    The verb and the table written to or first read from; CTE names for WITH.
+    Compiled statements are cached by SQLAlchemy, so the same strings come back and
+    their names are memoized rather than parsed per execution.
+    """
+    name = names.get(statement)
+    if name is None:
+        name = _parse_query_name(statement)
+        if len(names) < _QUERY_NAMES_MAX:
+            names[statement] = name
+    return name
+
+
+def stats_gauges(
+    prefix: str,
+    documentation: str,
+    stats: dict[LabelValues, dict[str, typing.Any]],
+    labelnames: LabelValues = (),
+) -> list[Gauge]:
+    """One gauge per numeric entry of stats() dicts, e.g. the pool or password pool stats.
+
+    stats maps label values to the stats() of that instance, e.g. one pool per db.
+    """
+    gauges: dict[str, Gauge] = {}
+    for labels, values in stats.items():
+        for key, value in values.items():
+            if isinstance(value, (int, float)):
+                if key not in gauges:
+                    gauges[key] = Gauge(f"{prefix}_{key}", f"{documentation}: {key.replace('_', ' ')}.", labelnames)
+                gauges[key].inc(*labels, amount=value)
+    return list(gauges.values())
+
+
+def instrument_engine(engine: AsyncEngine, metrics: Metrics, db: str) -> None:
+    """Time every statement on engine and every wait for one of its pool connections."""
+    names: dict[str, str] = {}
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        context._query_started = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        metrics.query_duration.labels(db, query_name(statement, names))\
+            .observe(time.perf_counter() - context._query_started)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+    engine.pool.wait_histogram = metrics.pool_wait.labels(db)
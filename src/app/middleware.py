@@ -0,0 +1,197 @@
+import collections
+import time
+import typing
+
+from jose import JWTError, jwt
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app import schemas
+from app.admission import AdmissionController, Priority
+from app.cache import TTLCache
+from app.db.replicas import format_lsn
+from app.db.resource import RoundTripCounter, round_trips
+from app.metrics import Metrics
+from app.repositories.utils import ALGORITHM, SECRET_KEY
+
+
+READ_AFTER_COOKIE: typing.Final = "read_after_lsn"
+
+
+class RoundTripStats:
+    """Requests and DB round trips per route, for comparing endpoints over time."""
+
+    def __init__(self) -> None:
+        self.requests: collections.Counter[str] = collections.Counter()
+        self.round_trips: collections.Counter[str] = collections.Counter()
+
+    def record(self, route: str, count: int) -> None:
+        self.requests[route] += 1
+        self.round_trips[route] += count
+
+    def stats(self) -> dict[str, dict[str, typing.Any]]:
+        return {
+            route: {
+                "requests": requests,
+                "round_trips": self.round_trips[route],
+                "round_trips_per_request": self.round_trips[route] / requests,
+            }
+            for route, requests in self.requests.items()
+        }
+
+
+class RoundTripCounterMiddleware:
+    """Counts the DB round trips of each request and reports them in X-DB-Round-Trips."""
+
+    def __init__(self, app: ASGIApp, stats: RoundTripStats) -> None:
+        self.app = app
+        self.stats = stats
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        counter = RoundTripCounter()
+        token = round_trips.set(counter)
+
+        async def send_with_header(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-DB-Round-Trips", str(counter.count))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_header)
+        finally:
+            round_trips.reset(token)
+            route = scope.get("route")
+            self.stats.record(getattr(route, "path", "unmatched"), counter.count)
+
+
+class ReadYourWritesMiddleware:
+    """Sends a client that wrote the primary's WAL position after its write, as a cookie.
+
+    The client's next reads carry it back, so they only go to replicas that replayed
+    that far, whichever worker serves them. The position is left in the request
+    state as commit_lsn by the session dependency, which exits before the response starts.
+    """
+
+    def __init__(self, app: ASGIApp, max_age: float) -> None:
+        self.app = app
+        self.max_age = max_age
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cookie(message: Message) -> None:
+            commit_lsn = scope.get("state", {}).get("commit_lsn")
+            if message["type"] == "http.response.start" and commit_lsn is not None:
+                MutableHeaders(scope=message).append(
+                    "Set-Cookie",
+                    f"{READ_AFTER_COOKIE}={format_lsn(commit_lsn)}; Max-Age={int(self.max_age)}; Path=/; "
+                    "HttpOnly; SameSite=Lax",
+                )
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+
+class MetricsMiddleware:
+    """Records the latency of every HTTP request by route and status, and how many are in flight."""
+
+    def __init__(self, app: ASGIApp, metrics: Metrics) -> None:
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = "500"
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        self.metrics.requests_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.metrics.requests_in_flight.dec()
+            route = scope.get("route")
+            self.metrics.request_duration.observe(
+                time.perf_counter() - started, scope["method"], getattr(route, "path", "unmatched"), status,
+            )
+
+
+class AdmissionMiddleware:
+    """Sheds requests the DB pools can't take right away, and users over their rate, with 503 or 429.
+
+    Runs before routing, so requests are classed by method and path: GETs and
+    read_paths (routes marked read_only) are reads, bulk_paths are bulk writes,
+    everything else is a write. Users are told apart by
+    their token's subject, resolved through the principal cache when possible;
+    requests without a valid token are only subject to the in-flight limits.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        controller: AdmissionController,
+        principal_cache: TTLCache[str, schemas.Principal],
+        metrics: Metrics,
+        bulk_paths: typing.Collection[str],
+        read_paths: typing.Collection[str],
+        exempt_paths: tuple[str, ...],
+    ) -> None:
+        self.app = app
+        self.controller = controller
+        self.principal_cache = principal_cache
+        self.metrics = metrics
+        self.bulk_paths = frozenset(bulk_paths)
+        self.read_paths = frozenset(read_paths)
+        self.exempt_paths = exempt_paths
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"].startswith(self.exempt_paths):
+            await self.app(scope, receive, send)
+            return
+
+        priority = self._priority(scope)
+        shed = self.controller.admit(priority, self._user(scope))
+        if shed is not None:
+            self.metrics.requests_shed.inc("rate_limited" if shed.status == 429 else "overloaded", priority.name)
+            response = JSONResponse(
+                {"detail": shed.detail}, status_code=shed.status, headers={"Retry-After": str(shed.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release()
+
+    def _priority(self, scope: Scope) -> Priority:
+        if scope["method"] in ("GET", "HEAD", "OPTIONS") or scope["path"] in self.read_paths:
+            return Priority.READ
+        return Priority.BULK if scope["path"] in self.bulk_paths else Priority.WRITE
+
+    def _user(self, scope: Scope) -> str | None:
+        scheme, _, token = Headers(scope=scope).get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not token:
+            return None
+        principal = self.principal_cache.peek(token)
+        if principal is not None:
+            return principal.email
+        try:
+            return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+        except JWTError:
+            return None
@@ -2,13 +2,15 @@ import logging
 import typing
 import sqlalchemy as sa
 
-from sqlalchemy import Column, Integer, String, Numeric, ForeignKey, DateTime
+from sqlalchemy import BigInteger, Column, Date, Identity, Integer, String, ForeignKey, DateTime, Index
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy import Enum
 
 from app.custom_types import TransactionType
+from app.money import DEFAULT_CURRENCY
 
 logger = logging.getLogger(__name__)
 
@@ -29,17 +31,181 @@ class User(Base):
     name = Column(String, index=True)
     email = Column(String, unique=True, index=True)
     hashed_password = Column(String)
-    balance = Column(Numeric(precision=10, scale=2), default=0.00)
+    # Money columns hold minor units of the wallet's currency, see app.money
+    balance = Column('balance_minor', BigInteger, default=0)
+    currency = Column(String(3), nullable=False, default=DEFAULT_CURRENCY, server_default=DEFAULT_CURRENCY)
+    # 0 unless the wallet is sharded, see BalanceSlot
+    balance_slots = Column(Integer, nullable=False, default=0, server_default='0')
+    # Bumped, and announced on the balance_changed channel, by the users_balance_changed trigger
+    balance_version = Column(BigInteger, nullable=False, default=0, server_default='0')
     transactions = relationship("Transaction", back_populates="user")
 
 
 class Transaction(Base):
+    """Ledger row, range-partitioned by month on created_at.
+
+    A partitioned table can only enforce uniqueness that includes created_at, so
+    transaction_id uniqueness lives in TransactionKey.
+    """
     __tablename__ = 'transactions'
 
-    id = Column(Integer, primary_key=True, index=True)
-    amount = Column(Numeric(precision=10, scale=2))
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    amount = Column('amount_minor', BigInteger)
+    created_at = Column(DateTime(timezone=True), primary_key=True, server_default=func.now())
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     user = relationship("User", back_populates="transactions")
     type = Column(transaction_type_enum, nullable=False)
-    transaction_id = Column(String, unique=True, nullable=False)
+    transaction_id = Column(String, nullable=False, index=True)
+    # Shared by the two legs of a transfer, see app.repositories.transfers; None otherwise
+    correlation_id = Column(String)
+
+    __table_args__ = (
+        Index('ix_transactions_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
+    )
+
+
+class TransactionKey(Base):
+    """Global index of transaction ids across all partitions, archived ones included.
+
+    Arbitrates idempotency keys and tells lookups which partition a transaction is in.
+    """
+    __tablename__ = 'transaction_keys'
+
+    transaction_id = Column(String, primary_key=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class TransactionArchive(Base):
+    """A monthly partition detached from transactions and moved to the archive schema.
+
+    Rows dated at or before the latest range_end can no longer be written, and
+    balances up to it are kept as checkpoints taken at range_end. Once exported
+    to file_path (see app.archive) the partition's table is dropped.
+    """
+    __tablename__ = 'transaction_archives'
+
+    partition_name = Column(String, primary_key=True)
+    range_start = Column(DateTime(timezone=True))
+    range_end = Column(DateTime(timezone=True), nullable=False)
+    archived_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    # None until exported; min and max created_at are None for a file without rows
+    file_path = Column(String)
+    row_count = Column(BigInteger)
+    min_created_at = Column(DateTime(timezone=True))
+    max_created_at = Column(DateTime(timezone=True))
+    exported_at = Column(DateTime(timezone=True))
+
+
+class BalanceCheckpoint(Base):
+    """Balance of a user as of a moment in time.
+
+    Point-in-time balances are answered from the nearest checkpoint plus the signed
+    transactions after it, instead of summing the whole history.
+    """
+    __tablename__ = 'balance_checkpoints'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    balance = Column('balance_minor', BigInteger, nullable=False)
+    as_of = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index('ix_balance_checkpoints_user_id_as_of', 'user_id', 'as_of', unique=True),
+    )
+
+
+class BalanceSlot(Base):
+    """One of balance_slots sub-balances of a sharded wallet.
+
+    Single deposits and withdrawals of a sharded wallet update a slot instead of
+    users.balance, so they don't queue on one row lock. The wallet's balance is
+    users.balance plus its slots, and every part of it stays non-negative.
+    """
+    __tablename__ = 'balance_slots'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    slot = Column(Integer, primary_key=True)
+    balance = Column('balance_minor', BigInteger, nullable=False, default=0, server_default='0')
+
+
+class ReconciliationRun(Base):
+    """A run of the ledger reconciliation job, see app.commands.reconcile.
+
+    Every transaction with an id up to watermark had committed when the run started.
+    An incremental run only rechecks wallets with transactions after the last
+    finished run's watermark.
+    """
+    __tablename__ = 'reconciliation_runs'
+
+    id = Column(Integer, primary_key=True)
+    started_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    finished_at = Column(DateTime(timezone=True))
+    # None for a full run
+    since_watermark = Column(BigInteger)
+    watermark = Column(BigInteger, nullable=False)
+    users_checked = Column(BigInteger)
+    mismatches = Column(BigInteger)
+
+
+class ReconciliationMismatch(Base):
+    """A wallet whose stored balance differed from the sum of its ledger in a reconciliation run."""
+    __tablename__ = 'reconciliation_mismatches'
+
+    run_id = Column(Integer, ForeignKey('reconciliation_runs.id'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    # users.balance plus its slots, None if users.balance is NULL
+    balance = Column('balance_minor', BigInteger)
+    ledger = Column('ledger_minor', BigInteger, nullable=False)
+
+
+class OutboxEvent(Base):
+    """A ledger row to announce downstream, written by the transactions_outbox trigger.
+
+    Deleted once delivered, see app.outbox.
+    """
+    __tablename__ = 'outbox_events'
+
+    id = Column(BigInteger, Identity(), primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    payload = Column(JSONB, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class DailyUserRollup(Base):
+    """A user's ledger totals for one UTC day, and their balance at the end of it.
+
+    Written by the rollup job (app.commands.rollups) for whole days only, and only
+    for days the user had transactions on; see RollupRun for how far they go.
+    """
+    __tablename__ = 'daily_user_rollups'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    deposits = Column('deposits_minor', BigInteger, nullable=False)
+    withdrawals = Column('withdrawals_minor', BigInteger, nullable=False)
+    deposit_count = Column(Integer, nullable=False)
+    withdrawal_count = Column(Integer, nullable=False)
+    closing_balance = Column('closing_balance_minor', BigInteger, nullable=False)
+
+
+class RollupRun(Base):
+    """A run of the rollup job.
+
+    Once finished, daily_user_rollups are complete up to and including through, as
+    of the run. Every transaction with an id up to watermark had committed when the
+    run read the ledger; the next run only redoes the days of transactions after
+    it, and the days after through.
+    """
+    __tablename__ = 'rollup_runs'
+
+    id = Column(Integer, primary_key=True)
+    started_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    finished_at = Column(DateTime(timezone=True))
+    # The watermark and through of the run this one continues from; None for a full run
+    since_watermark = Column(BigInteger)
+    since_through = Column(Date)
+    watermark = Column(BigInteger, nullable=False)
+    through = Column(Date, nullable=False)
+    # (user, day) rollups written
+    days = Column(BigInteger)
@@ -0,0 +1,49 @@
+"""Money is stored as BIGINT minor units (cents for USD) and only becomes a Decimal at the API edge.
+
+Each wallet has a currency, and the currency fixes how many minor units make one
+major unit. Amounts of a wallet's transactions are in its currency.
+"""
+import typing
+from decimal import Decimal
+
+from sqlalchemy import case
+from sqlalchemy.sql.elements import ColumnElement
+
+
+# ISO 4217 minor unit digits, plus a few non-ISO assets
+CURRENCY_SCALES: typing.Final[dict[str, int]] = {
+    "USD": 2,
+    "EUR": 2,
+    "GBP": 2,
+    "CHF": 2,
+    "JPY": 0,
+    "KRW": 0,
+    "KWD": 3,
+    "BHD": 3,
+    "BTC": 8,
+}
+# Wallets and tokens from before currencies existed are USD
+DEFAULT_CURRENCY: typing.Final = "USD"
+
+
+class Balance(typing.NamedTuple):
+    amount: int
+    currency: str
+
+
+def to_minor_units(amount: Decimal, currency: str) -> int:
+    """Raises ValueError if amount has more decimal places than the currency."""
+    scaled = amount.scaleb(CURRENCY_SCALES[currency])
+    if scaled != scaled.to_integral_value():
+        raise ValueError(f"{currency} amounts have at most {CURRENCY_SCALES[currency]} decimal places")
+    return int(scaled)
+
+
+def from_minor_units(amount: int, currency: str) -> Decimal:
+    # Keeps the currency's decimal places, e.g. 1000 cents is 10.00
+    return Decimal(amount).scaleb(-CURRENCY_SCALES[currency])
+
+
+def currency_scale(currency: ColumnElement[str]) -> ColumnElement[int]:
+    """SQL for the scale of a currency column."""
+    return case(CURRENCY_SCALES, value=currency)
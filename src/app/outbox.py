@@ -0,0 +1,154 @@
+import asyncio
+import importlib
+import json
+import logging
+import time
+import typing
+from datetime import datetime, timezone
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app.metrics import Metrics
+from app.repositories.outbox import claim_events, delete_events, get_backlog
+from app.settings import Settings
+
+
+logger = logging.getLogger(__name__)
+
+Event = dict[str, typing.Any]
+
+
+class Sink(typing.Protocol):
+    """Where the dispatcher delivers ledger events.
+
+    deliver gets a batch in outbox order; raising fails the whole batch, which is
+    then delivered again, so a sink has to tolerate duplicates (event_id is stable).
+    """
+    name: str
+
+    async def deliver(self, events: list[Event]) -> None: ...
+
+    async def close(self) -> None: ...
+
+
+class NdjsonFileSink:
+    """Appends every event to a file as a line of JSON; for local testing."""
+
+    def __init__(self, path: str) -> None:
+        self.name = f"ndjson:{path}"
+        self.path = path
+
+    async def deliver(self, events: list[Event]) -> None:
+        lines = "".join(json.dumps(event) + "\n" for event in events)
+        await asyncio.to_thread(self._append, lines)
+
+    def _append(self, lines: str) -> None:
+        with open(self.path, "a") as file:
+            file.write(lines)
+
+    async def close(self) -> None:
+        pass
+
+
+def load_sink(spec: str, settings: Settings) -> Sink:
+    """A sink from its setting: "ndjson:<path>", or "<module>:<name>" of a factory called with the settings."""
+    kind, _, target = spec.partition(":")
+    if kind == "ndjson":
+        return NdjsonFileSink(target)
+    factory = getattr(importlib.import_module(kind), target)
+    return factory(settings)
+
+
+class OutboxDispatcher:
+    """Delivers outbox_events to the sinks, at least once and in order per user.
+
+    Each round claims a batch (see claim_events), delivers it to every sink and
+    deletes it, all in one DB transaction: if a sink or the process fails, the
+    batch is rolled back and claimed again later. Every worker runs one, and they
+    share the backlog; a user's events are only ever in one of their batches.
+    Rounds follow each other right away while batches come back full, and every
+    poll_seconds otherwise.
+
+    Without sinks, while the outbox is on, a round only reads the backlog, which can
+    only grow, and logs an error when it has grown, at most every report_seconds.
+    """
+
+    def __init__(
+        self,
+        session_maker: async_sessionmaker[AsyncSession],
+        sinks: list[Sink],
+        batch_size: int,
+        poll_seconds: float,
+        metrics: Metrics | None = None,
+        report_seconds: float = 60,
+    ) -> None:
+        self.session_maker = session_maker
+        self.sinks = sinks
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.metrics = metrics
+        self.delivered = 0
+        self.failures = 0
+        self.backlog = 0
+        self.oldest: datetime | None = None
+        self.report_seconds = report_seconds
+        self._reported_backlog = 0
+        self._next_report = 0.0
+
+    async def run(self) -> None:
+        while True:
+            try:
+                delivered = await self.dispatch()
+            except Exception as e:
+                logger.warning("Outbox dispatch failed: %r", e)
+                self.failures += 1
+                delivered = 0
+            if delivered < self.batch_size:
+                await asyncio.sleep(self.poll_seconds)
+
+    async def dispatch(self) -> int:
+        """Deliver one batch; returns the number of events in it."""
+        if not self.sinks:
+            await self._watch()
+            return 0
+
+        async with self.session_maker() as session:
+            async with session.begin():
+                claimed = await claim_events(session, self.batch_size)
+                if claimed:
+                    events = [{"event_id": event.id, **event.payload} for event in claimed]
+                    for sink in self.sinks:
+                        started = time.perf_counter()
+                        await sink.deliver(events)
+                        if self.metrics is not None:
+                            self.metrics.outbox_delivery_seconds.observe(time.perf_counter() - started, sink.name)
+                            self.metrics.outbox_delivered.inc(sink.name, amount=len(events))
+                    await delete_events(session, [event.id for event in claimed])
+                self.backlog, self.oldest = await get_backlog(session)
+        self.delivered += len(claimed)
+        return len(claimed)
+
+    async def _watch(self) -> None:
+        async with self.session_maker() as session:
+            self.backlog, self.oldest = await get_backlog(session)
+        if self.backlog > self._reported_backlog and time.monotonic() >= self._next_report:
+            logger.error(
+                "%s outbox events are waiting but no outbox_sinks are configured; configure some, "
+                "or turn the outbox off with python -m app.commands.outbox disable --purge",
+                self.backlog,
+            )
+            self._reported_backlog = self.backlog
+            self._next_report = time.monotonic() + self.report_seconds
+
+    async def close(self) -> None:
+        for sink in self.sinks:
+            await sink.close()
+
+    def stats(self) -> dict[str, typing.Any]:
+        return {
+            "sinks": len(self.sinks),
+            "delivered": self.delivered,
+            "failures": self.failures,
+            "backlog": self.backlog,
+            "lag_seconds": (datetime.now(timezone.utc) - self.oldest).total_seconds() if self.oldest else 0,
+        }
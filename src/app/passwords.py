@@ -0,0 +1,63 @@
+import asyncio
+import concurrent.futures
+import time
+import typing
+
+from app.exceptions import PasswordPoolSaturatedError
+from app.metrics import Histogram
+from app.repositories.utils import hash_password, verify_password
+
+
+T = typing.TypeVar("T")
+
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded thread pool so it never blocks the event loop.
+
+    bcrypt releases the GIL while hashing, so threads give real parallelism here.
+    Once workers + queue_size calls are outstanding, new calls fail fast with
+    PasswordPoolSaturatedError instead of queueing behind a login burst.
+    """
+
+    def __init__(self, workers: int, queue_size: int, duration: Histogram | None = None) -> None:
+        self.workers = workers
+        self.duration = duration
+        self.queue_size = queue_size
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", hash_password, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run("verify", verify_password, plain_password, hashed_password)
+
+    async def _run(self, operation: str, func: typing.Callable[..., T], *args: typing.Any) -> T:
+        if self.pending >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise PasswordPoolSaturatedError("Password hashing pool is saturated")
+
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+            if self.duration is not None:
+                self.duration.observe(time.perf_counter() - started, operation)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "busy": min(self.pending, self.workers),
+            "queued": max(self.pending - self.workers, 0),
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import os
+import typing
+from datetime import datetime
+
+from sqlalchemy import (
+    BigInteger, ColumnElement, Executable, Result, TableClause, case, cast, column, false, func, literal,
+    literal_column, table, text, tuple_, union_all, update,
+)
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.archive import COLUMNS, ArchivedTransaction, ArchiveSummary, ArchiveWriter, count_rows
+from app.custom_types import TransactionType
+from app.exceptions import ArchiveMovedError
+from app.models import Transaction, TransactionArchive
+
+
+logger = logging.getLogger(__name__)
+
+# Where archive_partitions moves detached partitions, until export_archive drops them
+ARCHIVE_SCHEMA: typing.Final = "archive"
+# Raised for a table that isn't there (any more)
+UNDEFINED_TABLE: typing.Final = "42P01"
+PG_INHERITS: typing.Final = table("pg_inherits", column("inhrelid"), column("inhdetachpending"))
+
+
+def table_schema() -> ColumnElement[str | None]:
+    """Schema of the table an archived partition's rows are in until it's exported, over TransactionArchive.
+
+    archive_partitions detaches the partition, which leaves its table in the public
+    schema, then moves it to the archive schema, where export_archive drops it. NULL
+    while the partition is still attached, its rows being in transactions then, and
+    once its table is dropped.
+    """
+    name = TransactionArchive.partition_name
+    attached = select(PG_INHERITS.c.inhrelid)\
+        .where(PG_INHERITS.c.inhrelid == func.to_regclass(name))\
+        .where(PG_INHERITS.c.inhdetachpending.is_(false()))\
+        .exists()
+    return case(
+        (func.to_regclass(literal(f"{ARCHIVE_SCHEMA}.") + name).is_not(None), literal(ARCHIVE_SCHEMA)),
+        (func.to_regclass(name).is_not(None) & ~attached, literal("public")),
+    )
+
+
+def archived_table(qualified_name: str) -> TableClause:
+    """An archived partition's table, "<schema>.<name>" as table_schema places it, with the columns of transactions."""
+    schema, name = qualified_name.split(".")
+    return table(name, *(column(c.name, c.type) for c in Transaction.__table__.columns), schema=schema)
+
+
+async def _execute_on_tables(session: AsyncSession, stmt: Executable) -> Result[typing.Any]:
+    """Execute stmt, over archived partitions' tables, under a savepoint.
+
+    Raises ArchiveMovedError if one of them has been moved to the archive schema, or
+    exported and dropped, since it was looked up; the session stays usable.
+    """
+    try:
+        async with session.begin_nested():
+            return await session.execute(stmt)
+    except DBAPIError as e:
+        if getattr(e.orig, "sqlstate", None) != UNDEFINED_TABLE:
+            raise
+        raise ArchiveMovedError(str(e.orig)) from e
+
+
+async def get_archives(session: AsyncSession, since: datetime | None, until: datetime | None) -> list[str]:
+    """Names of the archived partitions that can hold rows dated in [since, until], oldest first.
+
+    Decided from an exported one's min and max created_at, without opening its file,
+    and from the range of one that isn't exported yet.
+    """
+    exported = TransactionArchive.file_path.is_not(None)
+    stmt = select(TransactionArchive.partition_name).order_by(TransactionArchive.range_end)
+    if since is not None:
+        stmt = stmt.where(case(
+            (exported, TransactionArchive.max_created_at >= since),
+            else_=TransactionArchive.range_end > since,
+        ))
+    if until is not None:
+        stmt = stmt.where(case(
+            (exported, TransactionArchive.min_created_at <= until),
+            else_=func.coalesce(TransactionArchive.range_start, literal_column("'-infinity'::timestamptz")) <= until,
+        ))
+    return list((await session.scalars(stmt)).all())
+
+
+async def get_archive_location(session: AsyncSession, partition_name: str) -> tuple[str | None, str | None]:
+    """Where an archived partition's rows are now: its file, or its table's schema (see table_schema).
+
+    export_archive drops the table as it records the file, so one at most; neither
+    while the partition is still attached.
+    """
+    result = await session.execute(
+        select(TransactionArchive.file_path, table_schema())
+        .where(TransactionArchive.partition_name == partition_name)
+    )
+    file_path, schema = result.one()
+    return file_path, schema
+
+
+async def read_table_history(
+    session: AsyncSession,
+    qualified_name: str,
+    user_id: int,
+    currency: str,
+    limit: int,
+    type_: TransactionType | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    after: tuple[datetime, int] | None = None,
+) -> list[ArchivedTransaction]:
+    """Up to limit of the user's rows of an archived partition's table, like archive.read_history's.
+
+    By keyset on the table's copy of ix_transactions_user_id_created_at_id. Raises
+    ArchiveMovedError if the table has moved on since it was looked up.
+    """
+    archived = archived_table(qualified_name)
+    stmt = select(
+        archived.c.id, archived.c.transaction_id, archived.c.user_id, archived.c.type,
+        archived.c.amount_minor.label("amount"), archived.c.created_at, archived.c.correlation_id,
+    )\
+        .where(archived.c.user_id == user_id)\
+        .order_by(archived.c.created_at, archived.c.id)\
+        .limit(limit)
+    if type_ is not None:
+        stmt = stmt.where(archived.c.type == type_)
+    if since is not None:
+        stmt = stmt.where(archived.c.created_at >= since)
+    if until is not None:
+        stmt = stmt.where(archived.c.created_at < until)
+    if after is not None:
+        stmt = stmt.where(tuple_(archived.c.created_at, archived.c.id) > after)
+    result = await _execute_on_tables(session, stmt)
+    return [ArchivedTransaction(**row._mapping, currency=currency) for row in result]
+
+
+async def get_table_delta(
+    session: AsyncSession, qualified_names: list[str], user_id: int, after: datetime | None, until: datetime,
+) -> int | None:
+    """The signed sum of the user's rows in (after, until] of archived partitions' tables; None without any.
+
+    Like archive.get_delta over files. Raises ArchiveMovedError if one of the tables
+    has moved on since it was looked up.
+    """
+    deltas = []
+    for qualified_name in qualified_names:
+        archived = archived_table(qualified_name)
+        signed = case(
+            (archived.c.type == TransactionType.WITHDRAW, -archived.c.amount_minor),
+            else_=archived.c.amount_minor,
+        )
+        delta = select(func.sum(signed).label("delta"))\
+            .where(archived.c.user_id == user_id)\
+            .where(archived.c.created_at <= until)
+        if after is not None:
+            delta = delta.where(archived.c.created_at > after)
+        deltas.append(delta)
+    deltas = union_all(*deltas).subquery()
+    return (await _execute_on_tables(session, select(cast(func.sum(deltas.c.delta), BigInteger)))).scalar()
+
+
+async def get_archive_horizon(session: AsyncSession) -> datetime | None:
+    """The range_end of the newest archived partition, exported to a file or not; None before any was.
+
+    Rows dated before it may be outside transactions: in an archive file, or in a
+    detached partition's table in the archive schema until it's exported.
+    """
+    return await session.scalar(select(func.max(TransactionArchive.range_end)))
+
+
+async def get_unexported(session: AsyncSession) -> list[TransactionArchive]:
+    result = await session.scalars(
+        select(TransactionArchive)
+        .where(TransactionArchive.file_path.is_(None))
+        .order_by(TransactionArchive.range_end)
+    )
+    return list(result.all())
+
+
+async def export_archive(
+    session: AsyncSession, archive: TransactionArchive, directory: str, batch_size: int,
+) -> ArchiveSummary | None:
+    """Write an archived partition to a file in directory, record it, and drop the partition's table.
+
+    Rows are read in (user_id, created_at, id) order, batch_size at a time by keyset
+    on the partition's copy of ix_transactions_user_id_created_at_id, and each batch
+    is a row group. Unlike a server-side cursor, which stays open until the
+    transaction ends, that leaves nothing using the table by the time it's dropped. The
+    table is only dropped once the file holds as many rows as it does, and with the
+    session's transaction, so a failed export leaves it as it was. None if the
+    table isn't in the archive schema, e.g. if archive_partitions was interrupted.
+    """
+    table = f"{ARCHIVE_SCHEMA}.{archive.partition_name}"
+    if await session.scalar(select(func.to_regclass(table))) is None:
+        return None
+
+    path = os.path.abspath(os.path.join(directory, f"{archive.partition_name}.parquet"))
+    columns = ", ".join(COLUMNS)
+    first = text(f"SELECT {columns} FROM {table} ORDER BY user_id, created_at, id LIMIT :limit")
+    following = text(
+        f"SELECT {columns} FROM {table} WHERE (user_id, created_at, id) > (:user_id, :created_at, :id) "
+        "ORDER BY user_id, created_at, id LIMIT :limit"
+    )
+    writer = ArchiveWriter(path)
+    try:
+        rows = (await session.execute(first, {"limit": batch_size})).all()
+        while rows:
+            await asyncio.to_thread(writer.write, rows)
+            last = rows[-1]
+            rows = (await session.execute(following, {
+                "user_id": last.user_id, "created_at": last.created_at, "id": last.id, "limit": batch_size,
+            })).all() if len(rows) == batch_size else []
+    except BaseException:
+        writer.abort()
+        raise
+    summary = await asyncio.to_thread(writer.close)
+
+    expected = await session.scalar(text(f"SELECT count(*) FROM {table}"))
+    if await asyncio.to_thread(count_rows, path) != expected:
+        raise RuntimeError(f"{path} doesn't hold the {expected} rows of {table}")
+
+    await session.execute(
+        update(TransactionArchive)
+        .where(TransactionArchive.partition_name == archive.partition_name)
+        .values(
+            file_path=path,
+            row_count=summary.rows,
+            min_created_at=summary.min_created_at,
+            max_created_at=summary.max_created_at,
+            exported_at=func.now(),
+        )
+    )
+    await session.execute(text(f"DROP TABLE {table}"))
+    logger.info("Exported %s to %s (%s rows)", table, path, summary.rows)
+    return summary
+
@@ -0,0 +1,134 @@
+import typing
+
+from sqlalchemy import BigInteger, Integer, cast, column, delete, func, update, values
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.models import BalanceSlot, User
+
+
+# users.balance plus the slots of a sharded wallet; correlates with User in the enclosing query.
+# sum() of a BIGINT is NUMERIC, hence the cast back
+total_balance = User.balance + func.coalesce(
+    select(cast(func.sum(BalanceSlot.balance), BigInteger)).where(BalanceSlot.user_id == User.id).scalar_subquery(),
+    0,
+)
+
+
+async def lock_users(session: AsyncSession, user_ids: typing.Any) -> dict[int, tuple[int | None, int]]:
+    """Lock the users' rows in id order and return their (balance, balance_slots).
+
+    FOR NO KEY UPDATE doesn't conflict with the key-share locks that inserting
+    their transactions takes, so slot writes are never blocked by it.
+    """
+    result = await session.execute(
+        select(User.id, User.balance, User.balance_slots)
+        .where(User.id.in_(user_ids))
+        .order_by(User.id)
+        .with_for_update(key_share=True)
+    )
+    return {user_id: (balance, slots) for user_id, balance, slots in result}
+
+
+async def consolidate_slots(
+    session: AsyncSession, user_ids: typing.Any, skip_locked: bool = False,
+) -> dict[int, int]:
+    """Move the slot balances of the users into users.balance; returns the new balances of those that had any.
+
+    The caller must already hold the users' row locks (see lock_users), so the slot
+    and row locks are always taken in the same order. A caller that may itself hold
+    slot locks taken before its row lock passes skip_locked, leaving slots other
+    transactions are writing where they are rather than deadlocking on them.
+    """
+    drained_slots = select(BalanceSlot.user_id, BalanceSlot.slot, BalanceSlot.balance)\
+        .where(BalanceSlot.user_id.in_(user_ids))\
+        .where(BalanceSlot.balance != 0)\
+        .order_by(BalanceSlot.user_id, BalanceSlot.slot)\
+        .with_for_update(skip_locked=skip_locked)\
+        .cte("drained_slots")
+    drained = update(BalanceSlot)\
+        .where(BalanceSlot.user_id == drained_slots.c.user_id)\
+        .where(BalanceSlot.slot == drained_slots.c.slot)\
+        .values(balance=0)\
+        .returning(drained_slots.c.user_id, drained_slots.c.balance)\
+        .cte("drained")
+    totals = select(drained.c.user_id, cast(func.sum(drained.c.balance), BigInteger).label("balance"))\
+        .group_by(drained.c.user_id)\
+        .subquery()
+    stmt = update(User)\
+        .where(User.id == totals.c.user_id)\
+        .values(balance=User.balance + totals.c.balance)\
+        .returning(User.id, User.balance)\
+        .add_cte(drained)\
+        .execution_options(synchronize_session=False)
+    return dict((await session.execute(stmt)).all())
+
+
+async def spread_slots(session: AsyncSession, balances: dict[int, tuple[int | None, int]]) -> None:
+    """Split each consolidated balance evenly over the user's slots, leaving users.balance at zero.
+
+    balances maps locked, consolidated users to their (balance, balance_slots).
+    """
+    shares = []
+    for user_id, (balance, slots) in balances.items():
+        if not slots or not balance:
+            continue
+        share = balance // slots
+        # The remainder goes to slot 0
+        shares.extend((user_id, slot, share) for slot in range(1, slots))
+        shares.append((user_id, 0, balance - share * (slots - 1)))
+    if not shares:
+        return
+
+    spread = values(
+        column("user_id", Integer), column("slot", Integer), column("balance", BalanceSlot.balance.type),
+        name="spread",
+    ).data(shares)
+    await session.execute(
+        update(BalanceSlot)
+        .where(BalanceSlot.user_id == spread.c.user_id)
+        .where(BalanceSlot.slot == spread.c.slot)
+        .values(balance=spread.c.balance)
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(
+        update(User)
+        .where(User.id.in_({user_id for user_id, _, _ in shares}))
+        .values(balance=0)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def set_balance_slots(session: AsyncSession, user_id: int, slots: int) -> None:
+    """Shard a wallet over slots sub-balances, re-shard it, or (slots=0) unshard it."""
+    locked = await lock_users(session, [user_id])
+    if user_id not in locked:
+        raise ValueError(f"User {user_id} does not exist")
+    balance = (await consolidate_slots(session, [user_id])).get(user_id, locked[user_id][0])
+
+    await session.execute(delete(BalanceSlot).where(BalanceSlot.user_id == user_id))
+    await session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(balance_slots=slots)
+        .execution_options(synchronize_session=False)
+    )
+    if slots:
+        await session.execute(insert(BalanceSlot).values([{"user_id": user_id, "slot": slot} for slot in range(slots)]))
+        await spread_slots(session, {user_id: (balance, slots)})
+
+
+async def rebalance_slots(session: AsyncSession) -> int:
+    """Even out the slots of every sharded wallet; returns how many were rebalanced.
+
+    Withdrawals only take the fast path when a single slot covers them, and the
+    fallback leaves the funds in users.balance, so slots drift apart over time.
+    """
+    locked = await lock_users(session, select(User.id).where(User.balance_slots > 0))
+    consolidated = await consolidate_slots(session, list(locked))
+    balances = {
+        user_id: (consolidated.get(user_id, balance), slots) for user_id, (balance, slots) in locked.items()
+    }
+    await spread_slots(session, balances)
+    return len(balances)
@@ -0,0 +1,69 @@
+import typing
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Integer, Select, any_, cast, func, literal, literal_column, or_
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.future import select
+
+from app import schemas
+from app.models import BalanceCheckpoint, Transaction, User
+from app.repositories.balance_slots import total_balance
+from app.repositories.utils import signed_amount
+
+
+STREAM_BATCH_SIZE: typing.Final = 1000
+
+
+def balances_query(user_ids: list[int], ts: int | None = None) -> Select[typing.Any]:
+    """(user_id, amount, currency) of many wallets in user id order, now or at ts.
+
+    The ids are sent as one array parameter (id = ANY($1)), so the statement is the
+    same, and prepared once, however many there are. Unknown ids are left out, and
+    so are wallets without any history by ts, like the single-wallet endpoint's 404.
+    """
+    ids = literal(user_ids, ARRAY(Integer))
+    if not ts:
+        return select(User.id.label("user_id"), total_balance.label("amount"), User.currency)\
+            .where(User.id == any_(ids))\
+            .order_by(User.id)
+
+    # Same as get_date_balance, for every wallet at once: the nearest checkpoint of each,
+    # plus one grouped sum of the transactions after it
+    _ts = datetime.fromtimestamp(ts)
+    checkpoints = select(BalanceCheckpoint.user_id, BalanceCheckpoint.balance, BalanceCheckpoint.as_of)\
+        .where(BalanceCheckpoint.user_id == any_(ids))\
+        .where(BalanceCheckpoint.as_of <= _ts)\
+        .distinct(BalanceCheckpoint.user_id)\
+        .order_by(BalanceCheckpoint.user_id, BalanceCheckpoint.as_of.desc())\
+        .subquery("checkpoints")
+    deltas = select(Transaction.user_id, cast(func.sum(signed_amount), BigInteger).label("delta"))\
+        .outerjoin(checkpoints, checkpoints.c.user_id == Transaction.user_id)\
+        .where(Transaction.user_id == any_(ids))\
+        .where(Transaction.created_at <= _ts)\
+        .where(Transaction.created_at > func.coalesce(
+            checkpoints.c.as_of, literal_column("'-infinity'::timestamptz"),
+        ))\
+        .group_by(Transaction.user_id)\
+        .subquery("deltas")
+    amount = func.coalesce(checkpoints.c.balance, 0) + func.coalesce(deltas.c.delta, 0)
+    return select(User.id.label("user_id"), amount.label("amount"), User.currency)\
+        .outerjoin(checkpoints, checkpoints.c.user_id == User.id)\
+        .outerjoin(deltas, deltas.c.user_id == User.id)\
+        .where(User.id == any_(ids))\
+        .where(or_(checkpoints.c.user_id.is_not(None), deltas.c.user_id.is_not(None)))\
+        .order_by(User.id)
+
+
+async def stream_balances(
+    session_maker: async_sessionmaker[AsyncSession], stmt: Select[typing.Any],
+) -> typing.AsyncIterator[str]:
+    """Yield the balances as NDJSON lines, read through a server-side cursor.
+
+    Opens its own session, as stream_history does.
+    """
+    async with session_maker() as session:
+        async with session.begin():
+            result = await session.stream(stmt.execution_options(yield_per=STREAM_BATCH_SIZE))
+            async for row in result:
+                yield schemas.UserBalanceEntry.from_ledger(row, row.currency).model_dump_json() + "\n"
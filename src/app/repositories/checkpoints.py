@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, literal, literal_column, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.models import BalanceCheckpoint, Transaction, TransactionArchive
+from app.repositories.utils import signed_amount
+
+
+async def create_checkpoints(session: AsyncSession, as_of: datetime) -> int:
+    """Snapshot the balance of every user whose ledger moved since their last checkpoint.
+
+    Each new checkpoint is the previous one plus the signed transactions between them,
+    so a run only reads the transactions written since the last run.
+    """
+    last_checkpoint = select(BalanceCheckpoint.user_id, BalanceCheckpoint.balance, BalanceCheckpoint.as_of)\
+        .where(BalanceCheckpoint.as_of <= as_of)\
+        .distinct(BalanceCheckpoint.user_id)\
+        .order_by(BalanceCheckpoint.user_id, BalanceCheckpoint.as_of.desc())\
+        .subquery()
+
+    snapshot = select(
+        Transaction.user_id,
+        func.coalesce(last_checkpoint.c.balance, 0) + func.sum(signed_amount),
+        literal(as_of, BalanceCheckpoint.as_of.type),
+    )\
+        .outerjoin(last_checkpoint, last_checkpoint.c.user_id == Transaction.user_id)\
+        .where(Transaction.created_at <= as_of)\
+        .where(or_(last_checkpoint.c.as_of.is_(None), Transaction.created_at > last_checkpoint.c.as_of))\
+        .group_by(Transaction.user_id, last_checkpoint.c.balance)
+
+    stmt = insert(BalanceCheckpoint)\
+        .from_select([BalanceCheckpoint.user_id, BalanceCheckpoint.balance, BalanceCheckpoint.as_of], snapshot)\
+        .on_conflict_do_nothing(index_elements=["user_id", "as_of"])
+    result = await session.execute(stmt)
+    return result.rowcount
+
+
+async def backfill_checkpoints(session: AsyncSession, interval: timedelta, until: datetime) -> int:
+    """Write a checkpoint at the end of every interval in which a user had transactions.
+
+    Recomputes everything from the live ledger in one pass, so existing checkpoints
+    in the covered range are overwritten rather than trusted. Archived partitions are
+    not in the live ledger; their totals come from the checkpoints taken when they
+    were archived, which are left as they are.
+    """
+    origin = literal_column("'2000-01-01T00:00:00+00:00'::timestamptz")
+    bucket_end = func.date_bin(interval, Transaction.created_at, origin, type_=BalanceCheckpoint.as_of.type) + interval
+    horizon = func.coalesce(
+        select(func.max(TransactionArchive.range_end)).scalar_subquery(),
+        literal_column("'-infinity'::timestamptz"),
+    )
+    archived = select(BalanceCheckpoint.user_id, BalanceCheckpoint.balance)\
+        .where(BalanceCheckpoint.as_of <= horizon)\
+        .distinct(BalanceCheckpoint.user_id)\
+        .order_by(BalanceCheckpoint.user_id, BalanceCheckpoint.as_of.desc())\
+        .subquery()
+
+    per_bucket = select(
+        Transaction.user_id,
+        bucket_end.label("as_of"),
+        func.sum(signed_amount).label("delta"),
+    )\
+        .where(Transaction.created_at > horizon)\
+        .where(bucket_end <= until)\
+        .group_by(Transaction.user_id, bucket_end)\
+        .subquery()
+
+    running = select(
+        per_bucket.c.user_id,
+        func.coalesce(archived.c.balance, 0)
+        + func.sum(per_bucket.c.delta).over(partition_by=per_bucket.c.user_id, order_by=per_bucket.c.as_of),
+        per_bucket.c.as_of,
+    )\
+        .outerjoin(archived, archived.c.user_id == per_bucket.c.user_id)
+
+    stmt = insert(BalanceCheckpoint)\
+        .from_select([BalanceCheckpoint.user_id, BalanceCheckpoint.balance, BalanceCheckpoint.as_of], running)
+    # excluded is keyed by column name
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "as_of"],
+        set_={"balance_minor": stmt.excluded.balance_minor},
+    )
+    result = await session.execute(stmt)
+    return result.rowcount
@@ -0,0 +1,217 @@
+import asyncio
+import dataclasses
+import logging
+import time
+from datetime import datetime
+from uuid import uuid4
+
+from sqlalchemy import Integer, column, delete, func, update, values
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app import schemas
+from app.custom_types import TransactionType
+from app.exceptions import PaymentError
+from app.metrics import Metrics
+from app.models import Transaction, TransactionKey, User
+from app.repositories.balance_slots import consolidate_slots, lock_users
+from app.repositories.payment import is_replay_of, select_by_transaction_id
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class _Pending:
+    data: schemas.TransactionEntry
+    user: schemas.Principal
+    tx_id: str
+    future: asyncio.Future[Transaction]
+    queued_at: float
+
+    @property
+    def delta(self) -> int:
+        return -self.data.amount if self.data.type == TransactionType.WITHDRAW else self.data.amount
+
+
+class GroupCommitter:
+    """Coalesces concurrent add_transaction calls into one DB transaction per batch.
+
+    Calls queue in-process and are flushed window seconds after the first one
+    arrives, or as soon as max_items are waiting. A batch pays for one BEGIN/COMMIT
+    and one WAL flush however many transactions it carries, and returns each
+    caller the same result, or error, add_transaction would have.
+    """
+
+    def __init__(
+        self,
+        session_maker: async_sessionmaker[AsyncSession],
+        window: float,
+        max_items: int,
+        metrics: Metrics | None = None,
+    ) -> None:
+        self.session_maker = session_maker
+        self.window = window
+        self.max_items = max_items
+        self.metrics = metrics
+        self._pending: list[_Pending] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._flushes: set[asyncio.Task[None]] = set()
+
+    async def add_transaction(self, data: schemas.TransactionEntry, user: schemas.Principal) -> Transaction:
+        loop = asyncio.get_running_loop()
+        item = _Pending(data, user, data.uid or str(uuid4()), loop.create_future(), time.perf_counter())
+        self._pending.append(item)
+        if len(self._pending) >= self.max_items:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush_now)
+        # A caller that goes away still gets its transaction committed, as without batching
+        return await asyncio.shield(item.future)
+
+    async def close(self) -> None:
+        """Flush whatever is queued and wait for in-flight batches."""
+        self._flush_now()
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+
+    def _flush_now(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: list[_Pending]) -> None:
+        started = time.perf_counter()
+        if self.metrics is not None:
+            self.metrics.group_commit_batch_size.observe(len(batch))
+            for item in batch:
+                self.metrics.group_commit_wait_seconds.observe(started - item.queued_at)
+
+        try:
+            outcomes = await self._commit(batch)
+        except Exception as e:
+            logger.exception("Group commit of %s transactions failed", len(batch))
+            outcomes = [e] * len(batch)
+
+        if self.metrics is not None:
+            self.metrics.group_commit_flush_seconds.observe(time.perf_counter() - started)
+        for item, outcome in zip(batch, outcomes, strict=True):
+            if isinstance(outcome, Exception):
+                item.future.set_exception(outcome)
+            else:
+                item.future.set_result(outcome)
+
+    async def _commit(self, batch: list[_Pending]) -> list[Transaction | Exception]:
+        async with self.session_maker() as session:
+            async with session.begin():
+                return await _apply_batch(session, batch)
+
+
+async def _apply_batch(session: AsyncSession, batch: list[_Pending]) -> list[Transaction | Exception]:
+    """Apply a batch in arrival order, with the same per-item outcome as add_transaction."""
+    balances = await _lock_balances(session, batch)
+
+    # The first request for a key owns it; later ones in the batch are replays of it
+    owners: dict[str, _Pending] = {}
+    for item in batch:
+        owners.setdefault(item.tx_id, item)
+    claimed = dict((await session.execute(
+        insert(TransactionKey)
+        .values([{"transaction_id": tx_id, "created_at": func.now()} for tx_id in owners])
+        .on_conflict_do_nothing(index_elements=["transaction_id"])
+        .returning(TransactionKey.transaction_id, TransactionKey.created_at)
+    )).all())
+
+    # The same guard as add_transaction's, against the balance left by earlier items
+    accepted: list[_Pending] = []
+    rejected: dict[str, PaymentError] = {}
+    for item in owners.values():
+        if item.tx_id not in claimed:
+            continue
+        balance = balances.get(item.user.id)
+        if balance is None or balance + item.delta < 0:
+            rejected[item.tx_id] = PaymentError("Insufficient funds")
+        else:
+            balances[item.user.id] = balance + item.delta
+            accepted.append(item)
+
+    if rejected:
+        await session.execute(delete(TransactionKey).where(TransactionKey.transaction_id.in_(rejected)))
+    created = await _apply(session, accepted, claimed)
+    created.update(await _replay(session, [tx_id for tx_id in owners if tx_id not in claimed]))
+    return [_outcome(item, created, rejected) for item in batch]
+
+
+async def _lock_balances(session: AsyncSession, batch: list[_Pending]) -> dict[int, int | None]:
+    """Lock the batch's users, and their balances to check withdrawals against."""
+    locked = await lock_users(session, {item.user.id for item in batch})
+    balances = {user_id: balance for user_id, (balance, _) in locked.items()}
+    # The batch works on users.balance, so sharded wallets that withdraw have their slots moved there
+    withdrawing = {
+        item.user.id for item in batch
+        if item.data.type == TransactionType.WITHDRAW and locked.get(item.user.id, (None, 0))[1]
+    }
+    if withdrawing:
+        balances.update(await consolidate_slots(session, withdrawing))
+    return balances
+
+
+async def _apply(
+    session: AsyncSession, accepted: list[_Pending], claimed: dict[str, datetime],
+) -> dict[str, Transaction]:
+    """Insert the accepted items' rows and apply them to their users' balances."""
+    if not accepted:
+        return {}
+    rows = await session.scalars(
+        insert(Transaction).returning(Transaction, sort_by_parameter_order=True),
+        [
+            {
+                "amount": item.data.amount,
+                "type": item.data.type,
+                "transaction_id": item.tx_id,
+                "user_id": item.user.id,
+                "created_at": claimed[item.tx_id],
+            }
+            for item in accepted
+        ],
+    )
+    created = {transaction.transaction_id: transaction for transaction in rows}
+
+    # One row update per user however many of the batch's items are theirs
+    deltas: dict[int, int] = {}
+    for item in accepted:
+        deltas[item.user.id] = deltas.get(item.user.id, 0) + item.delta
+    delta_values = values(column("id", Integer), column("delta", User.balance.type), name="deltas")\
+        .data(list(deltas.items()))
+    await session.execute(
+        update(User)
+        .where(User.id == delta_values.c.id)
+        .values(balance=User.balance + delta_values.c.delta)
+        .execution_options(synchronize_session=False)
+    )
+    return created
+
+
+async def _replay(session: AsyncSession, replayed: list[str]) -> dict[str, Transaction]:
+    """The existing rows of keys claimed before this batch."""
+    if not replayed:
+        return {}
+    existing = await session.scalars(select_by_transaction_id(*replayed))
+    return {transaction.transaction_id: transaction for transaction in existing}
+
+
+def _outcome(
+    item: _Pending, created: dict[str, Transaction], rejected: dict[str, PaymentError],
+) -> Transaction | Exception:
+    """The item's row, or why it has none."""
+    if item.tx_id in rejected:
+        return rejected[item.tx_id]
+    transaction = created.get(item.tx_id)
+    # An archived transaction's key stays claimed, but the row is no longer here
+    if transaction is None or not is_replay_of(transaction, item.data, item.user):
+        return PaymentError("Transaction already exists")
+    return transaction
@@ -0,0 +1,176 @@
+import base64
+import binascii
+import typing
+from datetime import datetime
+
+from fastapi import HTTPException
+from sqlalchemy import Select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.future import select
+from starlette import status
+
+from app import schemas
+from app.archive import ArchivedTransaction, iter_history
+from app.custom_types import TransactionType
+from app.exceptions import ArchiveMovedError
+from app.models import Transaction, User
+from app.repositories.archive import get_archive_location, get_archives, read_table_history
+
+
+STREAM_BATCH_SIZE: typing.Final = 1000
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{row_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor") from e
+
+
+def history_query(
+    user_id: int,
+    type_: TransactionType | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    cursor: str | None = None,
+) -> Select[typing.Any]:
+    """A user's ledger in (created_at, id) order, served by ix_transactions_user_id_created_at_id.
+
+    Every row also carries the wallet's currency (an InitPlan, looked up once), which
+    its amount's minor units are in.
+    """
+    currency = select(User.currency).where(User.id == user_id).scalar_subquery().label("currency")
+    stmt = select(
+        Transaction.id, Transaction.transaction_id, Transaction.amount, Transaction.type, Transaction.created_at,
+        Transaction.correlation_id, currency,
+    )\
+        .where(Transaction.user_id == user_id)\
+        .order_by(Transaction.created_at, Transaction.id)
+    if type_ is not None:
+        stmt = stmt.where(Transaction.type == type_)
+    if since is not None:
+        stmt = stmt.where(Transaction.created_at >= since)
+    if until is not None:
+        stmt = stmt.where(Transaction.created_at < until)
+    if cursor is not None:
+        stmt = stmt.where(tuple_(Transaction.created_at, Transaction.id) > decode_cursor(cursor))
+    return stmt
+
+
+async def get_archived_history(
+    session: AsyncSession,
+    session_maker: async_sessionmaker[AsyncSession],
+    user_id: int,
+    type_: TransactionType | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    cursor: str | None = None,
+) -> typing.AsyncIterator[ArchivedTransaction] | None:
+    """The rows of the user's history_query that are in archived partitions; None if none can hold any.
+
+    They all come before the rows still in transactions. Read lazily, see iter_archives,
+    which is why it takes session_maker.
+    """
+    # Naive datetimes are local time, as datetime.fromtimestamp gives them
+    since, until = (moment.astimezone() if moment is not None else None for moment in (since, until))
+    after = decode_cursor(cursor) if cursor is not None else None
+    starts = [moment for moment in (since, after[0] if after is not None else None) if moment is not None]
+    names = await get_archives(session, max(starts, default=None), until)
+    if not names:
+        return None
+    currency = await session.scalar(select(User.currency).where(User.id == user_id))
+    if currency is None:
+        return None
+    return iter_archives(session_maker, names, user_id, currency, type_=type_, since=since, until=until, after=after)
+
+
+async def iter_archives(
+    session_maker: async_sessionmaker[AsyncSession],
+    partition_names: list[str],
+    user_id: int,
+    currency: str,
+    type_: TransactionType | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    after: tuple[datetime, int] | None = None,
+) -> typing.AsyncIterator[ArchivedTransaction]:
+    """The user's rows of consecutive archived partitions, in order, filtered like read_history.
+
+    A partition that's exported is read from its file. One that isn't yet is read from
+    its table STREAM_BATCH_SIZE rows at a time, each batch in a short session of its
+    own, so nothing is held open between batches; and if the table has moved on in
+    between, the reading picks up where it left off, from wherever the rows are by
+    then. One still attached has nothing to add: its rows are in transactions.
+    """
+    for name in partition_names:
+        while True:
+            async with session_maker() as session:
+                file_path, schema = await get_archive_location(session, name)
+                if schema is not None:
+                    try:
+                        rows = await read_table_history(
+                            session, f"{schema}.{name}", user_id, currency, STREAM_BATCH_SIZE,
+                            type_=type_, since=since, until=until, after=after,
+                        )
+                    except ArchiveMovedError:
+                        continue
+            if file_path is not None:
+                async for row in iter_history(
+                    [file_path], user_id, currency, type_=type_, since=since, until=until, after=after,
+                ):
+                    yield row
+                break
+            if schema is None:
+                break
+            for row in rows:
+                yield row
+            if len(rows) < STREAM_BATCH_SIZE:
+                break
+            after = (rows[-1].created_at, rows[-1].id)
+
+
+async def get_history_page(
+    session: AsyncSession,
+    stmt: Select[typing.Any],
+    limit: int,
+    archived: typing.AsyncIterator[ArchivedTransaction] | None = None,
+) -> schemas.TransactionPage:
+    """A page of stmt's rows, preceded by those of archived (see get_archived_history) if any."""
+    rows: list[typing.Any] = []
+    if archived is not None:
+        async for row in archived:
+            rows.append(row)
+            if len(rows) > limit:
+                break
+    if len(rows) <= limit:
+        rows += (await session.execute(stmt.limit(limit + 1 - len(rows)))).all()
+    next_cursor = encode_cursor(rows[limit - 1].created_at, rows[limit - 1].id) if len(rows) > limit else None
+    return schemas.TransactionPage(
+        items=[schemas.Transaction.from_ledger(row, row.currency) for row in rows[:limit]],
+        next_cursor=next_cursor,
+    )
+
+
+async def stream_history(
+    session_maker: async_sessionmaker[AsyncSession],
+    stmt: Select[typing.Any],
+    archived: typing.AsyncIterator[ArchivedTransaction] | None = None,
+) -> typing.AsyncIterator[str]:
+    """Yield the history as NDJSON lines, the archived rows first, the rest read through a server-side cursor.
+
+    Opens its own session: the response body is produced after the request-scoped
+    session has been closed.
+    """
+    if archived is not None:
+        async for row in archived:
+            yield schemas.Transaction.from_ledger(row, row.currency).model_dump_json() + "\n"
+    async with session_maker() as session:
+        async with session.begin():
+            result = await session.stream(stmt.execution_options(yield_per=STREAM_BATCH_SIZE))
+            async for row in result:
+                yield schemas.Transaction.from_ledger(row, row.currency).model_dump_json() + "\n"
@@ -0,0 +1,309 @@
+import typing
+from uuid import uuid4
+
+import pydantic
+import sqlalchemy as sa
+from sqlalchemy import case, delete, exists, func, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.future import select
+
+from app import schemas
+from app.custom_types import RejectionReason, TransactionType
+from app.models import BalanceCheckpoint, Transaction, TransactionArchive, TransactionKey, User
+from app.money import currency_scale
+from app.repositories.balance_slots import consolidate_slots, lock_users
+
+
+# Per-batch staging table, loaded with COPY and dropped when the batch commits
+STAGING: typing.Final = sa.Table(
+    "transaction_staging",
+    sa.MetaData(),
+    sa.Column("line", sa.Integer, primary_key=True),
+    sa.Column("transaction_id", sa.String, nullable=False),
+    sa.Column("user_id", sa.Integer, nullable=False),
+    sa.Column("type", sa.String, nullable=False),
+    sa.Column("amount", sa.Numeric, nullable=False),
+    sa.Column("created_at", sa.DateTime(timezone=True)),
+    # amount in minor units of the wallet's currency, filled in by _convert_amounts
+    sa.Column("amount_minor", sa.BigInteger),
+    sa.Column("rejection", sa.String),
+    # position among the wallet's pending rows, filled in by _reject_overdrafts
+    sa.Column("seq", sa.Integer),
+    sa.Index("ix_transaction_staging_user_id_seq", "user_id", "seq"),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+COPY_COLUMNS: typing.Final = ["line", "transaction_id", "user_id", "type", "amount", "created_at"]
+
+pending = STAGING.c.rejection.is_(None)
+
+
+def signed_amount(staged: typing.Any) -> typing.Any:
+    """The staged row's amount_minor, negated for a withdrawal; staged is a row source's columns."""
+    return case((staged.type == TransactionType.WITHDRAW.value, -staged.amount_minor), else_=staged.amount_minor)
+
+
+async def iter_lines(chunks: typing.AsyncIterable[bytes]) -> typing.AsyncIterator[bytes]:
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+
+async def ingest_ndjson(
+    session_maker: async_sessionmaker[AsyncSession],
+    lines: typing.AsyncIterable[bytes],
+    batch_size: int,
+) -> schemas.IngestReport:
+    """Load NDJSON transactions in batches of batch_size, one DB transaction per batch.
+
+    Rows that can't be applied are reported back by line number instead of failing
+    the batch they're in.
+    """
+    report = schemas.IngestReport()
+    batch: list[tuple[typing.Any, ...]] = []
+    line_number = 0
+
+    async for line in lines:
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            item = schemas.TransactionIngest.model_validate_json(line)
+        except pydantic.ValidationError:
+            report.rejected.append(
+                schemas.IngestRejection(line=line_number, transaction_id=None, reason=RejectionReason.INVALID)
+            )
+            continue
+
+        batch.append(
+            (line_number, item.uid or str(uuid4()), item.user_id, item.type.value, item.amount, item.created_at)
+        )
+        if len(batch) >= batch_size:
+            await ingest_batch(session_maker, batch, report)
+            batch = []
+
+    if batch:
+        await ingest_batch(session_maker, batch, report)
+
+    report.rejected.sort(key=lambda rejection: rejection.line)
+    return report
+
+
+async def ingest_batch(
+    session_maker: async_sessionmaker[AsyncSession],
+    rows: list[tuple[typing.Any, ...]],
+    report: schemas.IngestReport,
+) -> None:
+    async with session_maker() as session:
+        async with session.begin():
+            connection = await session.connection()
+            await connection.run_sync(STAGING.create, checkfirst=False)
+            raw_connection = await connection.get_raw_connection()
+            await raw_connection.driver_connection.copy_records_to_table(
+                STAGING.name, records=rows, columns=COPY_COLUMNS,
+            )
+
+            await _lock_archives(session)
+            await _reject_unknown_users(session)
+            await _convert_amounts(session)
+            await _reject_out_of_range(session)
+            await _reject_duplicates(session)
+            await _claim_keys(session)
+            await _lock_users(session)
+            await _reject_overdrafts(session)
+            await _apply(session)
+
+            result = await session.execute(
+                select(STAGING.c.line, STAGING.c.transaction_id, STAGING.c.rejection)
+                .where(STAGING.c.rejection.is_not(None))
+            )
+            rejected = [
+                schemas.IngestRejection(line=line, transaction_id=tx_id, reason=RejectionReason(reason))
+                for line, tx_id, reason in result
+            ]
+
+    report.accepted += len(rows) - len(rejected)
+    report.rejected.extend(rejected)
+
+
+async def _reject(session: AsyncSession, reason: RejectionReason, *criteria: typing.Any) -> int:
+    result = await session.execute(update(STAGING).where(pending, *criteria).values(rejection=reason.value))
+    return result.rowcount
+
+
+async def _lock_archives(session: AsyncSession) -> None:
+    # Batches share this lock; archiving a partition waits for them, so no batch can
+    # write into a partition after its balances were checkpointed for archival
+    await session.execute(sa.text(f"LOCK TABLE {TransactionArchive.__tablename__} IN SHARE MODE"))
+
+
+async def _reject_unknown_users(session: AsyncSession) -> None:
+    await _reject(session, RejectionReason.UNKNOWN_USER, ~exists().where(User.id == STAGING.c.user_id))
+
+
+async def _convert_amounts(session: AsyncSession) -> None:
+    """Turn amounts into minor units of the wallet's currency, rejecting those too precise for it."""
+    scaled = STAGING.c.amount * func.power(sa.cast(10, sa.Numeric), currency_scale(User.currency))
+    await session.execute(
+        update(STAGING)
+        .where(pending)
+        .where(User.id == STAGING.c.user_id)
+        .where(scaled == func.trunc(scaled))
+        .values(amount_minor=sa.cast(scaled, sa.BigInteger))
+    )
+    await _reject(session, RejectionReason.INVALID, STAGING.c.amount_minor.is_(None))
+
+
+async def _reject_out_of_range(session: AsyncSession) -> None:
+    horizon = select(func.max(TransactionArchive.range_end)).scalar_subquery()
+    await _reject(
+        session,
+        RejectionReason.OUT_OF_RANGE,
+        (STAGING.c.created_at > func.now()) | (STAGING.c.created_at <= horizon),
+    )
+
+
+async def _reject_duplicates(session: AsyncSession) -> None:
+    earlier = STAGING.alias("earlier")
+    await _reject(
+        session,
+        RejectionReason.DUPLICATE,
+        exists().where(earlier.c.transaction_id == STAGING.c.transaction_id, earlier.c.line < STAGING.c.line),
+    )
+
+
+async def _claim_keys(session: AsyncSession) -> None:
+    """Claim the keys of the pending rows, rejecting those already taken as duplicates.
+
+    A key claimed by a concurrent batch or payment waits for it to commit and then
+    counts as taken, instead of failing the batch. Keys are claimed in order and
+    before any wallet is locked, like add_transaction does, so batches can't deadlock
+    on them. Rows rejected later give their keys back in _apply.
+    """
+    # now() is fixed for the DB transaction, so undated rows get the same created_at in _apply
+    claimed = insert(TransactionKey)\
+        .from_select(
+            ["transaction_id", "created_at"],
+            select(STAGING.c.transaction_id, func.coalesce(STAGING.c.created_at, func.now()))
+            .where(pending)
+            .order_by(STAGING.c.transaction_id),
+        )\
+        .on_conflict_do_nothing(index_elements=["transaction_id"])\
+        .returning(TransactionKey.transaction_id)\
+        .cte("claimed")
+    await _reject(
+        session,
+        RejectionReason.DUPLICATE,
+        STAGING.c.transaction_id.not_in(select(claimed.c.transaction_id)),
+    )
+
+
+async def _lock_users(session: AsyncSession) -> None:
+    # Lock in id order so concurrent batches touching the same wallets can't deadlock
+    await lock_users(session, select(STAGING.c.user_id).where(pending))
+    # Overdrafts are checked against users.balance, so sharded wallets that withdraw have their slots moved there
+    await consolidate_slots(
+        session,
+        select(STAGING.c.user_id).where(pending).where(STAGING.c.type == TransactionType.WITHDRAW.value),
+    )
+
+
+async def _reject_overdrafts(session: AsyncSession) -> None:
+    """Reject withdrawals that would take a wallet below zero, in file order, in one pass.
+
+    A recursive walk goes down each withdrawing wallet's pending rows in line order,
+    carrying the balance: a row that would take it below zero is rejected and leaves
+    it as it was, so later rows are judged without it. Rows are numbered per wallet
+    first, so each step is an index lookup of the next row.
+    """
+    numbered = select(
+        STAGING.c.line,
+        func.row_number().over(partition_by=STAGING.c.user_id, order_by=STAGING.c.line).label("seq"),
+    )\
+        .where(pending)\
+        .where(STAGING.c.user_id.in_(
+            select(STAGING.c.user_id).where(pending).where(STAGING.c.type == TransactionType.WITHDRAW.value)
+        ))\
+        .subquery()
+    await session.execute(update(STAGING).where(STAGING.c.line == numbered.c.line).values(seq=numbered.c.seq))
+
+    opening = User.balance + signed_amount(STAGING.c)
+    walk = select(
+        STAGING.c.user_id,
+        STAGING.c.seq,
+        STAGING.c.line,
+        (opening < 0).label("overdrawn"),
+        case((opening < 0, User.balance), else_=opening).label("balance"),
+    )\
+        .join(User, User.id == STAGING.c.user_id)\
+        .where(STAGING.c.seq == 1)\
+        .cte("walk", recursive=True)
+    following = STAGING.alias("following")
+    after = walk.c.balance + signed_amount(following.c)
+    walk = walk.union_all(
+        select(
+            following.c.user_id,
+            following.c.seq,
+            following.c.line,
+            (after < 0).label("overdrawn"),
+            case((after < 0, walk.c.balance), else_=after).label("balance"),
+        )
+        .join(walk, (following.c.user_id == walk.c.user_id) & (following.c.seq == walk.c.seq + 1))
+    )
+    await _reject(
+        session, RejectionReason.INSUFFICIENT_FUNDS, STAGING.c.line.in_(select(walk.c.line).where(walk.c.overdrawn)),
+    )
+
+
+async def _apply(session: AsyncSession) -> None:
+    """Insert the accepted rows, apply per-user balance deltas and release unused keys in one statement.
+
+    The keys released are those of rows rejected after _claim_keys, i.e. overdrafts.
+    """
+    accepted = select(STAGING).where(pending).cte("accepted")
+    released = delete(TransactionKey)\
+        .where(TransactionKey.transaction_id == STAGING.c.transaction_id)\
+        .where(STAGING.c.rejection == RejectionReason.INSUFFICIENT_FUNDS.value)\
+        .cte("released")
+    inserted = insert(Transaction)\
+        .from_select(
+            [
+                Transaction.transaction_id, Transaction.user_id, Transaction.type, Transaction.amount,
+                Transaction.created_at,
+            ],
+            select(
+                accepted.c.transaction_id,
+                accepted.c.user_id,
+                sa.cast(accepted.c.type, Transaction.type.type),
+                accepted.c.amount_minor,
+                func.coalesce(accepted.c.created_at, func.now()),
+            ),
+        )\
+        .cte("inserted")
+
+    deltas = select(
+        accepted.c.user_id,
+        func.sum(signed_amount(accepted.c)).label("delta"),
+        func.min(func.coalesce(accepted.c.created_at, func.now())).label("earliest"),
+    )\
+        .group_by(accepted.c.user_id)\
+        .cte("deltas")
+    credited = update(User)\
+        .where(User.id == deltas.c.user_id)\
+        .values(balance=User.balance + deltas.c.delta)\
+        .cte("credited")
+
+    # Backdated rows make later checkpoints stale; they get rebuilt on the next run
+    stmt = delete(BalanceCheckpoint)\
+        .where(BalanceCheckpoint.user_id == deltas.c.user_id)\
+        .where(BalanceCheckpoint.as_of >= deltas.c.earliest)\
+        .add_cte(released)\
+        .add_cte(inserted)\
+        .add_cte(credited)
+    await session.execute(stmt)
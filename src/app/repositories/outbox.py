@@ -0,0 +1,82 @@
+import typing
+from datetime import datetime
+
+from sqlalchemy import delete, func, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.models import OutboxEvent
+
+
+# First key of the transaction-level advisory locks dispatchers hold on the users they deliver for
+OUTBOX_LOCK_NAMESPACE: typing.Final = 0x6F7574
+# The statement trigger on transactions that writes the events
+OUTBOX_TRIGGER: typing.Final = "transactions_outbox"
+# Those of the users whose advisory lock no other dispatcher holds, now locked
+LOCK_USERS = text(
+    "SELECT user_id FROM unnest(CAST(:user_ids AS integer[])) AS user_id "
+    "WHERE pg_try_advisory_xact_lock(:namespace, user_id)"
+)
+TRIGGER_ENABLED = text(
+    "SELECT tgenabled <> 'D' FROM pg_trigger WHERE tgrelid = CAST('transactions' AS regclass) AND tgname = :name"
+)
+
+
+async def claim_events(session: AsyncSession, limit: int) -> list[OutboxEvent]:
+    """The oldest undelivered events, in id order, locked until the session's transaction ends.
+
+    A user's events are only ever claimed by one dispatcher at a time: a dispatcher
+    first takes the advisory locks of the users of the oldest events, once per user
+    in a statement of its own, then claims only those users' events, so a later
+    event can't overtake an earlier one that's committed. Writes to a wallet sharded
+    over balance slots don't lock its users row, though, so its events can commit,
+    and be delivered, out of id order.
+    """
+    oldest = select(OutboxEvent.user_id).order_by(OutboxEvent.id).limit(limit).subquery()
+    user_ids = list(await session.scalars(select(oldest.c.user_id).distinct()))
+    if not user_ids:
+        return []
+    locked = list(await session.scalars(LOCK_USERS, {"namespace": OUTBOX_LOCK_NAMESPACE, "user_ids": user_ids}))
+    if not locked:
+        return []
+    result = await session.execute(
+        select(OutboxEvent)
+        .where(OutboxEvent.user_id.in_(locked))
+        .order_by(OutboxEvent.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    return list(result.scalars())
+
+
+async def delete_events(session: AsyncSession, ids: list[int]) -> None:
+    await session.execute(delete(OutboxEvent).where(OutboxEvent.id.in_(ids)))
+
+
+async def get_backlog(session: AsyncSession) -> tuple[int, datetime | None]:
+    """(events, created_at of the oldest) not yet delivered.
+
+    The count is the span of ids between the oldest and the newest event, read off
+    both ends of the primary key instead of counting; events delivered out of id
+    order make it an overestimate.
+    """
+    oldest = select(OutboxEvent.id, OutboxEvent.created_at).order_by(OutboxEvent.id).limit(1).subquery()
+    newest = select(func.max(OutboxEvent.id)).scalar_subquery()
+    row = (await session.execute(select(newest - oldest.c.id + 1, oldest.c.created_at))).first()
+    return (row[0], row[1]) if row is not None else (0, None)
+
+
+async def is_outbox_enabled(session: AsyncSession) -> bool:
+    """Whether ledger writes add outbox events; off until enabled, see app.commands.outbox."""
+    return bool(await session.scalar(TRIGGER_ENABLED, {"name": OUTBOX_TRIGGER}))
+
+
+async def set_outbox_enabled(session: AsyncSession, enabled: bool) -> None:
+    """Turn writing outbox events on or off; waits for, and briefly blocks, writes to transactions."""
+    action = "ENABLE" if enabled else "DISABLE"
+    await session.execute(text(f"ALTER TABLE transactions {action} TRIGGER {OUTBOX_TRIGGER}"))
+
+
+async def purge_events(session: AsyncSession) -> int:
+    """Delete every undelivered event; returns how many."""
+    return (await session.execute(delete(OutboxEvent))).rowcount
@@ -0,0 +1,123 @@
+import dataclasses
+import logging
+import re
+from datetime import datetime, timezone
+
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.future import select
+
+from app.models import TransactionArchive
+from app.repositories.archive import ARCHIVE_SCHEMA
+from app.repositories.checkpoints import create_checkpoints
+
+
+logger = logging.getLogger(__name__)
+
+PARENT = "transactions"
+
+PARTITIONS = text(
+    "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), i.inhdetachpending "
+    "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+    "WHERE i.inhparent = CAST(:parent AS regclass)"
+)
+BOUND = re.compile(r"FROM \((?:MINVALUE|'([^']+)')\) TO \('([^']+)'\)")
+
+
+@dataclasses.dataclass(frozen=True)
+class Partition:
+    name: str
+    start: datetime | None
+    end: datetime
+    detach_pending: bool
+
+
+def month_start(moment: datetime) -> datetime:
+    return moment.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    year, month_index = divmod(month.year * 12 + month.month - 1 + months, 12)
+    return month.replace(year=year, month=month_index + 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"{PARENT}_y{month.year:04d}m{month.month:02d}"
+
+
+async def list_partitions(session: AsyncSession) -> list[Partition]:
+    partitions = []
+    for name, bound, detach_pending in await session.execute(PARTITIONS, {"parent": PARENT}):
+        start, end = BOUND.search(bound).groups()
+        partitions.append(Partition(
+            name=name,
+            start=datetime.fromisoformat(start) if start else None,
+            end=datetime.fromisoformat(end),
+            detach_pending=detach_pending,
+        ))
+    return sorted(partitions, key=lambda partition: partition.end)
+
+
+async def ensure_partitions(session: AsyncSession, now: datetime, months_ahead: int) -> list[str]:
+    """Create the monthly partitions from the current month to months_ahead months out.
+
+    Each is created as a plain table and then attached, which only takes a SHARE
+    UPDATE EXCLUSIVE lock on transactions, so reads and writes carry on meanwhile.
+    """
+    existing = {partition.start for partition in await list_partitions(session)}
+    created = []
+    current = month_start(now)
+    for offset in range(months_ahead + 1):
+        start = add_months(current, offset)
+        if start in existing:
+            continue
+
+        name = partition_name(start)
+        await session.execute(text(f"CREATE TABLE {name} (LIKE {PARENT} INCLUDING DEFAULTS)"))
+        await session.execute(text(
+            f"ALTER TABLE {PARENT} ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{add_months(start, 1).isoformat()}')"
+        ))
+        created.append(name)
+    return created
+
+
+async def archive_partitions(
+    engine: AsyncEngine, session: AsyncSession, now: datetime, hot_months: int,
+) -> list[str]:
+    """Detach partitions that ended more than hot_months ago and move them to the archive schema.
+
+    For each one, first (in the session's transaction) record it in transaction_archives
+    and checkpoint every balance at its end, so balances stay correct without its rows.
+    Recording it waits for in-flight bulk ingests, which hold a SHARE lock on that
+    table, and makes later ingests reject rows dated inside it. Then detach it
+    concurrently, outside of any transaction, so live traffic is never blocked.
+    """
+    cutoff = add_months(month_start(now), -hot_months)
+    cold = [partition for partition in await list_partitions(session) if partition.end <= cutoff]
+    if not cold:
+        return []
+
+    await session.execute(
+        insert(TransactionArchive)
+        .values([
+            {"partition_name": partition.name, "range_start": partition.start, "range_end": partition.end}
+            for partition in cold
+        ])
+        .on_conflict_do_nothing(index_elements=["partition_name"])
+    )
+    horizon = await session.scalar(select(func.max(TransactionArchive.range_end)))
+    await create_checkpoints(session, horizon)
+    await session.commit()
+
+    async with engine.connect() as connection:
+        autocommit = await connection.execution_options(isolation_level="AUTOCOMMIT")
+        for partition in cold:
+            # An interrupted earlier run leaves the detach pending; it can only be finalized
+            mode = "FINALIZE" if partition.detach_pending else "CONCURRENTLY"
+            await autocommit.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {partition.name} {mode}"))
+            await autocommit.execute(text(f"ALTER TABLE {partition.name} SET SCHEMA {ARCHIVE_SCHEMA}"))
+            logger.info("Archived %s (up to %s)", partition.name, partition.end.isoformat())
+
+    return [partition.name for partition in cold]
@@ -1,78 +1,203 @@
+import typing
 from typing import Self
 from uuid import uuid4
 
 from fastapi import HTTPException
+from sqlalchemy import Select, and_, func, literal, true, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.future import select
-from sqlalchemy.ext.asyncio import (
-    async_sessionmaker,
-    AsyncSession as AsyncSessionType,
-)
+from sqlalchemy.orm import aliased
+from sqlalchemy.ext.asyncio import AsyncSession as AsyncSessionType
 
 from app import schemas
-from app.models import User, Transaction
-from app.repositories.utils import hash_password, change_balance, balance_strategy
-from app.schemas import TransactionAdd
+from app.archive import ArchivedTransaction
+from app.cache import VersionedCache
+from app.custom_types import TransactionType
+from app.exceptions import PaymentError
+from app.models import BalanceSlot, User, Transaction, TransactionKey
+from app.money import Balance
+from app.repositories.balance_slots import consolidate_slots, lock_users, total_balance
+from app.repositories.history import get_history_page
+from app.repositories.utils import balance_strategy
+
+
+def select_by_transaction_id(*tx_ids: str) -> Select[tuple[Transaction]]:
+    # created_at from the key lets the planner skip every other partition at run time
+    return select(Transaction)\
+        .join(TransactionKey, and_(
+            TransactionKey.transaction_id == Transaction.transaction_id,
+            TransactionKey.created_at == Transaction.created_at,
+        ))\
+        .where(TransactionKey.transaction_id.in_(tx_ids))
+
+
+def is_replay_of(transaction: Transaction, data: schemas.TransactionEntry, user: schemas.Principal) -> bool:
+    """Whether a request reusing transaction's idempotency key asks for the same thing."""
+    return (transaction.user_id, transaction.type, transaction.amount) == (user.id, data.type, data.amount)
 
 
 class PaymentRepository:
 
-    def __init__(self, db_session_maker: async_sessionmaker[AsyncSessionType]):
-        self.db_session_maker = db_session_maker
+    def __init__(self, db_session: AsyncSessionType):
+        # Request-scoped session; the caller owns its transaction
+        self.db_session = db_session
 
-    async def create_user(self, payment_repo: Self, data: schemas.UserCreate) -> User:
-        async with payment_repo.db_session_maker() as session:
-            async with session.begin():
-                result = await session.execute(select(User).filter_by(email=data.email))
-                existing_user = result.scalars().first()
-                if existing_user:
-                    raise HTTPException(status_code=409, detail="User already exists")
+    async def create_user(self, payment_repo: Self, data: schemas.UserCreate, hashed_password: str) -> User:
+        session = payment_repo.db_session
+        result = await session.execute(select(User).filter_by(email=data.email))
+        existing_user = result.scalars().first()
+        if existing_user:
+            raise HTTPException(status_code=409, detail="User already exists")
 
-                hashed_password = hash_password(data.password)
-                new_user = User(name=data.name, email=data.email, hashed_password=hashed_password)
-                session.add(new_user)
-            await session.commit()
+        new_user = User(name=data.name, email=data.email, hashed_password=hashed_password, currency=data.currency)
+        session.add(new_user)
+        await session.flush()
 
         return new_user
 
     async def get_user_balance(self, payment_repo: Self, user_id: str, ts: int):
-        async with payment_repo.db_session_maker() as session:
-            async with session.begin():
-                balance_method = balance_strategy[bool(ts)]
-                balance = await balance_method(payment_repo, user_id=user_id, ts=ts)
-            await session.commit()
-
+        balance_method = balance_strategy[bool(ts)]
+        return await balance_method(payment_repo, user_id=user_id, ts=ts)
+
+    async def get_cached_balance(
+        self, payment_repo: Self, user_id: int, balance_cache: VersionedCache[int, Balance],
+    ) -> Balance | None:
+        balance = balance_cache.get(user_id)
+        if balance is not None:
+            return balance
+
+        generation = balance_cache.generation
+        row = (await payment_repo.db_session.execute(
+            select(total_balance, User.currency, User.balance_version, User.balance_slots).where(User.id == user_id)
+        )).first()
+        if row is None or row[0] is None:
+            return None
+        amount, currency, version, slots = row
+        balance = Balance(amount, currency)
+        # Slot writes don't touch users, so a sharded wallet's balance has no version to go by
+        if not slots:
+            balance_cache.set(user_id, balance, version, generation)
         return balance
 
-    async def add_transaction(self, payment_repo: Self, data: TransactionAdd, user: User) -> Transaction:
-        async with payment_repo.db_session_maker() as session:
-            async with session.begin():
-                tx_id = str(uuid4())
-                # Check if a transaction with such id already exists
-                result = await session.execute(select(Transaction).filter_by(transaction_id=tx_id))
-                existing_transaction = result.scalars().first()
-                if existing_transaction:
-                    raise HTTPException(status_code=409, detail="Transaction already exists")
-
-                new_transaction = Transaction(
-                    amount=data.amount,
-                    type=data.type,
-                    transaction_id=tx_id,
-                    user=user
-                )
-                await change_balance(user, data)
-                session.add(new_transaction)
-            await session.commit()
-
-        return new_transaction
-
-    async def get_transaction(self, payment_repo: Self, tx_id: str) -> Transaction:
-        async with payment_repo.db_session_maker() as session:
-            async with session.begin():
-                result = await session.execute(select(Transaction).filter_by(transaction_id=tx_id))
-                transaction = result.scalars().first()
-                if not transaction:
-                    raise HTTPException(status_code=404, detail="Transaction not found")
-
-            await session.commit()
-
+    async def add_transaction(
+        self, payment_repo: Self, data: schemas.TransactionEntry, user: schemas.Principal,
+    ) -> Transaction:
+        delta = -data.amount if data.type == TransactionType.WITHDRAW else data.amount
+        tx_id = data.uid or str(uuid4())
+
+        # Key claim, ledger insert and guarded balance update in one statement. A retried
+        # idempotency key conflicts on transaction_keys and inserts nothing, so the balance
+        # is not touched again; an overdraft returns the row with applied=false and is
+        # rolled back. A sharded wallet's users row is left alone and one of its unlocked
+        # slots that covers the amount is updated instead.
+        key = insert(TransactionKey)\
+            .values(transaction_id=tx_id, created_at=func.now())\
+            .on_conflict_do_nothing(index_elements=["transaction_id"])\
+            .returning(TransactionKey.transaction_id, TransactionKey.created_at)\
+            .cte("key")
+        inserted = insert(Transaction)\
+            .from_select(
+                [
+                    Transaction.amount, Transaction.type, Transaction.transaction_id, Transaction.user_id,
+                    Transaction.created_at,
+                ],
+                select(
+                    literal(data.amount, Transaction.amount.type),
+                    literal(data.type, Transaction.type.type),
+                    key.c.transaction_id,
+                    literal(user.id),
+                    key.c.created_at,
+                ),
+            )\
+            .returning(*Transaction.__table__.c)\
+            .cte("inserted")
+        credited = update(User)\
+            .where(User.id == inserted.c.user_id)\
+            .where(User.balance_slots == 0)\
+            .where(User.balance + delta >= 0)\
+            .values(balance=User.balance + delta)\
+            .returning(User.id)\
+            .cte("credited")
+        picked = select(BalanceSlot.user_id, BalanceSlot.slot)\
+            .join(inserted, inserted.c.user_id == BalanceSlot.user_id)\
+            .where(BalanceSlot.balance + delta >= 0)\
+            .order_by(func.random())\
+            .limit(1)\
+            .with_for_update(of=BalanceSlot, skip_locked=True)\
+            .cte("picked")
+        slotted = update(BalanceSlot)\
+            .where(BalanceSlot.user_id == picked.c.user_id)\
+            .where(BalanceSlot.slot == picked.c.slot)\
+            .values(balance=BalanceSlot.balance + delta)\
+            .returning(BalanceSlot.user_id)\
+            .cte("slotted")
+        sharded = select(User.balance_slots > 0).where(User.id == user.id).scalar_subquery()
+        new_transaction = aliased(Transaction, inserted)
+        stmt = select(
+            new_transaction,
+            (credited.c.id.is_not(None) | slotted.c.user_id.is_not(None)).label("applied"),
+            sharded.label("sharded"),
+        )\
+            .select_from(inserted)\
+            .outerjoin(credited, true())\
+            .outerjoin(slotted, true())
+
+        row = (await payment_repo.db_session.execute(stmt)).first()
+        if row is None:
+            return await self._get_replayed_transaction(payment_repo.db_session, tx_id, data, user)
+        if not row.applied and not (row.sharded and await self._apply_to_consolidated(payment_repo, user.id, delta)):
+            # The caller's transaction rolls back the inserted row
+            raise PaymentError("Insufficient funds")
+
+        return row[0]
+
+    async def _apply_to_consolidated(self, payment_repo: Self, user_id: int, delta: int) -> bool:
+        """Fallback for a sharded wallet when no unlocked slot could take delta.
+
+        Applies it to users.balance, first moving the slots there for a withdrawal, so
+        the check is against the whole balance.
+        """
+        session = payment_repo.db_session
+        await lock_users(session, [user_id])
+        if delta < 0:
+            # The first statement may have locked a slot it then found too small, so
+            # waiting for slots here could deadlock with another fallback; the skipped
+            # ones only make the check stricter
+            await consolidate_slots(session, [user_id], skip_locked=True)
+        result = await session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .where(User.balance + delta >= 0)
+            .values(balance=User.balance + delta)
+            .returning(User.id)
+            .execution_options(synchronize_session=False)
+        )
+        return result.first() is not None
+
+    async def _get_replayed_transaction(
+        self, session: AsyncSessionType, tx_id: str, data: schemas.TransactionEntry, user: schemas.Principal,
+    ) -> Transaction:
+        transaction = (await session.execute(select_by_transaction_id(tx_id))).scalars().one()
+        if not is_replay_of(transaction, data, user):
+            raise PaymentError("Transaction already exists")
         return transaction
+
+    async def get_transaction_history(
+        self,
+        payment_repo: Self,
+        stmt: Select[typing.Any],
+        limit: int,
+        archived: typing.AsyncIterator[ArchivedTransaction] | None = None,
+    ) -> schemas.TransactionPage:
+        return await get_history_page(payment_repo.db_session, stmt, limit, archived)
+
+    async def get_transaction(self, payment_repo: Self, tx_id: str) -> schemas.Transaction:
+        result = await payment_repo.db_session.execute(
+            select_by_transaction_id(tx_id).add_columns(User.currency).join(User, User.id == Transaction.user_id)
+        )
+        row = result.first()
+        if not row:
+            raise HTTPException(status_code=404, detail="Transaction not found")
+
+        transaction, currency = row
+        return schemas.Transaction.from_ledger(transaction, currency)
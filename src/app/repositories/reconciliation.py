@@ -0,0 +1,120 @@
+import typing
+
+from sqlalchemy import BigInteger, Select, cast, func, literal_column, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.models import (
+    BalanceCheckpoint, ReconciliationMismatch, ReconciliationRun, Transaction, TransactionArchive, User,
+)
+from app.repositories.balance_slots import total_balance
+from app.repositories.utils import get_settled_watermark, signed_amount
+
+
+STREAM_BATCH_SIZE: typing.Final = 10_000
+# Mismatches are written in chunks of this many, so a badly drifted range stays bounded too
+MISMATCH_FLUSH_SIZE: typing.Final = 1000
+
+
+def ledger_query(start: int, end: int, since: int | None = None) -> Select[typing.Any]:
+    """(user_id, balance, ledger) of the wallets with ids in [start, end), in id order.
+
+    ledger is what the wallet's balance should be: its checkpoint at the archive
+    horizon, which stands in for the archived rows, plus the signed sum of the live
+    transactions after it. With since, only wallets with transactions of a higher
+    id are included. Being one statement, balances and ledger come from one snapshot.
+    """
+    horizon = select(func.max(TransactionArchive.range_end)).scalar_subquery()
+    # No checkpoint is used before anything has been archived: as_of <= NULL is never true
+    archived = select(BalanceCheckpoint.user_id, BalanceCheckpoint.balance)\
+        .where(BalanceCheckpoint.user_id >= start, BalanceCheckpoint.user_id < end)\
+        .where(BalanceCheckpoint.as_of <= horizon)\
+        .distinct(BalanceCheckpoint.user_id)\
+        .order_by(BalanceCheckpoint.user_id, BalanceCheckpoint.as_of.desc())\
+        .subquery("archived")
+    live = select(Transaction.user_id, cast(func.sum(signed_amount), BigInteger).label("total"))\
+        .where(Transaction.user_id >= start, Transaction.user_id < end)\
+        .where(Transaction.created_at > func.coalesce(horizon, literal_column("'-infinity'::timestamptz")))\
+        .group_by(Transaction.user_id)\
+        .subquery("live")
+
+    stmt = select(
+        User.id.label("user_id"),
+        total_balance.label("balance"),
+        (func.coalesce(archived.c.balance, 0) + func.coalesce(live.c.total, 0)).label("ledger"),
+    )\
+        .outerjoin(archived, archived.c.user_id == User.id)\
+        .outerjoin(live, live.c.user_id == User.id)\
+        .where(User.id >= start, User.id < end)\
+        .order_by(User.id)
+    if since is not None:
+        # Served by each partition's primary key, which leads with id
+        stmt = stmt.where(User.id.in_(
+            select(Transaction.user_id)
+            .where(Transaction.id > since)
+            .where(Transaction.user_id >= start, Transaction.user_id < end)
+        ))
+    return stmt
+
+
+async def reconcile_range(
+    session: AsyncSession, run_id: int, start: int, end: int, since: int | None = None,
+) -> tuple[int, int]:
+    """Check the wallets with ids in [start, end), recording mismatches; returns (checked, mismatched).
+
+    The rows are streamed through a server-side cursor, so memory stays bounded
+    however large the range.
+    """
+    checked = mismatched = 0
+    mismatches: list[dict[str, typing.Any]] = []
+    result = await session.stream(ledger_query(start, end, since).execution_options(yield_per=STREAM_BATCH_SIZE))
+    async for user_id, balance, ledger in result:
+        checked += 1
+        if balance == ledger:
+            continue
+        mismatched += 1
+        mismatches.append({"run_id": run_id, "user_id": user_id, "balance": balance, "ledger": ledger})
+        if len(mismatches) >= MISMATCH_FLUSH_SIZE:
+            await _record_mismatches(session, mismatches)
+            mismatches = []
+    await _record_mismatches(session, mismatches)
+    return checked, mismatched
+
+
+async def _record_mismatches(session: AsyncSession, mismatches: list[dict[str, typing.Any]]) -> None:
+    if mismatches:
+        # A range retried after a failure may report the same wallets again
+        await session.execute(insert(ReconciliationMismatch).on_conflict_do_nothing(), mismatches)
+
+
+async def start_run(session: AsyncSession, incremental: bool) -> ReconciliationRun:
+    """Record a new run, starting from the last finished run's watermark if incremental.
+
+    Waits for the transactions that may still commit ids below the new watermark,
+    see get_settled_watermark, so the next run can start right above it.
+    """
+    since = None
+    if incremental:
+        previous = await session.scalar(
+            select(ReconciliationRun.watermark)
+            .where(ReconciliationRun.finished_at.is_not(None))
+            .order_by(ReconciliationRun.id.desc())
+            .limit(1)
+        )
+        since = previous
+    run = ReconciliationRun(
+        since_watermark=since,
+        watermark=await get_settled_watermark(session),
+    )
+    session.add(run)
+    await session.flush()
+    return run
+
+
+async def finish_run(session: AsyncSession, run_id: int, checked: int, mismatched: int) -> None:
+    await session.execute(
+        update(ReconciliationRun)
+        .where(ReconciliationRun.id == run_id)
+        .values(finished_at=func.now(), users_checked=checked, mismatches=mismatched)
+    )
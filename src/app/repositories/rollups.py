@@ -0,0 +1,308 @@
+import typing
+from datetime import date, datetime, time, timedelta, timezone
+
+import sqlalchemy as sa
+from sqlalchemy import BigInteger, Date, and_, cast, func, literal, literal_column, or_, true, union, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased
+
+from app import schemas
+from app.custom_types import TransactionType
+from app.models import BalanceCheckpoint, DailyUserRollup, RollupRun, Transaction, TransactionArchive, User
+from app.money import Balance, from_minor_units
+from app.repositories.utils import get_settled_watermark, signed_amount
+
+
+ONE_DAY: typing.Final = timedelta(days=1)
+
+# The (user, day) rollups a run rewrites, dropped when it commits
+CHANGED_DAYS: typing.Final = sa.Table(
+    "rollup_changed_days",
+    sa.MetaData(),
+    sa.Column("user_id", sa.Integer, primary_key=True),
+    sa.Column("day", sa.Date, primary_key=True),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+
+# Days are UTC days
+transaction_day = cast(func.timezone("UTC", Transaction.created_at), Date)
+is_deposit = Transaction.type == TransactionType.DEPOSIT
+is_withdrawal = Transaction.type == TransactionType.WITHDRAW
+
+
+def day_start(day: date) -> datetime:
+    return datetime.combine(day, time.min, tzinfo=timezone.utc)
+
+
+def _day_start_column(day: typing.Any) -> typing.Any:
+    return func.timezone("UTC", cast(day, sa.DateTime), type_=Transaction.created_at.type)
+
+
+def _totals(*where: typing.Any) -> typing.Any:
+    """(deposits, withdrawals, deposit_count, withdrawal_count) columns of the transactions matching where."""
+    return select(
+        cast(func.coalesce(func.sum(Transaction.amount).filter(is_deposit), 0), BigInteger).label("deposits"),
+        cast(func.coalesce(func.sum(Transaction.amount).filter(is_withdrawal), 0), BigInteger).label("withdrawals"),
+        func.count().filter(is_deposit).label("deposit_count"),
+        func.count().filter(is_withdrawal).label("withdrawal_count"),
+    ).where(*where)
+
+
+async def start_run(session: AsyncSession, through: date, incremental: bool) -> RollupRun:
+    """Record a new run rolling up to through, continuing from the last finished run if incremental.
+
+    Waits for the transactions that may still commit ids below the new watermark,
+    see get_settled_watermark, so the next run can start right above it.
+    """
+    since_watermark = since_through = None
+    if incremental:
+        previous = (await session.execute(
+            select(RollupRun.watermark, RollupRun.through)
+            .where(RollupRun.finished_at.is_not(None))
+            .order_by(RollupRun.id.desc())
+            .limit(1)
+        )).first()
+        if previous is not None:
+            since_watermark, since_through = previous.watermark, previous.through
+    run = RollupRun(
+        since_watermark=since_watermark,
+        since_through=since_through,
+        watermark=await get_settled_watermark(session),
+        through=through,
+    )
+    session.add(run)
+    await session.flush()
+    return run
+
+
+async def roll_up(session: AsyncSession, run: RollupRun) -> int:
+    """Rewrite the rollups of the run's changed (user, day) pairs; returns how many.
+
+    A pair changed if it has a transaction after since_watermark, or is a day after
+    since_through; in a full run every day up to through did. Each is summed again
+    from its transactions, so rerunning a day is harmless. The closing balances of
+    a user's days from their first changed one on are then chained again from the
+    day before it, or from their checkpoint at the archive horizon.
+    """
+    connection = await session.connection()
+    await connection.run_sync(CHANGED_DAYS.create, checkfirst=False)
+
+    until = day_start(run.through + ONE_DAY)
+    changed = select(Transaction.user_id, transaction_day).where(Transaction.created_at < until)
+    if run.since_watermark is not None:
+        changed = union(
+            # Served by each partition's primary key, which leads with id
+            changed.where(Transaction.id > run.since_watermark),
+            # Only the newest partitions hold days that ended since the last run
+            changed.where(Transaction.created_at >= day_start(run.since_through + ONE_DAY)),
+        )
+    else:
+        changed = changed.distinct()
+    await session.execute(insert(CHANGED_DAYS).from_select([CHANGED_DAYS.c.user_id, CHANGED_DAYS.c.day], changed))
+
+    start = _day_start_column(CHANGED_DAYS.c.day)
+    totals = _totals()\
+        .add_columns(CHANGED_DAYS.c.user_id, CHANGED_DAYS.c.day, literal(0, BigInteger))\
+        .select_from(CHANGED_DAYS)\
+        .join(Transaction, and_(
+            Transaction.user_id == CHANGED_DAYS.c.user_id,
+            Transaction.created_at >= start,
+            Transaction.created_at < start + ONE_DAY,
+        ))\
+        .group_by(CHANGED_DAYS.c.user_id, CHANGED_DAYS.c.day)
+    stmt = insert(DailyUserRollup).from_select(
+        [
+            DailyUserRollup.deposits, DailyUserRollup.withdrawals, DailyUserRollup.deposit_count,
+            DailyUserRollup.withdrawal_count, DailyUserRollup.user_id, DailyUserRollup.day,
+            DailyUserRollup.closing_balance,
+        ],
+        totals,
+    )
+    # excluded is keyed by column name; closing balances are chained below
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "day"],
+        set_={
+            column: stmt.excluded[column]
+            for column in ("deposits_minor", "withdrawals_minor", "deposit_count", "withdrawal_count")
+        },
+    )
+    written = (await session.execute(stmt)).rowcount
+
+    first_days = select(CHANGED_DAYS.c.user_id, func.min(CHANGED_DAYS.c.day).label("day"))\
+        .group_by(CHANGED_DAYS.c.user_id)\
+        .subquery("first_days")
+    earlier = aliased(DailyUserRollup, name="earlier")
+    previous_closing = select(earlier.closing_balance)\
+        .where(earlier.user_id == first_days.c.user_id)\
+        .where(earlier.day < first_days.c.day)\
+        .order_by(earlier.day.desc())\
+        .limit(1)\
+        .scalar_subquery()
+    bases = select(
+        first_days.c.user_id,
+        first_days.c.day,
+        func.coalesce(previous_closing, _archived_balance(first_days.c.user_id), 0).label("balance"),
+    ).subquery("bases")
+    running = select(
+        DailyUserRollup.user_id,
+        DailyUserRollup.day,
+        cast(
+            bases.c.balance + func.sum(DailyUserRollup.deposits - DailyUserRollup.withdrawals).over(
+                partition_by=DailyUserRollup.user_id, order_by=DailyUserRollup.day,
+            ),
+            BigInteger,
+        ).label("closing_balance"),
+    )\
+        .join(bases, and_(bases.c.user_id == DailyUserRollup.user_id, DailyUserRollup.day >= bases.c.day))\
+        .subquery("running")
+    await session.execute(
+        update(DailyUserRollup)
+        .where(DailyUserRollup.user_id == running.c.user_id)
+        .where(DailyUserRollup.day == running.c.day)
+        .values(closing_balance=running.c.closing_balance)
+    )
+    return written
+
+
+async def finish_run(session: AsyncSession, run_id: int, days: int) -> None:
+    await session.execute(
+        update(RollupRun)
+        .where(RollupRun.id == run_id)
+        .values(finished_at=func.now(), days=days)
+    )
+
+
+async def get_rolled_through(session: AsyncSession) -> date | None:
+    """The last day rollups are complete for, as of the last finished run; None before any."""
+    return await session.scalar(
+        select(RollupRun.through)
+        .where(RollupRun.finished_at.is_not(None))
+        .order_by(RollupRun.id.desc())
+        .limit(1)
+    )
+
+
+def _archived_balance(user_id: typing.Any) -> typing.Any:
+    # No checkpoint is used before anything has been archived: as_of <= NULL is never true
+    horizon = select(func.max(TransactionArchive.range_end)).scalar_subquery()
+    return select(BalanceCheckpoint.balance)\
+        .where(BalanceCheckpoint.user_id == user_id)\
+        .where(BalanceCheckpoint.as_of <= horizon)\
+        .order_by(BalanceCheckpoint.as_of.desc())\
+        .limit(1)\
+        .scalar_subquery()
+
+
+def _balance_before(user_id: int, at: datetime, rolled_through: date | None) -> typing.Any:
+    """The user's balance from the transactions before at.
+
+    The closing balance of their last rolled-up day before at's, plus the
+    transactions from the start of at's day, or from the first day not rolled up
+    if at is past them. Rollups cover every day with transactions, so a user with
+    none before then has nothing but their archived balance.
+    """
+    if rolled_through is None:
+        base = _archived_balance(user_id)
+        since = Transaction.created_at > func.coalesce(
+            select(func.max(TransactionArchive.range_end)).scalar_subquery(),
+            literal_column("'-infinity'::timestamptz"),
+        )
+    else:
+        day = min(at.date(), rolled_through + ONE_DAY)
+        closing = select(DailyUserRollup.closing_balance)\
+            .where(DailyUserRollup.user_id == user_id)\
+            .where(DailyUserRollup.day < day)\
+            .order_by(DailyUserRollup.day.desc())\
+            .limit(1)\
+            .scalar_subquery()
+        base = func.coalesce(closing, _archived_balance(user_id))
+        since = Transaction.created_at >= day_start(day)
+
+    replayed = select(cast(func.sum(signed_amount), BigInteger))\
+        .where(Transaction.user_id == user_id)\
+        .where(since)\
+        .where(Transaction.created_at < at)\
+        .scalar_subquery()
+    return func.coalesce(base, 0) + func.coalesce(replayed, 0)
+
+
+async def get_statement(
+    session: AsyncSession, user_id: int, since: datetime, until: datetime,
+) -> schemas.Statement | None:
+    """The user's statement over [since, until); None if there is no such user.
+
+    Whole days that are rolled up are summed from their rollups, and only the
+    partial days at either end, and the days not rolled up yet, from transactions.
+    Transactions written into a day after it was rolled up count from the next run.
+    """
+    since, until = since.astimezone(timezone.utc), until.astimezone(timezone.utc)
+    rolled_through = await get_rolled_through(session)
+
+    first_day = since.date() if since == day_start(since.date()) else since.date() + ONE_DAY
+    end_day = until.date() if rolled_through is None else min(until.date(), rolled_through + ONE_DAY)
+    if rolled_through is not None and first_day < end_day:
+        rolled = select(
+            cast(func.coalesce(func.sum(DailyUserRollup.deposits), 0), BigInteger).label("deposits"),
+            cast(func.coalesce(func.sum(DailyUserRollup.withdrawals), 0), BigInteger).label("withdrawals"),
+            cast(func.coalesce(func.sum(DailyUserRollup.deposit_count), 0), BigInteger).label("deposit_count"),
+            cast(func.coalesce(func.sum(DailyUserRollup.withdrawal_count), 0), BigInteger).label("withdrawal_count"),
+        )\
+            .where(DailyUserRollup.user_id == user_id)\
+            .where(DailyUserRollup.day >= first_day, DailyUserRollup.day < end_day)\
+            .subquery("rolled")
+        edges = or_(
+            and_(Transaction.created_at >= since, Transaction.created_at < day_start(first_day)),
+            and_(Transaction.created_at >= day_start(end_day), Transaction.created_at < until),
+        )
+    else:
+        rolled = select(*(literal(0, BigInteger).label(name) for name in (
+            "deposits", "withdrawals", "deposit_count", "withdrawal_count",
+        ))).subquery("rolled")
+        edges = and_(Transaction.created_at >= since, Transaction.created_at < until)
+    raw = _totals(Transaction.user_id == user_id, edges).subquery("raw")
+
+    row = (await session.execute(
+        select(
+            User.currency,
+            _balance_before(user_id, since, rolled_through).label("opening_balance"),
+            (rolled.c.deposits + raw.c.deposits).label("deposits"),
+            (rolled.c.withdrawals + raw.c.withdrawals).label("withdrawals"),
+            (rolled.c.deposit_count + raw.c.deposit_count).label("deposit_count"),
+            (rolled.c.withdrawal_count + raw.c.withdrawal_count).label("withdrawal_count"),
+        )
+        .join(rolled, true())
+        .join(raw, true())
+        .where(User.id == user_id)
+    )).first()
+    if row is None:
+        return None
+
+    closing_balance = row.opening_balance + row.deposits - row.withdrawals
+    return schemas.Statement(
+        since=since,
+        until=until,
+        currency=row.currency,
+        opening_balance=from_minor_units(row.opening_balance, row.currency),
+        closing_balance=from_minor_units(closing_balance, row.currency),
+        deposits=from_minor_units(row.deposits, row.currency),
+        withdrawals=from_minor_units(row.withdrawals, row.currency),
+        deposit_count=row.deposit_count,
+        withdrawal_count=row.withdrawal_count,
+    )
+
+
+async def get_day_balance(session: AsyncSession, user_id: int, day: date) -> Balance | None:
+    """The user's balance at the end of a UTC day; None if there is no such user.
+
+    For a rolled-up day that is a single rollup lookup.
+    """
+    rolled_through = await get_rolled_through(session)
+    result = await session.execute(
+        select(_balance_before(user_id, day_start(day + ONE_DAY), rolled_through), User.currency)
+        .where(User.id == user_id)
+    )
+    row = result.first()
+    return Balance(*row) if row is not None else None
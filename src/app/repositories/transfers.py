@@ -0,0 +1,223 @@
+import typing
+from uuid import uuid4
+
+from sqlalchemy import BigInteger, Integer, String, any_, cast, column, func, literal, union_all, update, values
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased
+
+from app import schemas
+from app.custom_types import TransactionType
+from app.exceptions import PaymentError
+from app.models import BalanceSlot, Transaction, TransactionKey, User
+from app.repositories.balance_slots import lock_users
+from app.repositories.payment import select_by_transaction_id
+
+
+def leg_ids(correlation_id: str) -> tuple[str, str]:
+    """transaction_id of the debit and the credit leg of a transfer."""
+    return f"{correlation_id}:debit", f"{correlation_id}:credit"
+
+
+async def settle_transfers(
+    session: AsyncSession, transfers: list[schemas.TransferEntry],
+) -> list[tuple[Transaction, Transaction]]:
+    """Move money between wallets; returns the (debit, credit) legs of each transfer, in order.
+
+    All of them settle in one statement, and together: if one is refused the
+    caller's transaction has to roll back. Each transfer's uid (a new one if None)
+    is its idempotency key and the correlation id of its legs; a retried transfer
+    returns the legs written the first time.
+    """
+    correlation_ids = [transfer.uid or str(uuid4()) for transfer in transfers]
+    _check_batch(transfers, correlation_ids)
+
+    # In a statement of its own, so settle_query's snapshot is taken after the locks and its
+    # updates find the latest version of each wallet's row. Locked inside it, a row another
+    # writer changed meanwhile would be updated through its older, snapshot version, which
+    # can wait behind a transfer waiting for this one
+    await lock_users(session, wallet_ids(transfers))
+    rows = (await session.execute(settle_query(transfers, correlation_ids))).all()
+    if rows[0].short:
+        raise PaymentError(f"Insufficient funds in wallet {', '.join(map(str, rows[0].short))}")
+
+    legs, replayed = _written_legs(transfers, correlation_ids, rows)
+    if replayed:
+        legs.update(await _get_replayed_legs(session, replayed))
+    return [legs[correlation_id] for correlation_id in correlation_ids]
+
+
+def _check_batch(transfers: list[schemas.TransferEntry], correlation_ids: list[str]) -> None:
+    if len(set(correlation_ids)) < len(correlation_ids):
+        raise PaymentError("Transfer uids must be unique within a batch")
+    for transfer in transfers:
+        if transfer.from_user_id == transfer.to_user_id:
+            raise PaymentError("Cannot transfer to the same wallet")
+
+
+def _written_legs(
+    transfers: list[schemas.TransferEntry], correlation_ids: list[str], rows: typing.Sequence[typing.Any],
+) -> tuple[dict[str, tuple[Transaction, Transaction]], list[tuple[schemas.TransferEntry, str]]]:
+    """The legs settle_query wrote, by correlation id, and the transfers it found already settled."""
+    legs = {}
+    replayed = []
+    for transfer, correlation_id, row in zip(transfers, correlation_ids, rows, strict=True):
+        if row.sender_currency is None or row.recipient_currency is None:
+            missing = transfer.from_user_id if row.sender_currency is None else transfer.to_user_id
+            raise PaymentError(f"User {missing} does not exist")
+        if row.sender_currency != row.recipient_currency:
+            raise PaymentError("Cannot transfer between wallets of different currencies")
+        if row.debit is not None and row.credit is not None:
+            legs[correlation_id] = (row.debit, row.credit)
+        elif row.debit is None and row.credit is None:
+            replayed.append((transfer, correlation_id))
+        else:
+            # One of the leg ids was already taken as another transaction's idempotency key
+            raise PaymentError("Transaction already exists")
+    return legs, replayed
+
+
+def wallet_ids(transfers: list[schemas.TransferEntry]) -> list[int]:
+    return sorted({user_id for transfer in transfers for user_id in (transfer.from_user_id, transfer.to_user_id)})
+
+
+def settle_query(transfers: list[schemas.TransferEntry], correlation_ids: list[str]) -> typing.Any:
+    """The statement settle_transfers runs, once it has locked the wallets; one row per transfer, in order.
+
+    settle_transfers locks the rows of every wallet involved first, in id order, so
+    concurrent transfers, in whichever direction, never deadlock. Both legs of each transfer
+    are claimed in transaction_keys; a transfer whose keys are taken by an earlier
+    attempt writes nothing. The rest are applied to users.balance as one net delta
+    per wallet, guarded so no balance goes negative. A sharded sender that can't
+    cover its debit from users.balance has its slots moved there first, skipping
+    those other transactions are writing; rebalance_slots spreads them again.
+    """
+    requested = values(
+        column("ordinal", Integer), column("correlation_id", String), column("debit_id", String),
+        column("credit_id", String), column("from_user_id", Integer), column("to_user_id", Integer),
+        column("amount", BigInteger),
+        name="requested",
+    ).data([
+        (ordinal, correlation_id, *leg_ids(correlation_id), transfer.from_user_id, transfer.to_user_id, transfer.amount)
+        for ordinal, (transfer, correlation_id) in enumerate(zip(transfers, correlation_ids, strict=True))
+    ])
+    requested = select(requested).cte("requested")
+
+    # Already locked by settle_transfers, so nothing has changed them since the statement's snapshot
+    locked = select(User.id, User.currency, User.balance, User.balance_slots)\
+        .where(User.id == any_(literal(wallet_ids(transfers), ARRAY(Integer))))\
+        .cte("locked")
+    sender = locked.alias("sender")
+    recipient = locked.alias("recipient")
+    valid = select(requested)\
+        .join(sender, sender.c.id == requested.c.from_user_id)\
+        .join(recipient, recipient.c.id == requested.c.to_user_id)\
+        .where(sender.c.currency == recipient.c.currency)\
+        .cte("valid")
+
+    keys = insert(TransactionKey)\
+        .from_select(
+            [TransactionKey.transaction_id, TransactionKey.created_at],
+            union_all(select(valid.c.debit_id, func.now()), select(valid.c.credit_id, func.now())),
+        )\
+        .on_conflict_do_nothing(index_elements=["transaction_id"])\
+        .returning(TransactionKey.transaction_id, TransactionKey.created_at)\
+        .cte("keys")
+    debit_key = keys.alias("debit_key")
+    credit_key = keys.alias("credit_key")
+    claimed = select(valid, debit_key.c.created_at)\
+        .join(debit_key, debit_key.c.transaction_id == valid.c.debit_id)\
+        .join(credit_key, credit_key.c.transaction_id == valid.c.credit_id)\
+        .cte("claimed")
+
+    columns = [
+        Transaction.transaction_id, Transaction.correlation_id, Transaction.user_id, Transaction.type,
+        Transaction.amount, Transaction.created_at,
+    ]
+    legs = insert(Transaction)\
+        .from_select(columns, union_all(
+            select(
+                claimed.c.debit_id, claimed.c.correlation_id, claimed.c.from_user_id,
+                literal(TransactionType.WITHDRAW, Transaction.type.type), claimed.c.amount, claimed.c.created_at,
+            ),
+            select(
+                claimed.c.credit_id, claimed.c.correlation_id, claimed.c.to_user_id,
+                literal(TransactionType.DEPOSIT, Transaction.type.type), claimed.c.amount, claimed.c.created_at,
+            ),
+        ))\
+        .returning(*Transaction.__table__.c)\
+        .cte("legs")
+
+    moves = union_all(
+        select(claimed.c.from_user_id.label("user_id"), (-claimed.c.amount).label("delta")),
+        select(claimed.c.to_user_id, claimed.c.amount),
+    ).subquery("moves")
+    net = select(moves.c.user_id, cast(func.sum(moves.c.delta), BigInteger).label("delta"))\
+        .group_by(moves.c.user_id)\
+        .cte("net")
+
+    drained_slots = select(BalanceSlot.user_id, BalanceSlot.slot, BalanceSlot.balance)\
+        .join(net, net.c.user_id == BalanceSlot.user_id)\
+        .join(locked, locked.c.id == BalanceSlot.user_id)\
+        .where(locked.c.balance_slots > 0)\
+        .where(locked.c.balance + net.c.delta < 0)\
+        .where(BalanceSlot.balance != 0)\
+        .order_by(BalanceSlot.user_id, BalanceSlot.slot)\
+        .with_for_update(of=BalanceSlot, skip_locked=True)\
+        .cte("drained_slots")
+    drained = update(BalanceSlot)\
+        .where(BalanceSlot.user_id == drained_slots.c.user_id)\
+        .where(BalanceSlot.slot == drained_slots.c.slot)\
+        .values(balance=0)\
+        .returning(drained_slots.c.user_id, drained_slots.c.balance)\
+        .cte("drained")
+    drained_totals = select(drained.c.user_id, cast(func.sum(drained.c.balance), BigInteger).label("balance"))\
+        .group_by(drained.c.user_id)\
+        .subquery("drained_totals")
+    deltas = select(net.c.user_id, (net.c.delta + func.coalesce(drained_totals.c.balance, 0)).label("delta"))\
+        .outerjoin(drained_totals, drained_totals.c.user_id == net.c.user_id)\
+        .subquery("deltas")
+    applied = update(User)\
+        .where(User.id == deltas.c.user_id)\
+        .where(User.balance + deltas.c.delta >= 0)\
+        .values(balance=User.balance + deltas.c.delta)\
+        .returning(User.id)\
+        .cte("applied")
+    short = select(func.array_agg(net.c.user_id))\
+        .where(net.c.user_id.not_in(select(applied.c.id)))\
+        .scalar_subquery()
+
+    debit_leg = legs.alias("debit_leg")
+    credit_leg = legs.alias("credit_leg")
+    return select(
+        aliased(Transaction, debit_leg, name="debit"),
+        aliased(Transaction, credit_leg, name="credit"),
+        sender.c.currency.label("sender_currency"),
+        recipient.c.currency.label("recipient_currency"),
+        short.label("short"),
+    )\
+        .select_from(requested)\
+        .outerjoin(sender, sender.c.id == requested.c.from_user_id)\
+        .outerjoin(recipient, recipient.c.id == requested.c.to_user_id)\
+        .outerjoin(debit_leg, debit_leg.c.transaction_id == requested.c.debit_id)\
+        .outerjoin(credit_leg, credit_leg.c.transaction_id == requested.c.credit_id)\
+        .order_by(requested.c.ordinal)
+
+
+async def _get_replayed_legs(
+    session: AsyncSession, replayed: list[tuple[schemas.TransferEntry, str]],
+) -> dict[str, tuple[Transaction, Transaction]]:
+    result = await session.execute(
+        select_by_transaction_id(*(leg for _, correlation_id in replayed for leg in leg_ids(correlation_id)))
+    )
+    found = {transaction.transaction_id: transaction for transaction in result.scalars()}
+    legs = {}
+    for transfer, correlation_id in replayed:
+        debit, credit = (found.get(leg) for leg in leg_ids(correlation_id))
+        if debit is None or credit is None or (debit.user_id, credit.user_id, debit.amount) != (
+            transfer.from_user_id, transfer.to_user_id, transfer.amount,
+        ):
+            raise PaymentError("Transaction already exists")
+        legs[correlation_id] = debit, credit
+    return legs
@@ -1,5 +1,7 @@
+import asyncio
+import typing
+
 import bcrypt
-from decimal import Decimal
 from jose import jwt
 from passlib.context import CryptContext
 from sqlalchemy import URL
@@ -7,14 +9,24 @@ from fastapi.security import OAuth2PasswordBearer
 from fastapi import HTTPException
 from starlette import status
 from sqlalchemy.future import select
-from sqlalchemy import func
+from sqlalchemy import BigInteger, cast, func, case, literal_column, text
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from datetime import datetime, timedelta
 
 from app.settings import Settings
-from app.models import User, Transaction
+from app.archive import get_delta
+from app.exceptions import ArchiveMovedError
+from app.models import User, Transaction, BalanceCheckpoint, TransactionArchive
 from app.custom_types import TransactionType
-from app.schemas import TransactionAdd
+from app.money import Balance
+from app.repositories.archive import get_table_delta, table_schema
+from app.repositories.balance_slots import total_balance
+
+if typing.TYPE_CHECKING:
+    # Both import this module, so they're only needed for annotations
+    from app.passwords import PasswordHasher
+    from app.repositories.payment import PaymentRepository
 
 SECRET_KEY = "your-secret-key"
 ALGORITHM = "HS256"
@@ -23,28 +35,108 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 1440
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-
-async def get_total_balance(repo: 'PaymentRepository', **kwargs) -> Decimal:
-    async with repo.db_session_maker() as session:
-        async with session.begin():
-            result = await session.execute(select(User).filter_by(id=kwargs.get("user_id")))
-            user = result.scalars().first()
-        await session.commit()
-    return user.balance
-
-
-async def get_date_balance(repo: 'PaymentRepository', **kwargs) -> Decimal:
-    async with repo.db_session_maker() as session:
-        async with session.begin():
-            _ts = datetime.fromtimestamp(kwargs.get("ts"))
-            stmt = select(func.sum(Transaction.amount))\
-                .where(Transaction.created_at <= _ts)\
-                .where(Transaction.user_id == kwargs.get("user_id"))
-            result = await session.execute(stmt)
-            total_amount = result.scalar()
-        await session.commit()
-
-    return total_amount
+# Withdrawals decrease the balance, so ledger sums have to use the signed amount
+signed_amount = case(
+    (Transaction.type == TransactionType.WITHDRAW, -Transaction.amount),
+    else_=Transaction.amount,
+)
+
+
+# Other transactions writing to the table, i.e. holding the lock an insert takes until the end
+WRITERS = text(
+    "SELECT DISTINCT virtualtransaction FROM pg_locks "
+    "WHERE relation = CAST(:table AS regclass) AND mode = 'RowExclusiveLock' AND granted "
+    "AND pid <> pg_backend_pid()"
+)
+# Those of the given transactions still running; each holds a lock on its own virtual id until it ends
+RUNNING = text("SELECT virtualxid FROM pg_locks WHERE locktype = 'virtualxid' AND virtualxid = ANY(:ids)")
+WATERMARK_POLL_SECONDS = 0.05
+
+
+async def get_settled_watermark(session: AsyncSession) -> int:
+    """The highest transactions.id, returned once no transaction can commit a lower one.
+
+    Ids are drawn from a sequence before commit, so a lower id than the highest
+    visible one may still be held by a transaction in flight. That transaction has
+    been writing to transactions since before the highest id was read, and holds its
+    lock until it ends, so this waits for the writers seen right after the read. In a
+    READ COMMITTED transaction, later statements see every row up to the watermark.
+    """
+    watermark = await session.scalar(select(func.coalesce(func.max(Transaction.id), 0)))
+    writers = list(await session.scalars(WRITERS, {"table": Transaction.__tablename__}))
+    while writers:
+        await asyncio.sleep(WATERMARK_POLL_SECONDS)
+        writers = list(await session.scalars(RUNNING, {"ids": writers}))
+    return watermark
+
+
+async def get_total_balance(repo: 'PaymentRepository', **kwargs) -> Balance | None:
+    result = await repo.db_session.execute(
+        select(total_balance, User.currency).where(User.id == kwargs.get("user_id"))
+    )
+    row = result.first()
+    return Balance(*row) if row is not None and row[0] is not None else None
+
+
+async def get_date_balance(repo: 'PaymentRepository', **kwargs) -> Balance | None:
+    user_id = kwargs.get("user_id")
+    _ts = datetime.fromtimestamp(kwargs.get("ts"))
+
+    # Start from the nearest checkpoint and replay only the transactions after it
+    nearest_checkpoint = select(BalanceCheckpoint)\
+        .where(BalanceCheckpoint.user_id == user_id)\
+        .where(BalanceCheckpoint.as_of <= _ts)\
+        .order_by(BalanceCheckpoint.as_of.desc())\
+        .limit(1)
+    checkpoint_balance = nearest_checkpoint.with_only_columns(BalanceCheckpoint.balance).scalar_subquery()
+    checkpoint_as_of = nearest_checkpoint.with_only_columns(BalanceCheckpoint.as_of).scalar_subquery()
+    delta = select(cast(func.sum(signed_amount), BigInteger))\
+        .where(Transaction.user_id == user_id)\
+        .where(Transaction.created_at <= _ts)\
+        .where(Transaction.created_at > func.coalesce(checkpoint_as_of, literal_column("'-infinity'::timestamptz")))\
+        .scalar_subquery()
+
+    # Archive files with rows in the same window, which are no longer in transactions
+    archive_files = select(func.array_agg(TransactionArchive.file_path))\
+        .where(TransactionArchive.file_path.is_not(None))\
+        .where(TransactionArchive.max_created_at > func.coalesce(
+            checkpoint_as_of, literal_column("'-infinity'::timestamptz"),
+        ))\
+        .where(TransactionArchive.min_created_at <= _ts)\
+        .scalar_subquery()
+    # And the tables of archived partitions in it that aren't exported yet
+    schema = table_schema()
+    archive_tables = select(func.array_agg(schema + "." + TransactionArchive.partition_name))\
+        .where(TransactionArchive.file_path.is_(None))\
+        .where(schema.is_not(None))\
+        .where(TransactionArchive.range_end > func.coalesce(
+            checkpoint_as_of, literal_column("'-infinity'::timestamptz"),
+        ))\
+        .where(func.coalesce(TransactionArchive.range_start, literal_column("'-infinity'::timestamptz")) <= _ts)\
+        .scalar_subquery()
+
+    currency = select(User.currency).where(User.id == user_id).scalar_subquery()
+    result = await repo.db_session.execute(
+        select(checkpoint_balance, checkpoint_as_of, delta, archive_files, archive_tables, currency),
+    )
+    base, as_of, replayed, paths, tables, currency = result.one()
+    if tables:
+        try:
+            archived = await get_table_delta(repo.db_session, tables, user_id, as_of, _ts.astimezone())
+        except ArchiveMovedError:
+            # Moved to the archive schema, or exported, since; look again
+            return await get_date_balance(repo, **kwargs)
+        if archived is not None:
+            replayed = (replayed or 0) + archived
+    if paths:
+        # Naive datetimes are local time, as datetime.fromtimestamp gives them
+        archived = await get_delta(paths, user_id, as_of, _ts.astimezone())
+        if archived is not None:
+            replayed = (replayed or 0) + archived
+
+    if base is None and replayed is None:
+        return None
+    return Balance((base or 0) + (replayed or 0), currency)
 
 
 balance_strategy = {
@@ -62,17 +154,15 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
-async def get_user(db: 'PaymentRepository', email: str):
-    async with db() as session:
-        async with session.begin():
-            result = await session.execute(select(User).filter_by(email=email))
-            user = result.scalars().first()
-            if not user:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail="User not found"
-                )
-            return user
+async def get_user(db: AsyncSession, email: str):
+    result = await db.execute(select(User).filter_by(email=email))
+    user = result.scalars().first()
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+    return user
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -86,11 +176,11 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     return encoded_jwt
 
 
-async def authenticate_user(db: 'PaymentRepository', email: str, password: str):
+async def authenticate_user(db: AsyncSession, email: str, password: str, hasher: 'PasswordHasher'):
     user = await get_user(db, email)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await hasher.verify(password, user.hashed_password):
         return False
     return user
 
@@ -99,10 +189,3 @@ def get_dsn(scheme: str | None = None) -> URL:
     settings = Settings(scheme=scheme)
     return settings.db_dsn
 
-
-async def change_balance(user: User, data: TransactionAdd) -> None:
-    balance = user.balance + data.amount if data.type.value == TransactionType.DEPOSIT.value else \
-        user.balance - data.amount
-
-    if balance >= 0:
-        user.balance = balance
@@ -1,8 +1,18 @@
+import typing
+
 import pydantic
 from pydantic import BaseModel, EmailStr
+from datetime import datetime
 from decimal import Decimal
 
-from app.custom_types import TransactionType
+from app.custom_types import TransactionType, RejectionReason
+from app.money import CURRENCY_SCALES, DEFAULT_CURRENCY, from_minor_units
+
+
+# Positional notation in JSON even for tiny amounts: 0.00000001 rather than 1E-8
+Money = typing.Annotated[
+    Decimal, pydantic.PlainSerializer(lambda amount: format(amount, "f"), return_type=str, when_used="json"),
+]
 
 
 class Base(BaseModel):
@@ -18,24 +28,154 @@ class User(Base):
     id: int
     name: str | None
     email: EmailStr
+    currency: str
+
+
+class Principal(Base):
+    """The authenticated caller, resolved from a bearer token."""
+    id: int
+    email: str
+    currency: str = DEFAULT_CURRENCY
 
 
 class UserBalance(Base):
-    amount: Decimal
+    amount: Money
+    currency: str
+
+
+class BalancesQuery(Base):
+    user_ids: list[int] = pydantic.Field(min_length=1)
+    # Balances as of this unix timestamp instead of now
+    ts: int | None = None
+
+
+class UserBalanceEntry(Base):
+    user_id: int
+    amount: Money
+    currency: str
+
+    @classmethod
+    def from_ledger(cls, row: typing.Any, currency: str) -> typing.Self:
+        """From a (user_id, amount) row, whose amount is in minor units of currency."""
+        return cls(user_id=row.user_id, amount=from_minor_units(row.amount, currency), currency=currency)
 
 
 class UserCreate(Base):
     name: str | None
     email: EmailStr
     password: str
+    currency: str = DEFAULT_CURRENCY
+
+    @pydantic.field_validator("currency")
+    @classmethod
+    def known_currency(cls, currency: str) -> str:
+        if currency not in CURRENCY_SCALES:
+            raise ValueError(f"Unsupported currency, expected one of {', '.join(CURRENCY_SCALES)}")
+        return currency
 
 
 class TransactionAdd(Base):
-    amount: Decimal
+    amount: Decimal = pydantic.Field(gt=0)
     type: TransactionType
+    # Idempotency key: retrying with the same uid returns the original transaction
+    uid: str | None = None
+
+
+class TransactionEntry(Base):
+    """A TransactionAdd with its amount in minor units of the caller's currency."""
+    amount: int = pydantic.Field(gt=0)
+    type: TransactionType
+    uid: str | None = None
 
 
 class Transaction(Base):
     transaction_id: str
-    amount: Decimal
+    amount: Money
     type: TransactionType
+    created_at: datetime | None = None
+    # Shared by the two legs of a transfer
+    correlation_id: str | None = None
+
+    @classmethod
+    def from_ledger(cls, row: typing.Any, currency: str) -> typing.Self:
+        """From a transactions row, whose amount is in minor units of currency."""
+        return cls(
+            transaction_id=row.transaction_id,
+            amount=from_minor_units(row.amount, currency),
+            type=row.type,
+            created_at=row.created_at,
+            correlation_id=row.correlation_id,
+        )
+
+
+class TransferAdd(Base):
+    to_user_id: int
+    amount: Decimal = pydantic.Field(gt=0)
+    # Idempotency key, and the correlation id of the two legs
+    uid: str | None = None
+
+
+class TransferBatch(Base):
+    transfers: list[TransferAdd] = pydantic.Field(min_length=1)
+
+
+class TransferEntry(Base):
+    """A transfer with its amount in minor units of the two wallets' currency."""
+    from_user_id: int
+    to_user_id: int
+    amount: int = pydantic.Field(gt=0)
+    uid: str | None = None
+
+
+class Transfer(Base):
+    correlation_id: str
+    from_user_id: int
+    to_user_id: int
+    debit: Transaction
+    credit: Transaction
+
+    @classmethod
+    def from_legs(cls, debit: typing.Any, credit: typing.Any, currency: str) -> typing.Self:
+        """From the transactions rows of a transfer's legs, whose amounts are in minor units of currency."""
+        return cls(
+            correlation_id=debit.correlation_id,
+            from_user_id=debit.user_id,
+            to_user_id=credit.user_id,
+            debit=Transaction.from_ledger(debit, currency),
+            credit=Transaction.from_ledger(credit, currency),
+        )
+
+
+class TransactionPage(Base):
+    items: list[Transaction]
+    # Pass back as ?cursor= to get the next page; None on the last page
+    next_cursor: str | None
+
+
+class Statement(Base):
+    """A user's ledger over [since, until): the balance at both ends and the totals in between."""
+    since: datetime
+    until: datetime
+    currency: str
+    opening_balance: Money
+    closing_balance: Money
+    deposits: Money
+    withdrawals: Money
+    deposit_count: int
+    withdrawal_count: int
+
+
+class TransactionIngest(TransactionAdd):
+    user_id: int
+    created_at: datetime | None = None
+
+
+class IngestRejection(Base):
+    line: int
+    transaction_id: str | None
+    reason: RejectionReason
+
+
+class IngestReport(Base):
+    accepted: int = 0
+    rejected: list[IngestRejection] = []
@@ -15,6 +15,105 @@ class Settings(BaseSettings):
     service_name: str = "Wallet API"
     debug: bool = False
 
+    # One engine per Granian worker, so the server-side connection count is
+    # workers * (db_pool_size + db_max_overflow)
+    db_pool_size: int = 10
+    db_max_overflow: int = 5
+    db_pool_timeout: float = 30
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = False
+    # asyncpg prepared statements cached per connection; 0 disables (e.g. behind pgbouncer)
+    db_statement_cache_size: int = 100
+    # Only honoured in debug mode
+    db_echo: bool = False
+
+    # Streaming replicas for GET requests, as full DSNs (a JSON list in the environment).
+    # Each gets its own pool sized like the primary's
+    db_replica_dsns: list[str] = []
+    db_replica_health_check_seconds: float = 5
+    db_replica_health_check_timeout: float = 2
+    db_replica_max_lag_seconds: float = 5
+    # After a successful write, the client gets a cookie with the primary's WAL position,
+    # kept this long: its reads only go to replicas that replayed past it, and skip the
+    # balance cache. Keep it above max lag + health check interval, after which any
+    # healthy replica has the write
+    db_read_your_writes_seconds: float = 15
+
+    # transactions is partitioned by month: partitions are created this many months
+    # ahead, and detached to the archive schema once they ended hot_months ago
+    transaction_partitions_ahead: int = 3
+    transaction_hot_months: int = 12
+    # Archived partitions are exported to Parquet files here (see app.archive), one row group
+    # per this many rows. Readers open files by the absolute path recorded at export, so
+    # every API worker needs the directory mounted at the same place
+    archive_dir: str = "archive"
+    archive_row_group_size: int = 50_000
+
+    # Checkpoints are taken this far in the past, so transactions that began before but haven't
+    # written yet are not missed; those already writing are waited for
+    checkpoint_lag_seconds: int = 300
+    checkpoint_backfill_interval_days: int = 1
+
+    # Ledger reconciliation checks ranges of this many user ids in parallel processes
+    reconcile_range_size: int = 50_000
+    reconcile_workers: int = 4
+
+    # Daily rollups cover UTC days that ended at least lag_seconds ago
+    rollup_lag_seconds: int = 300
+
+    # Admission control, per worker: requests beyond what the DB pools can serve right away
+    # get a 503 instead of queueing for a connection. 0 means the primary pool's size plus
+    # overflow, and as much again per replica. Writes may only fill write_share of it and
+    # bulk writes bulk_share, so reads are shed last
+    admission_max_in_flight: int = 0
+    admission_write_share: float = 0.8
+    admission_bulk_share: float = 0.25
+    admission_bulk_paths: list[str] = ["/api/transaction/bulk/", "/api/transfer/batch/"]
+    # Never shed, so probes and scrapes still get through under load
+    admission_exempt_paths: list[str] = ["/metrics", "/api/internal/"]
+    # Token bucket per user (token subject): requests per second and burst; 429 beyond it. 0 disables
+    admission_user_rate: float = 200
+    admission_user_burst: int = 400
+    admission_retry_after_seconds: int = 1
+
+    # Endpoints over other users' wallets (bulk ingest, batch balances) need this key in an
+    # X-Operator-Key header instead of a user's bearer token. Empty disables them
+    operator_api_key: str = ""
+
+    # Resolved bearer tokens, so authenticated requests skip JWT decoding and user lookups
+    principal_cache_size: int = 10_000
+    principal_cache_ttl_seconds: float = 300
+
+    # Current balances of unsharded wallets, cached per worker and invalidated by NOTIFY
+    # from the primary; 0 disables
+    balance_cache_size: int = 100_000
+    balance_listener_reconnect_seconds: float = 1
+
+    # bcrypt runs on this many threads; calls beyond workers + queue size get a 503
+    password_pool_workers: int = 4
+    password_pool_queue_size: int = 64
+
+    # Coalesce concurrent POST /transaction/ calls of a worker into one DB transaction,
+    # flushed window_ms after the first arrives or once max_items are waiting
+    group_commit_enabled: bool = False
+    group_commit_window_ms: float = 2
+    group_commit_max_items: int = 100
+
+    # Once the outbox is enabled (python -m app.commands.outbox enable), every ledger row gets
+    # an outbox_events row, delivered by a dispatcher in each worker to these sinks:
+    # "ndjson:<path>" appends to a file, "<module>:<name>" is a factory of an app.outbox.Sink
+    # called with the settings. Without any, events are kept, and the backlog reported, until there are
+    outbox_sinks: list[str] = []
+    outbox_batch_size: int = 500
+    outbox_poll_seconds: float = 0.5
+
+    # Rows per COPY batch for bulk ingestion; each batch is one DB transaction
+    bulk_ingest_batch_size: int = 10_000
+    # Most user ids one POST /user/balances/ call may ask for
+    balance_batch_max_ids: int = 10_000
+    # Most transfers one POST /transfer/batch/ call may settle
+    transfer_batch_max_size: int = 1000
+
     @field_validator("db_dsn", mode="before")
     def assemble_dsn(cls, v, info: FieldValidationInfo):
         if isinstance(v, str):
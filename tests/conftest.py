@@ -0,0 +1,151 @@
+import asyncio
+import contextlib
+import dataclasses
+import os
+import typing
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+import sqlalchemy as sa
+from alembic import command
+from alembic.config import Config
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app.custom_types import ALEMBIC_SCHEME, FAST_API_SCHEME
+from app.repositories.balance_slots import set_balance_slots
+from app.repositories.checkpoints import create_checkpoints
+from app.repositories.outbox import set_outbox_enabled
+from app.repositories.rollups import ONE_DAY, finish_run, roll_up, start_run
+from app.settings import Settings
+
+
+ROOT: typing.Final = Path(__file__).parents[1]
+
+# Size of the synthetic ledger; the defaults take about a minute to load
+LEDGER_USERS: typing.Final = int(os.environ.get("PLAN_TEST_USERS", 10_000))
+LEDGER_TRANSACTIONS: typing.Final = int(os.environ.get("PLAN_TEST_TRANSACTIONS", 1_000_000))
+LEDGER_DAYS: typing.Final = 90
+# Keep the database after the run, e.g. to look at a plan by hand
+KEEP_DATABASE: typing.Final = os.environ.get("PLAN_TEST_KEEP_DB") == "1"
+
+
+@dataclasses.dataclass(frozen=True)
+class Ledger:
+    settings: Settings
+    user_id: int
+    sharded_user_id: int
+    email: str
+    transaction_id: str
+    # Between the checkpoints and now, so point-in-time balances start from a checkpoint
+    ts: int
+
+
+LOAD_LEDGER: typing.Final = [
+    sa.text(
+        "INSERT INTO users (id, name, email, hashed_password, balance_minor, currency) "
+        "SELECT i, 'user ' || i, 'user' || i || '@plans.test', '', 0, 'USD' FROM generate_series(1, :users) AS i"
+    ),
+    sa.text("SELECT setval('users_id_seq', :users)"),
+    # Users take turns, and every fifth turn is a withdrawal of a tenth of a deposit at most,
+    # so balances stay positive
+    sa.text(
+        "INSERT INTO transactions (amount_minor, user_id, type, transaction_id, created_at) "
+        "SELECT CASE WHEN i / :users % 5 = 0 THEN 1 + (random() * 1000)::bigint "
+        "ELSE 1 + (random() * 10000)::bigint END, "
+        "1 + i % :users, "
+        "CAST(CASE WHEN i / :users % 5 = 0 THEN 'WITHDRAW' ELSE 'DEPOSIT' END AS transactiontype), "
+        "'plan-' || i, "
+        "now() - random() * make_interval(days => :days) "
+        "FROM generate_series(1, :transactions) AS i"
+    ),
+    sa.text(
+        "INSERT INTO transaction_keys (transaction_id, created_at) SELECT transaction_id, created_at FROM transactions"
+    ),
+    sa.text(
+        "UPDATE users SET balance_minor = ledger.total FROM ("
+        "SELECT user_id, sum(CASE WHEN type = 'WITHDRAW' THEN -amount_minor ELSE amount_minor END) AS total "
+        "FROM transactions GROUP BY user_id"
+        ") AS ledger WHERE users.id = ledger.user_id"
+    ),
+]
+
+
+async def load_ledger(settings: Settings, now: datetime) -> Ledger:
+    engine = create_async_engine(settings.db_dsn)
+    session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+    user_id, sharded_user_id = 42, 7
+    try:
+        async with session_maker() as session:
+            async with session.begin():
+                # So the ledger comes with a backlog of events to dispatch
+                await set_outbox_enabled(session, True)
+                for statement in LOAD_LEDGER:
+                    await session.execute(
+                        statement, {"users": LEDGER_USERS, "transactions": LEDGER_TRANSACTIONS, "days": LEDGER_DAYS},
+                    )
+                for days in (60, 30):
+                    await create_checkpoints(session, now - timedelta(days=days))
+                rollup_run = await start_run(session, now.date() - ONE_DAY, incremental=False)
+                await finish_run(session, rollup_run.id, await roll_up(session, rollup_run))
+                await set_balance_slots(session, sharded_user_id, 8)
+                transaction_id = await session.scalar(sa.text(
+                    "SELECT transaction_id FROM transactions WHERE user_id = :user_id ORDER BY created_at DESC LIMIT 1"
+                ), {"user_id": user_id})
+
+        async with engine.connect() as connection:
+            autocommit = await connection.execution_options(isolation_level="AUTOCOMMIT")
+            # Sets the visibility map too, as autovacuum eventually would, so index-only scans are possible
+            await autocommit.execute(sa.text("VACUUM ANALYZE"))
+    finally:
+        await engine.dispose()
+
+    return Ledger(
+        settings=settings,
+        user_id=user_id,
+        sharded_user_id=sharded_user_id,
+        email=f"user{user_id}@plans.test",
+        transaction_id=transaction_id,
+        ts=int((now - timedelta(days=10)).timestamp()),
+    )
+
+
+@contextlib.contextmanager
+def migrated_database(name: str) -> typing.Iterator[Settings]:
+    """A database of its own, migrated to head, and dropped afterwards unless KEEP_DATABASE.
+
+    Skips the tests using it if Postgres can't be reached.
+    """
+    admin = sa.create_engine(
+        Settings(scheme=ALEMBIC_SCHEME, name="postgres").db_dsn, isolation_level="AUTOCOMMIT",
+    )
+    try:
+        with admin.connect() as connection:
+            connection.execute(sa.text(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)'))
+            connection.execute(sa.text(f'CREATE DATABASE "{name}"'))
+    except sa.exc.OperationalError as e:
+        admin.dispose()
+        pytest.skip(f"Postgres is not reachable: {e}")
+
+    try:
+        config = Config(str(ROOT / "alembic.ini"))
+        config.set_main_option("script_location", str(ROOT / "migrations"))
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            # Read by the migrations' env.py through Settings
+            monkeypatch.setenv("NAME", name)
+            command.upgrade(config, "head")
+
+        yield Settings(scheme=FAST_API_SCHEME, name=name)
+    finally:
+        if not KEEP_DATABASE:
+            with admin.connect() as connection:
+                connection.execute(sa.text(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)'))
+        admin.dispose()
+
+
+@pytest.fixture(scope="session")
+def ledger() -> typing.Iterator[Ledger]:
+    """A migrated_database loaded with a synthetic ledger."""
+    name = os.environ.get("PLAN_TEST_DB", f"{Settings(scheme=FAST_API_SCHEME).name}_plans")
+    with migrated_database(name) as settings:
+        yield asyncio.run(load_ledger(settings, datetime.now(timezone.utc)))
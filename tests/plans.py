@@ -0,0 +1,115 @@
+"""Record the statements repository code runs, and EXPLAIN (ANALYZE, BUFFERS) each of them."""
+import contextlib
+import dataclasses
+import json
+import typing
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+
+EXPLAINABLE: typing.Final = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+# Tables that grow with the user base or the ledger, where a sequential scan is a regression.
+# The ledger's partitions are all named transactions_*.
+LARGE_TABLES: typing.Final = frozenset((
+    "users", "transaction_keys", "balance_checkpoints", "outbox_events", "daily_user_rollups",
+))
+LEDGER_PARTITION_PREFIX: typing.Final = "transactions_"
+
+
+@dataclasses.dataclass(frozen=True)
+class Statement:
+    sql: str
+    parameters: typing.Any
+
+
+@dataclasses.dataclass(frozen=True)
+class Plan:
+    statement: Statement
+    plan: dict[str, typing.Any]
+    # False if the statement couldn't be run again (e.g. a plain INSERT of a unique key), so
+    # the plan is the planner's estimate only, without buffer counts
+    analyzed: bool
+
+    @property
+    def buffers(self) -> int:
+        """Shared buffers hit or read by the whole statement, its CTEs and subplans included."""
+        top = self.plan["Plan"]
+        return top.get("Shared Hit Blocks", 0) + top.get("Shared Read Blocks", 0)
+
+    def seq_scans(self) -> list[str]:
+        """Relations scanned sequentially anywhere in the plan."""
+        scanned = []
+        nodes = [self.plan["Plan"]]
+        while nodes:
+            node = nodes.pop()
+            if node["Node Type"] == "Seq Scan":
+                scanned.append(node["Relation Name"])
+            nodes.extend(node.get("Plans", []))
+        return scanned
+
+
+def is_large(relation: str) -> bool:
+    return relation in LARGE_TABLES or relation.startswith(LEDGER_PARTITION_PREFIX)
+
+
+async def empty_relations(connection: AsyncConnection) -> frozenset[str]:
+    """Relations without a single page as of their last VACUUM, e.g. partitions for the months ahead.
+
+    The planner rightly scans these sequentially.
+    """
+    result = await connection.execute(text("SELECT relname FROM pg_class WHERE relkind = 'r' AND relpages = 0"))
+    return frozenset(result.scalars())
+
+
+class StatementRecorder:
+    """Collects the explainable statements sent over a connection while recording."""
+
+    def __init__(self, connection: AsyncConnection) -> None:
+        self.statements: list[Statement] = []
+        self._recording = False
+        event.listen(connection.sync_connection, "before_cursor_execute", self._record)
+
+    @contextlib.contextmanager
+    def recording(self) -> typing.Iterator[None]:
+        self._recording = True
+        try:
+            yield
+        finally:
+            self._recording = False
+
+    def _record(
+        self,
+        _connection: typing.Any,
+        _cursor: typing.Any,
+        statement: str,
+        parameters: typing.Any,
+        _context: typing.Any,
+        executemany: bool,
+    ) -> None:
+        if self._recording and statement.lstrip().upper().startswith(EXPLAINABLE):
+            # An executemany is planned the same for every parameter set
+            self.statements.append(Statement(statement, parameters[0] if executemany else parameters))
+
+
+async def explain(connection: AsyncConnection, statement: Statement) -> Plan:
+    """Run the statement again under EXPLAIN (ANALYZE, BUFFERS), in a savepoint that is rolled back.
+
+    Falls back to a plain EXPLAIN if running it again fails.
+    """
+    try:
+        return await _explain(connection, statement, "ANALYZE, BUFFERS, FORMAT JSON", analyzed=True)
+    except DBAPIError:
+        return await _explain(connection, statement, "FORMAT JSON", analyzed=False)
+
+
+async def _explain(connection: AsyncConnection, statement: Statement, options: str, analyzed: bool) -> Plan:
+    savepoint = await connection.begin_nested()
+    try:
+        result = await connection.exec_driver_sql(f"EXPLAIN ({options}) {statement.sql}", statement.parameters)
+        output = result.scalar_one()
+    finally:
+        await savepoint.rollback()
+    plans = json.loads(output) if isinstance(output, str) else output
+    return Plan(statement, plans[0], analyzed)
@@ -0,0 +1,72 @@
+"""Unit tests of the admission control of app.admission; no database needed."""
+import pytest
+
+from app import admission, cache
+from app.admission import AdmissionController, Priority, Shed, TokenBucket
+
+
+class Clock:
+    """Stands in for the time module, with a monotonic clock moved by hand."""
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock = Clock()
+    # The buckets' own clock, and the one forgetting idle buckets
+    monkeypatch.setattr(admission, "time", clock)
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+
+def controller(**overrides: float) -> AdmissionController:
+    options = {
+        "max_in_flight": 10, "write_share": 0.5, "bulk_share": 0.2,
+        "user_rate": 0, "user_burst": 2, "max_users": 100, "retry_after": 1,
+    }
+    return AdmissionController(**(options | overrides))
+
+
+def test_bucket_refills_at_its_rate_up_to_its_burst(clock: Clock) -> None:
+    bucket = TokenBucket(tokens=1)
+    assert [bucket.take(rate=2, burst=3), bucket.take(rate=2, burst=3)] == [0, 0.5]
+
+    clock.now += 0.5
+    assert [bucket.take(rate=2, burst=3)] == [0]
+    # However long it sat idle
+    clock.now += 60
+    assert [bucket.take(rate=2, burst=3) for _ in range(4)] == [0, 0, 0, 0.5]
+
+
+@pytest.mark.usefixtures("clock")
+def test_lower_priorities_get_a_share_of_the_slots() -> None:
+    admitter = controller()
+    overloaded = Shed(503, "Server is at capacity", 1)
+    assert [admitter.admit(Priority.BULK, None) for _ in range(3)] == [None, None, overloaded]
+    # Two bulk writes in flight take two of the five slots writes can use
+    assert [admitter.admit(Priority.WRITE, None) for _ in range(4)] == [None, None, None, overloaded]
+    assert [admitter.admit(Priority.READ, None) for _ in range(6)] == [None] * 5 + [overloaded]
+
+    stats = admitter.stats()
+    assert [stats["in_flight"], stats["max_writes_in_flight"], stats["max_bulk_in_flight"]] == [10, 5, 2]
+    admitter.release()
+    assert admitter.admit(Priority.READ, None) is None
+    assert admitter.admit(Priority.WRITE, None) is not None
+
+
+def test_users_are_rate_limited_by_buckets_of_their_own(clock: Clock) -> None:
+    admitter = controller(user_rate=1, user_burst=2)
+    limited = Shed(429, "Too many requests", 1)
+    assert [admitter.admit(Priority.READ, "a") for _ in range(3)] == [None, None, limited]
+    # Other users have buckets of their own
+    assert admitter.admit(Priority.READ, "b") is None
+
+    clock.now += 1
+    assert [admitter.admit(Priority.READ, "a"), admitter.admit(Priority.READ, "a")] == [None, limited]
+    stats = admitter.stats()
+    assert [stats["tracked_users"], stats["admitted"], stats["shed_rate_limited"]] == [2, 4, 2]
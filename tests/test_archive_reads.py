@@ -0,0 +1,132 @@
+"""Behavioral tests of reading a ledger partly archived by app.repositories.partitions.
+
+They run against a database of their own, since archiving detaches a partition from
+the ledger for good: its rows have to be read from the partition's table in the
+archive schema until it's exported, then from its file.
+"""
+import typing
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from app import schemas
+from app.custom_types import FAST_API_SCHEME
+from app.repositories import PaymentRepository, history
+from app.repositories.archive import export_archive, get_archive_horizon, get_unexported
+from app.repositories.partitions import archive_partitions, month_start
+from app.settings import Settings
+from conftest import migrated_database
+
+
+ADD_ROW: typing.Final = sa.text(
+    "INSERT INTO transactions (amount_minor, user_id, type, transaction_id, created_at) "
+    "VALUES (:amount, :user_id, CAST(:type AS transactiontype), :transaction_id, :created_at)"
+)
+
+
+@pytest.fixture
+def database() -> typing.Iterator[Settings]:
+    # Anew for each test: a partition can only be archived once
+    with migrated_database(f"{Settings(scheme=FAST_API_SCHEME).name}_archive") as settings:
+        yield settings
+
+
+@pytest.fixture
+async def engine(database: Settings) -> typing.AsyncIterator[AsyncEngine]:
+    engine = create_async_engine(database.db_dsn)
+    try:
+        yield engine
+    finally:
+        await engine.dispose()
+
+
+@pytest.fixture
+def session_maker(engine: AsyncEngine) -> async_sessionmaker[AsyncSession]:
+    return async_sessionmaker(bind=engine, expire_on_commit=False)
+
+
+async def archived_wallet(
+    engine: AsyncEngine, session_maker: async_sessionmaker[AsyncSession], rows: list[tuple[int, str, datetime]],
+) -> int:
+    """A new wallet with the given (amount, type, created_at) rows, once every partition before this month is archived.
+
+    The partitions are left unexported.
+    """
+    async with session_maker() as session:
+        async with session.begin():
+            repo = PaymentRepository(session)
+            data = schemas.UserCreate(name="wallet", email=f"{uuid.uuid4().hex}@example.com", password="")
+            user = await repo.create_user(repo, data, hashed_password="")
+            for amount, type_, created_at in rows:
+                await session.execute(ADD_ROW, {
+                    "amount": amount, "user_id": user.id, "type": type_,
+                    "transaction_id": uuid.uuid4().hex, "created_at": created_at,
+                })
+    async with session_maker() as session:
+        await archive_partitions(engine, session, datetime.now().astimezone(), hot_months=0)
+    return user.id
+
+
+async def date_balance(session_maker: async_sessionmaker[AsyncSession], user_id: int, ts: datetime) -> int | None:
+    async with session_maker() as session:
+        repo = PaymentRepository(session)
+        balance = await repo.get_user_balance(repo, user_id, int(ts.timestamp()))
+    return balance.amount if balance is not None else None
+
+
+async def test_balance_and_history_read_an_unexported_archive(
+    engine: AsyncEngine, session_maker: async_sessionmaker[AsyncSession],
+) -> None:
+    this_month = month_start(datetime.now().astimezone())
+    user_id = await archived_wallet(engine, session_maker, [
+        (1000, "DEPOSIT", this_month - timedelta(days=20)),
+        (300, "WITHDRAW", this_month - timedelta(days=10)),
+        (50, "DEPOSIT", this_month + timedelta(minutes=1)),
+    ])
+    async with session_maker() as session:
+        assert await get_archive_horizon(session) == this_month
+        assert [archive.partition_name for archive in await get_unexported(session)] == ["transactions_legacy"]
+
+    # Before the archive's checkpoint, the rows can only come from the partition's table
+    moments = [this_month - timedelta(days=30), this_month - timedelta(days=15), this_month - timedelta(days=5)]
+    moments.append(this_month + timedelta(minutes=2))
+    assert [await date_balance(session_maker, user_id, ts) for ts in moments] == [None, 1000, 700, 750]
+
+    async with session_maker() as session:
+        archived = await history.get_archived_history(session, session_maker, user_id)
+        assert archived is not None
+        assert [(row.type.value, row.amount) async for row in archived] == [("DEPOSIT", 1000), ("WITHDRAW", 300)]
+
+
+async def test_history_picks_up_an_export_where_it_left_off(
+    engine: AsyncEngine,
+    session_maker: async_sessionmaker[AsyncSession],
+    monkeypatch: pytest.MonkeyPatch,
+    tmp_path: Path,
+) -> None:
+    pytest.importorskip("pyarrow")
+    this_month = month_start(datetime.now().astimezone())
+    user_id = await archived_wallet(engine, session_maker, [
+        (amount, "DEPOSIT", this_month - timedelta(days=amount)) for amount in (3, 2, 1)
+    ])
+    # A row a batch, so the table is looked up again between rows
+    monkeypatch.setattr(history, "STREAM_BATCH_SIZE", 1)
+
+    async with session_maker() as session:
+        archived = await history.get_archived_history(session, session_maker, user_id)
+    assert archived is not None
+    amounts = [(await anext(archived)).amount]
+
+    async with session_maker() as session:
+        async with session.begin():
+            for archive in await get_unexported(session):
+                assert await export_archive(session, archive, str(tmp_path), 1000) is not None
+        assert await session.scalar(sa.text("SELECT to_regclass('archive.transactions_legacy')")) is None
+
+    amounts += [row.amount async for row in archived]
+    assert amounts == [3, 2, 1]
+    assert [await date_balance(session_maker, user_id, this_month - timedelta(hours=1))] == [sum(amounts)]
@@ -0,0 +1,115 @@
+"""Unit tests of the in-process caches of app.cache; no database needed."""
+import pytest
+
+from app import cache
+from app.cache import TTLCache, VersionedCache
+
+
+class Clock:
+    """Stands in for the time module, with a monotonic clock moved by hand."""
+
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+
+@pytest.mark.usefixtures("clock")
+def test_ttl_cache_evicts_the_least_recently_used() -> None:
+    entries: TTLCache[str, int] = TTLCache(maxsize=2, ttl=60)
+    entries.set("a", 1)
+    entries.set("b", 2)
+    assert entries.get("a") == 1
+    entries.set("c", 3)
+
+    assert (entries.get("a"), entries.get("b"), entries.get("c")) == (1, None, 3)
+    assert entries.stats() == {"size": 2, "maxsize": 2, "hits": 3, "misses": 1}
+
+
+@pytest.mark.usefixtures("clock")
+def test_ttl_cache_peek_leaves_recency_alone() -> None:
+    entries: TTLCache[str, int] = TTLCache(maxsize=2, ttl=60)
+    entries.set("a", 1)
+    entries.set("b", 2)
+    assert entries.peek("a") == 1
+    entries.set("c", 3)
+
+    assert entries.peek("a") is None
+    assert entries.stats()["hits"] == entries.stats()["misses"] == 0
+
+
+def test_ttl_cache_expires_entries(clock: Clock) -> None:
+    entries: TTLCache[str, int] = TTLCache(maxsize=10, ttl=60)
+    entries.set("default", 1)
+    entries.set("shorter", 2, ttl=10)
+    entries.set("longer", 3, ttl=600)
+    # Not even stored
+    entries.set("expired", 4, ttl=0)
+    assert [len(entries)] == [3]
+
+    clock.now += 10
+    assert (entries.get("default"), entries.get("shorter")) == (1, None)
+    # Dropped once found expired
+    assert [len(entries)] == [2]
+    # A TTL is never longer than the cache's own
+    clock.now += 50
+    assert (entries.get("default"), entries.get("longer")) == (None, None)
+    assert len(entries) == 0
+
+
+@pytest.mark.usefixtures("clock")
+def test_ttl_cache_invalidates_by_value() -> None:
+    entries: TTLCache[str, int] = TTLCache(maxsize=10, ttl=60)
+    for key, value in (("a", 1), ("b", 2), ("c", 1)):
+        entries.set(key, value)
+
+    assert [entries.invalidate(lambda value: value == 1)] == [2]
+    assert [entries.peek(key) for key in ("a", "b", "c")] == [None, 2, None]
+
+
+def test_versioned_cache_evicts_the_least_recently_used() -> None:
+    balances: VersionedCache[int, str] = VersionedCache(maxsize=2)
+    balances.set(1, "one", version=1, generation=balances.generation)
+    balances.set(2, "two", version=1, generation=balances.generation)
+    assert balances.get(1) == "one"
+    balances.set(3, "three", version=1, generation=balances.generation)
+
+    assert [balances.get(key) for key in (1, 2, 3)] == ["one", None, "three"]
+    # A notified key takes a place too, even without a value
+    balances.notify(4, version=1)
+    assert [len(balances), balances.get(1), balances.get(4)] == [2, None, None]
+
+
+def test_versioned_cache_keeps_the_newest_version() -> None:
+    balances: VersionedCache[int, str] = VersionedCache(maxsize=10)
+    balances.set(1, "v2", version=2, generation=balances.generation)
+    # A late read
+    balances.set(1, "v1", version=1, generation=balances.generation)
+    assert balances.get(1) == "v2"
+
+    # A late notification leaves it, a newer one drops it until a read at that version
+    balances.notify(1, version=2)
+    assert balances.get(1) == "v2"
+    balances.notify(1, version=3)
+    balances.set(1, "v2", version=2, generation=balances.generation)
+    assert balances.get(1) is None
+    balances.set(1, "v3", version=3, generation=balances.generation)
+    assert balances.get(1) == "v3"
+
+
+def test_versioned_cache_drops_reads_of_an_older_generation() -> None:
+    balances: VersionedCache[int, str] = VersionedCache(maxsize=10)
+    generation = balances.generation
+    balances.set(1, "before", version=1, generation=generation)
+    balances.clear()
+
+    balances.set(2, "read before the clear", version=1, generation=generation)
+    assert [balances.get(1), balances.get(2), len(balances)] == [None, None, 0]
@@ -0,0 +1,29 @@
+"""Unit tests of the opaque history cursors of app.repositories.history; no database needed."""
+import base64
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException
+from starlette import status
+
+from app.repositories.history import decode_cursor, encode_cursor
+
+
+def test_cursor_round_trips() -> None:
+    created_at = datetime(2026, 10, 18, 12, 30, 15, 123456, tzinfo=timezone.utc)
+    assert decode_cursor(encode_cursor(created_at, 42)) == (created_at, 42)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"\xff\xfe").decode(),
+    base64.urlsafe_b64encode(b"no separator").decode(),
+    base64.urlsafe_b64encode(b"2026-10-18T12:00:00+00:00|1|2").decode(),
+    base64.urlsafe_b64encode(b"yesterday|1").decode(),
+    base64.urlsafe_b64encode(b"2026-10-18T12:00:00+00:00|one").decode(),
+])
+def test_malformed_cursor_is_a_bad_request(cursor: str) -> None:
+    with pytest.raises(HTTPException) as raised:
+        decode_cursor(cursor)
+    assert raised.value.status_code == status.HTTP_400_BAD_REQUEST
+    assert raised.value.__cause__ is not None
@@ -0,0 +1,55 @@
+"""Unit tests of naming queries for the metrics of app.metrics; no database needed."""
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from app.metrics import query_name
+
+
+def compiled(statement: sa.Executable) -> str:
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+USERS = sa.table("users", sa.column("id"), sa.column("balance_minor"))
+KEYS = sa.table("transaction_keys", sa.column("transaction_id"))
+
+
+def walk_statement() -> str:
+    """A recursive CTE like the ingest overdraft walk, which SQLAlchemy renders with its column names."""
+    walk = sa.select(USERS.c.id, USERS.c.balance_minor).cte("walk", recursive=True)
+    walk = walk.union_all(sa.select(walk.c.id, walk.c.balance_minor).where(walk.c.balance_minor < 0))
+    return compiled(sa.update(USERS).where(USERS.c.id.in_(sa.select(walk.c.id))).values(balance_minor=0))
+
+
+@pytest.mark.parametrize(("statement", "name"), [
+    (compiled(sa.select(USERS.c.id).where(USERS.c.id == 1)), "SELECT users"),
+    ("SELECT extract(epoch FROM now()) FROM users", "SELECT users"),
+    ("SELECT 1", "SELECT"),
+    ('INSERT INTO "transactions" (amount_minor) VALUES ($1)', "INSERT transactions"),
+    ("UPDATE users SET balance_minor = $1", "UPDATE users"),
+    ("DELETE FROM outbox_events WHERE id = $1", "DELETE outbox_events"),
+    ("LOCK TABLE transaction_archives IN SHARE MODE", "LOCK transaction_archives"),
+    ("lock table balance_slots in exclusive mode", "LOCK balance_slots"),
+    ("CREATE TEMPORARY TABLE staging (line integer) ON COMMIT DROP", "CREATE staging"),
+    (
+        compiled(
+            sa.select(sa.func.count())
+            .select_from(sa.select(KEYS.c.transaction_id).cte("claimed"))
+            .add_cte(sa.insert(KEYS).values(transaction_id="a").returning(KEYS.c.transaction_id).cte("key"))
+        ),
+        "WITH key,claimed",
+    ),
+    ("WITH cold AS MATERIALIZED (SELECT 1), hot AS NOT MATERIALIZED (SELECT 2) SELECT 1", "WITH cold,hot"),
+    (walk_statement(), "WITH walk"),
+])
+def test_query_name(statement: str, name: str) -> None:
+    assert query_name(statement, {}) == name
+
+
+def test_query_names_are_memoized_up_to_a_bound() -> None:
+    names = {f"SELECT {i} FROM users": "SELECT users" for i in range(1024)}
+    names["SELECT 1 FROM users"] = "memoized"
+
+    assert query_name("SELECT 1 FROM users", names) == "memoized"
+    assert query_name("SELECT * FROM accounts", names) == "SELECT accounts"
+    assert "SELECT * FROM accounts" not in names
@@ -0,0 +1,486 @@
+"""Plan regression tests for the queries of app.repositories.
+
+Every case runs real repository code against the synthetic ledger, records each
+statement it sends, and EXPLAIN (ANALYZE, BUFFERS)es it again in a savepoint. A
+case fails if a plan scans a large table sequentially or its statements touch
+more shared buffers than the budget. Budgets are set to hold at any ledger size:
+a per-wallet query must not read more as the ledger grows.
+
+Each public query function of app.repositories has to be covered by a case, or
+listed in NOT_PLANNED with the reason, so new queries can't go unchecked.
+"""
+import dataclasses
+import fnmatch
+import importlib
+import inspect
+import os
+import pkgutil
+import typing
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+import app.repositories
+from app import schemas
+from app.cache import VersionedCache
+from app.models import TransactionArchive
+from app.outbox import NdjsonFileSink, OutboxDispatcher
+from app.custom_types import TransactionType
+from app.repositories import PaymentRepository
+from app.repositories import (
+    archive, balance_slots, balances, checkpoints, history, ingest, reconciliation, rollups, transfers, utils,
+)
+from app.repositories.group_commit import GroupCommitter
+from conftest import Ledger
+from plans import Plan, StatementRecorder, empty_relations, explain, is_large
+
+
+@dataclasses.dataclass(frozen=True)
+class Context:
+    ledger: Ledger
+    session_maker: async_sessionmaker[AsyncSession]
+
+    @property
+    def principal(self) -> schemas.Principal:
+        return schemas.Principal(id=self.ledger.user_id, email=self.ledger.email)
+
+
+@dataclasses.dataclass(frozen=True)
+class Case:
+    name: str
+    # Functions of app.repositories this case runs the queries of, as "<module>.<qualname>"
+    covers: tuple[str, ...]
+    run: typing.Callable[[Context], typing.Awaitable[typing.Any]]
+    # Shared buffers all of the case's statements may touch together; None for jobs over the whole ledger
+    buffer_budget: int | None = 500
+    # Large tables the case may scan sequentially, as fnmatch patterns
+    allow_seq_scans: frozenset[str] = frozenset()
+
+
+async def in_session(context: Context, call: typing.Callable[[AsyncSession], typing.Awaitable[typing.Any]]) -> None:
+    async with context.session_maker() as session:
+        async with session.begin():
+            await call(session)
+
+
+async def consume(lines: typing.AsyncIterator[str]) -> None:
+    async for _ in lines:
+        pass
+
+
+async def repo_call(context: Context, method: str, *args: typing.Any, **kwargs: typing.Any) -> None:
+    async def call(session: AsyncSession) -> None:
+        repo = PaymentRepository(session)
+        await getattr(repo, method)(repo, *args, **kwargs)
+
+    await in_session(context, call)
+
+
+async def group_commit(context: Context) -> None:
+    committer = GroupCommitter(context.session_maker, window=0.001, max_items=10)
+    entry = schemas.TransactionEntry(amount=100, type=TransactionType.DEPOSIT)
+    await committer.add_transaction(entry, context.principal)
+    await committer.close()
+
+
+def ingest_lines(context: Context) -> typing.AsyncIterator[bytes]:
+    async def lines() -> typing.AsyncIterator[bytes]:
+        for index in range(100):
+            item = {"user_id": context.ledger.user_id + index, "type": "DEPOSIT", "amount": "1.00"}
+            yield schemas.TransactionIngest.model_validate(item).model_dump_json().encode()
+
+    return lines()
+
+
+def all_ids(context: Context) -> list[int]:
+    return list(range(context.ledger.user_id, context.ledger.user_id + 100))
+
+
+CASES: typing.Final = [
+    Case(
+        "user by email",
+        ("utils.get_user",),
+        lambda context: in_session(context, lambda session: utils.get_user(session, context.ledger.email)),
+        buffer_budget=20,
+    ),
+    Case(
+        "current balance",
+        ("payment.PaymentRepository.get_user_balance", "utils.get_total_balance"),
+        lambda context: repo_call(context, "get_user_balance", user_id=context.ledger.user_id, ts=None),
+        buffer_budget=20,
+    ),
+    Case(
+        "sharded balance",
+        ("utils.get_total_balance",),
+        lambda context: repo_call(context, "get_user_balance", user_id=context.ledger.sharded_user_id, ts=None),
+        buffer_budget=20,
+    ),
+    Case(
+        "point-in-time balance",
+        ("payment.PaymentRepository.get_user_balance", "utils.get_date_balance"),
+        lambda context: repo_call(context, "get_user_balance", user_id=context.ledger.user_id, ts=context.ledger.ts),
+    ),
+    Case(
+        "cached balance miss",
+        ("payment.PaymentRepository.get_cached_balance",),
+        lambda context: repo_call(context, "get_cached_balance", context.ledger.user_id, VersionedCache(maxsize=1)),
+        buffer_budget=20,
+    ),
+    Case(
+        "transaction by id",
+        ("payment.PaymentRepository.get_transaction",),
+        lambda context: repo_call(context, "get_transaction", context.ledger.transaction_id),
+        buffer_budget=50,
+    ),
+    Case(
+        "create user",
+        ("payment.PaymentRepository.create_user",),
+        lambda context: repo_call(
+            context, "create_user",
+            schemas.UserCreate(name="new", email="new@example.com", password="unused"), "hashed",
+        ),
+        buffer_budget=50,
+    ),
+    Case(
+        "deposit",
+        ("payment.PaymentRepository.add_transaction",),
+        lambda context: repo_call(
+            context, "add_transaction",
+            schemas.TransactionEntry(amount=100, type=TransactionType.DEPOSIT), context.principal,
+        ),
+        buffer_budget=100,
+    ),
+    Case(
+        "withdrawal",
+        ("payment.PaymentRepository.add_transaction",),
+        lambda context: repo_call(
+            context, "add_transaction",
+            schemas.TransactionEntry(amount=1, type=TransactionType.WITHDRAW), context.principal,
+        ),
+        buffer_budget=100,
+    ),
+    Case(
+        "sharded withdrawal",
+        ("payment.PaymentRepository.add_transaction",),
+        lambda context: repo_call(
+            context, "add_transaction",
+            schemas.TransactionEntry(amount=1, type=TransactionType.WITHDRAW),
+            schemas.Principal(id=context.ledger.sharded_user_id, email="sharded@plans.test"),
+        ),
+        buffer_budget=100,
+    ),
+    Case(
+        "transfer",
+        ("transfers.settle_transfers",),
+        lambda context: in_session(context, lambda session: transfers.settle_transfers(session, [
+            schemas.TransferEntry(from_user_id=context.ledger.user_id, to_user_id=context.ledger.user_id + 1, amount=1),
+        ])),
+        buffer_budget=100,
+    ),
+    Case(
+        "batch transfers",
+        ("transfers.settle_transfers",),
+        lambda context: in_session(context, lambda session: transfers.settle_transfers(session, [
+            schemas.TransferEntry(from_user_id=context.ledger.sharded_user_id, to_user_id=user_id, amount=1)
+            for user_id in all_ids(context)
+        ])),
+        buffer_budget=2000,
+    ),
+    Case(
+        "group commit",
+        ("group_commit.GroupCommitter.add_transaction", "group_commit.GroupCommitter.close"),
+        group_commit,
+        buffer_budget=100,
+    ),
+    Case(
+        "history page",
+        ("payment.PaymentRepository.get_transaction_history", "history.get_history_page"),
+        lambda context: repo_call(
+            context, "get_transaction_history", history.history_query(context.ledger.user_id), 100,
+        ),
+    ),
+    Case(
+        "history page after a cursor",
+        ("history.get_history_page",),
+        lambda context: in_session(context, lambda session: history.get_history_page(
+            session,
+            history.history_query(
+                context.ledger.user_id,
+                cursor=history.encode_cursor(datetime.now(timezone.utc) - timedelta(days=45), 0),
+            ),
+            100,
+        )),
+    ),
+    Case(
+        "history stream",
+        ("history.stream_history",),
+        lambda context: consume(history.stream_history(
+            context.session_maker, history.history_query(context.ledger.user_id, type_=TransactionType.WITHDRAW),
+        )),
+    ),
+    Case(
+        "archived history lookup",
+        ("history.get_archived_history", "archive.get_archives"),
+        lambda context: in_session(context, lambda session: history.get_archived_history(
+            session, context.session_maker, context.ledger.user_id,
+            since=datetime.now(timezone.utc) - timedelta(days=400),
+        )),
+        buffer_budget=20,
+    ),
+    Case(
+        "archived partition location",
+        ("archive.get_archive_location",),
+        lambda context: in_session(context, _locate_archive),
+        buffer_budget=20,
+    ),
+    Case(
+        "archives to export",
+        ("archive.get_unexported",),
+        lambda context: in_session(context, archive.get_unexported),
+        buffer_budget=20,
+    ),
+    Case(
+        "archive horizon",
+        ("archive.get_archive_horizon",),
+        lambda context: in_session(context, archive.get_archive_horizon),
+        buffer_budget=20,
+    ),
+    Case(
+        "batch balances",
+        ("balances.stream_balances",),
+        lambda context: consume(
+            balances.stream_balances(context.session_maker, balances.balances_query(all_ids(context))),
+        ),
+        buffer_budget=2000,
+    ),
+    Case(
+        "batch point-in-time balances",
+        ("balances.stream_balances",),
+        lambda context: consume(balances.stream_balances(
+            context.session_maker, balances.balances_query(all_ids(context), context.ledger.ts),
+        )),
+        buffer_budget=20_000,
+    ),
+    Case(
+        "statement",
+        ("rollups.get_statement", "rollups.get_rolled_through"),
+        lambda context: in_session(context, lambda session: rollups.get_statement(
+            session,
+            context.ledger.user_id,
+            datetime.fromtimestamp(context.ledger.ts - 45 * 86400, timezone.utc),
+            datetime.now(timezone.utc),
+        )),
+        buffer_budget=100,
+    ),
+    Case(
+        "day balance",
+        ("rollups.get_day_balance", "rollups.get_rolled_through"),
+        lambda context: in_session(context, lambda session: rollups.get_day_balance(
+            session, context.ledger.user_id, datetime.fromtimestamp(context.ledger.ts, timezone.utc).date(),
+        )),
+        buffer_budget=20,
+    ),
+    Case(
+        "lock and consolidate slots",
+        ("balance_slots.lock_users", "balance_slots.consolidate_slots"),
+        lambda context: in_session(context, lambda session: _lock_and_consolidate(session, context)),
+        buffer_budget=50,
+    ),
+    Case(
+        "reshard a wallet",
+        ("balance_slots.set_balance_slots", "balance_slots.spread_slots"),
+        lambda context: in_session(
+            context, lambda session: balance_slots.set_balance_slots(session, context.ledger.sharded_user_id, 4),
+        ),
+        buffer_budget=100,
+    ),
+    Case(
+        "outbox dispatch",
+        ("outbox.claim_events", "outbox.delete_events", "outbox.get_backlog"),
+        lambda context: OutboxDispatcher(
+            context.session_maker, [NdjsonFileSink(os.devnull)], batch_size=500, poll_seconds=0,
+        ).dispatch(),
+        # Deleting the batch walks the primary key once per event
+        buffer_budget=3000,
+    ),
+    Case(
+        "rebalance slots",
+        ("balance_slots.rebalance_slots",),
+        lambda context: in_session(context, balance_slots.rebalance_slots),
+        # Nightly job: finding the sharded wallets reads users once
+        buffer_budget=None,
+        allow_seq_scans=frozenset(("users",)),
+    ),
+    Case(
+        "bulk ingest",
+        ("ingest.ingest_ndjson", "ingest.ingest_batch"),
+        lambda context: ingest.ingest_ndjson(context.session_maker, ingest_lines(context), 100),
+        buffer_budget=5000,
+    ),
+    Case(
+        "incremental checkpoints",
+        ("checkpoints.create_checkpoints",),
+        lambda context: in_session(
+            context, lambda session: checkpoints.create_checkpoints(session, datetime.now(timezone.utc)),
+        ),
+        # Reads every transaction since the last checkpoint, a month of this ledger
+        buffer_budget=None,
+        allow_seq_scans=frozenset(("balance_checkpoints", "transactions_*")),
+    ),
+    Case(
+        "checkpoint backfill",
+        ("checkpoints.backfill_checkpoints",),
+        lambda context: in_session(context, lambda session: checkpoints.backfill_checkpoints(
+            session, timedelta(days=7), datetime.now(timezone.utc),
+        )),
+        # Rebuilds everything from the whole ledger
+        buffer_budget=None,
+        allow_seq_scans=frozenset(("balance_checkpoints", "transactions_*")),
+    ),
+    Case(
+        "daily rollups",
+        ("rollups.start_run", "utils.get_settled_watermark", "rollups.roll_up", "rollups.finish_run"),
+        lambda context: in_session(context, lambda session: _roll_up(session, incremental=False)),
+        # Rebuilds every day from the whole ledger
+        buffer_budget=None,
+        allow_seq_scans=frozenset(("daily_user_rollups", "transactions_*")),
+    ),
+    Case(
+        "daily rollups incrementally",
+        ("rollups.start_run", "rollups.roll_up", "rollups.finish_run"),
+        lambda context: in_session(context, lambda session: _roll_up(session, incremental=True)),
+        # Reads the day that ended since the last run, from this month's partition
+        buffer_budget=None,
+        allow_seq_scans=frozenset(("transactions_*",)),
+    ),
+    Case(
+        "reconcile a range",
+        ("reconciliation.start_run", "reconciliation.reconcile_range", "reconciliation.finish_run"),
+        lambda context: in_session(context, lambda session: _reconcile(session, incremental=False)),
+        # Aggregates every transaction of the range's wallets
+        buffer_budget=None,
+        allow_seq_scans=frozenset(("transactions_*",)),
+    ),
+    Case(
+        "reconcile a range incrementally",
+        ("reconciliation.start_run", "reconciliation.reconcile_range"),
+        lambda context: in_session(context, lambda session: _reconcile(session, incremental=True)),
+        buffer_budget=None,
+    ),
+]
+
+# Public query functions of app.repositories without a case, and why
+NOT_PLANNED: typing.Final = {
+    "utils.authenticate_user": "runs get_user's query, then bcrypt",
+    "ingest.iter_lines": "no queries",
+    "partitions.list_partitions": "reads the catalog",
+    "partitions.ensure_partitions": "DDL",
+    "partitions.archive_partitions": "DDL, and create_checkpoints, which has a case",
+    "archive.export_archive": "reads a partition detached from the ledger, then DDL",
+    "archive.read_table_history": "reads a partition detached from the ledger",
+    "archive.get_table_delta": "reads partitions detached from the ledger",
+    "history.iter_archives": "runs get_archive_location's query, and reads partitions detached from the ledger",
+    "outbox.is_outbox_enabled": "reads the catalog",
+    "outbox.set_outbox_enabled": "DDL",
+    "outbox.purge_events": "deletes the whole table",
+}
+
+
+async def _lock_and_consolidate(session: AsyncSession, context: Context) -> None:
+    user_ids = [context.ledger.user_id, context.ledger.sharded_user_id]
+    await balance_slots.lock_users(session, user_ids)
+    await balance_slots.consolidate_slots(session, user_ids)
+
+
+async def _locate_archive(session: AsyncSession) -> None:
+    # As if archive_partitions had recorded the oldest partition, which is still attached
+    session.add(TransactionArchive(partition_name="transactions_legacy", range_end=datetime.now(timezone.utc)))
+    await session.flush()
+    await archive.get_archive_location(session, "transactions_legacy")
+
+
+async def _reconcile(session: AsyncSession, incremental: bool) -> None:
+    run = await reconciliation.start_run(session, incremental=False)
+    if incremental:
+        # As if the previous run had seen all but the last thousand transactions
+        run.since_watermark = run.watermark - 1000
+    await reconciliation.reconcile_range(session, run.id, 1, 1001, run.since_watermark)
+    await reconciliation.finish_run(session, run.id, 0, 0)
+
+
+async def _roll_up(session: AsyncSession, incremental: bool) -> None:
+    through = datetime.now(timezone.utc).date() - rollups.ONE_DAY
+    run = await rollups.start_run(session, through, incremental=False)
+    if incremental:
+        # As if the previous run had seen all but the last thousand transactions, and the day before
+        run.since_watermark, run.since_through = run.watermark - 1000, through - rollups.ONE_DAY
+    await rollups.finish_run(session, run.id, await rollups.roll_up(session, run))
+
+
+def problems(case: Case, plans: list[Plan], empty: frozenset[str]) -> list[str]:
+    found = []
+    for plan in plans:
+        for relation in plan.seq_scans():
+            allowed = any(fnmatch.fnmatchcase(relation, pattern) for pattern in case.allow_seq_scans)
+            if is_large(relation) and relation not in empty and not allowed:
+                found.append(f"Seq Scan on {relation} in:\n{plan.statement.sql}")
+    spent = sum(plan.buffers for plan in plans)
+    if case.buffer_budget is not None and spent > case.buffer_budget:
+        statements = "\n".join(f"{plan.buffers} buffers: {plan.statement.sql}" for plan in plans)
+        found.append(f"{spent} shared buffers, over the budget of {case.buffer_budget}:\n{statements}")
+    return found
+
+
+@pytest.mark.parametrize("case", CASES, ids=lambda case: case.name)
+async def test_query_plan(case: Case, ledger: Ledger) -> None:
+    engine = create_async_engine(ledger.settings.db_dsn, poolclass=NullPool)
+    try:
+        async with engine.connect() as connection:
+            await connection.begin()
+            recorder = StatementRecorder(connection)
+            # Commits inside the repository code only release savepoints, and it all rolls back at the end
+            session_maker = async_sessionmaker(
+                bind=connection, expire_on_commit=False, join_transaction_mode="create_savepoint",
+            )
+            with recorder.recording():
+                await case.run(Context(ledger, session_maker))
+            plans = [await explain(connection, statement) for statement in recorder.statements]
+            empty = await empty_relations(connection)
+            await connection.rollback()
+    finally:
+        await engine.dispose()
+
+    assert plans, "the case ran no statements"
+    found = problems(case, plans, empty)
+    assert not found, "\n\n".join(found)
+
+
+def repository_query_functions() -> set[str]:
+    """"<module>.<qualname>" of every public coroutine or async generator function of app.repositories."""
+    found = set()
+    for module_info in pkgutil.iter_modules(app.repositories.__path__):
+        module = importlib.import_module(f"{app.repositories.__name__}.{module_info.name}")
+        for name, value in vars(module).items():
+            if name.startswith("_") or getattr(value, "__module__", None) != module.__name__:
+                continue
+            if inspect.isclass(value):
+                found.update(
+                    f"{module_info.name}.{name}.{attribute}"
+                    for attribute, method in vars(value).items()
+                    if not attribute.startswith("_") and _is_async(method)
+                )
+            elif _is_async(value):
+                found.add(f"{module_info.name}.{name}")
+    return found
+
+
+def _is_async(function: typing.Any) -> bool:
+    return inspect.iscoroutinefunction(function) or inspect.isasyncgenfunction(function)
+
+
+def test_every_repository_query_has_a_case() -> None:
+    covered = {name for case in CASES for name in case.covers}
+    missing = repository_query_functions() - covered - NOT_PLANNED.keys()
+    assert not missing, f"Add a plan case, or a NOT_PLANNED entry, for: {', '.join(sorted(missing))}"
@@ -0,0 +1,322 @@
+"""Behavioral tests of the write paths of app.repositories.
+
+They run against the database of the ledger fixture, each on wallets of its own,
+and commit for real, so concurrent writers lock and conflict as they do in the
+service. Whatever a test does, every wallet's balance, slots included, has to end
+up equal to the signed sum of its ledger rows.
+"""
+import asyncio
+import json
+import random
+import typing
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from app import schemas
+from app.custom_types import RejectionReason, TransactionType
+from app.exceptions import PaymentError
+from app.repositories import PaymentRepository
+from app.repositories.balance_slots import set_balance_slots
+from app.repositories.group_commit import GroupCommitter
+from app.repositories.ingest import ingest_ndjson
+from app.repositories.transfers import leg_ids, settle_transfers
+from conftest import Ledger
+
+
+# Writers running at once in the concurrent tests, each on a connection of its own
+CONCURRENCY: typing.Final = 20
+
+WALLET_TOTALS: typing.Final = sa.text(
+    "SELECT users.id, "
+    "users.balance_minor + coalesce((SELECT sum(balance_minor) FROM balance_slots WHERE user_id = users.id), 0), "
+    "coalesce((SELECT sum(CASE WHEN type = 'WITHDRAW' THEN -amount_minor ELSE amount_minor END) "
+    "FROM transactions WHERE user_id = users.id), 0) "
+    "FROM users WHERE users.id = ANY(:user_ids)"
+)
+
+
+@pytest.fixture
+async def session_maker(ledger: Ledger) -> typing.AsyncIterator[async_sessionmaker[AsyncSession]]:
+    engine = create_async_engine(ledger.settings.db_dsn, pool_size=CONCURRENCY)
+    try:
+        yield async_sessionmaker(bind=engine, expire_on_commit=False)
+    finally:
+        await engine.dispose()
+
+
+async def add_transaction(
+    session_maker: async_sessionmaker[AsyncSession], user: schemas.Principal, entry: schemas.TransactionEntry,
+) -> typing.Any:
+    async with session_maker() as session:
+        async with session.begin():
+            repo = PaymentRepository(session)
+            return await repo.add_transaction(repo, entry, user)
+
+
+async def transfer(
+    session_maker: async_sessionmaker[AsyncSession], *transfers: schemas.TransferEntry,
+) -> list[tuple[typing.Any, typing.Any]]:
+    async with session_maker() as session:
+        async with session.begin():
+            return await settle_transfers(session, list(transfers))
+
+
+async def new_wallet(
+    session_maker: async_sessionmaker[AsyncSession], deposit: int = 0, slots: int = 0,
+) -> schemas.Principal:
+    """A new USD wallet, sharded over slots if any, holding deposit minor units."""
+    async with session_maker() as session:
+        async with session.begin():
+            repo = PaymentRepository(session)
+            data = schemas.UserCreate(name="wallet", email=f"{uuid.uuid4().hex}@example.com", password="")
+            user = await repo.create_user(repo, data, hashed_password="")
+            if slots:
+                await set_balance_slots(session, user.id, slots)
+    principal = schemas.Principal.model_validate(user)
+    if deposit:
+        await add_transaction(session_maker, principal, deposit_of(deposit))
+    return principal
+
+
+def deposit_of(amount: int, uid: str | None = None) -> schemas.TransactionEntry:
+    return schemas.TransactionEntry(amount=amount, type=TransactionType.DEPOSIT, uid=uid)
+
+
+def withdrawal_of(amount: int, uid: str | None = None) -> schemas.TransactionEntry:
+    return schemas.TransactionEntry(amount=amount, type=TransactionType.WITHDRAW, uid=uid)
+
+
+async def balances(session_maker: async_sessionmaker[AsyncSession], *users: schemas.Principal) -> list[int]:
+    """The wallets' balances, checked against their ledgers."""
+    async with session_maker() as session:
+        result = await session.execute(WALLET_TOTALS, {"user_ids": [user.id for user in users]})
+        totals = {user_id: (balance, ledger) for user_id, balance, ledger in result}
+    for user in users:
+        balance, ledger = totals[user.id]
+        assert balance == ledger, f"wallet {user.id} holds {balance} but its ledger sums to {ledger}"
+    return [totals[user.id][0] for user in users]
+
+
+async def key_is_claimed(session_maker: async_sessionmaker[AsyncSession], transaction_id: str) -> bool:
+    async with session_maker() as session:
+        return await session.scalar(
+            sa.text("SELECT EXISTS (SELECT FROM transaction_keys WHERE transaction_id = :transaction_id)"),
+            {"transaction_id": transaction_id},
+        )
+
+
+async def test_add_transaction_replays_a_key(session_maker: async_sessionmaker[AsyncSession]) -> None:
+    user = await new_wallet(session_maker)
+    uid = uuid.uuid4().hex
+
+    first = await add_transaction(session_maker, user, deposit_of(500, uid))
+    replayed = await add_transaction(session_maker, user, deposit_of(500, uid))
+    assert (replayed.id, replayed.created_at) == (first.id, first.created_at)
+    with pytest.raises(PaymentError, match="Transaction already exists"):
+        await add_transaction(session_maker, user, deposit_of(600, uid))
+
+    assert await balances(session_maker, user) == [500]
+
+
+async def test_add_transaction_refuses_an_overdraft(session_maker: async_sessionmaker[AsyncSession]) -> None:
+    user = await new_wallet(session_maker, deposit=500)
+    sharded = await new_wallet(session_maker, deposit=500, slots=4)
+    uid = uuid.uuid4().hex
+
+    for wallet in (user, sharded):
+        with pytest.raises(PaymentError, match="Insufficient funds"):
+            await add_transaction(session_maker, wallet, withdrawal_of(501, f"{uid}-{wallet.id}"))
+    # Nothing of a refused transaction is kept, its key included
+    assert not await key_is_claimed(session_maker, f"{uid}-{user.id}")
+    assert await balances(session_maker, user, sharded) == [500, 500]
+
+    # A sharded wallet's withdrawal is checked against all of its slots together
+    await add_transaction(session_maker, sharded, withdrawal_of(500, f"{uid}-{sharded.id}"))
+    assert await balances(session_maker, user, sharded) == [500, 0]
+
+
+async def test_transfer_batch_is_all_or_nothing(session_maker: async_sessionmaker[AsyncSession]) -> None:
+    first, second, third = [await new_wallet(session_maker, deposit=1000) for _ in range(3)]
+    batch = [
+        schemas.TransferEntry(from_user_id=first.id, to_user_id=second.id, amount=300, uid=uuid.uuid4().hex),
+        schemas.TransferEntry(from_user_id=second.id, to_user_id=third.id, amount=1301, uid=uuid.uuid4().hex),
+    ]
+
+    with pytest.raises(PaymentError, match=f"Insufficient funds in wallet {second.id}"):
+        await transfer(session_maker, *batch)
+    assert await balances(session_maker, first, second, third) == [1000, 1000, 1000]
+    for entry in batch:
+        for leg in leg_ids(entry.uid):
+            assert not await key_is_claimed(session_maker, leg)
+
+    # With the first transfer's credit, the second one is covered
+    batch[1] = batch[1].model_copy(update={"amount": 1300})
+    await transfer(session_maker, *batch)
+    assert await balances(session_maker, first, second, third) == [700, 0, 2300]
+
+
+async def test_transfer_replays_a_key(session_maker: async_sessionmaker[AsyncSession]) -> None:
+    sender, recipient = await new_wallet(session_maker, deposit=1000), await new_wallet(session_maker)
+    entry = schemas.TransferEntry(from_user_id=sender.id, to_user_id=recipient.id, amount=250, uid=uuid.uuid4().hex)
+
+    [(debit, credit)] = await transfer(session_maker, entry)
+    [(replayed_debit, replayed_credit)] = await transfer(session_maker, entry)
+    assert (replayed_debit.id, replayed_credit.id) == (debit.id, credit.id)
+    with pytest.raises(PaymentError, match="Transaction already exists"):
+        await transfer(session_maker, entry.model_copy(update={"amount": 300}))
+
+    assert await balances(session_maker, sender, recipient) == [750, 250]
+
+
+async def test_opposite_transfers_dont_deadlock(session_maker: async_sessionmaker[AsyncSession]) -> None:
+    wallets = [await new_wallet(session_maker, deposit=10_000) for _ in range(3)]
+    ring = list(zip(wallets, [*wallets[1:], wallets[0]], strict=True))
+
+    async def batch(reverse: bool) -> None:
+        # Each batch touches every wallet, in the opposite order to the next one
+        pairs = [(recipient, sender) for sender, recipient in reversed(ring)] if reverse else ring
+        await transfer(session_maker, *(
+            schemas.TransferEntry(from_user_id=sender.id, to_user_id=recipient.id, amount=10)
+            for sender, recipient in pairs
+        ))
+
+    await asyncio.gather(*(batch(index % 2 == 1) for index in range(CONCURRENCY)))
+    assert await balances(session_maker, *wallets) == [10_000] * 3
+
+
+async def test_concurrent_writes_keep_balances_equal_to_the_ledger(
+    session_maker: async_sessionmaker[AsyncSession],
+) -> None:
+    wallets = [await new_wallet(session_maker, deposit=1000) for _ in range(3)]
+    wallets.append(await new_wallet(session_maker, deposit=1000, slots=4))
+    rng = random.Random(0)
+    refused = 0
+
+    async def write(index: int) -> None:
+        nonlocal refused
+        sender, recipient = rng.sample(wallets, 2)
+        try:
+            if index % 2:
+                await add_transaction(session_maker, sender, withdrawal_of(rng.randint(1, 300)))
+            else:
+                await transfer(session_maker, schemas.TransferEntry(
+                    from_user_id=sender.id, to_user_id=recipient.id, amount=rng.randint(1, 300),
+                ))
+        except PaymentError:
+            refused += 1
+
+    await asyncio.gather(*(write(index) for index in range(CONCURRENCY * 5)))
+
+    assert all(balance >= 0 for balance in await balances(session_maker, *wallets))
+    # Far more is asked for than the wallets hold, so some writes must have been refused
+    assert refused
+
+
+async def test_group_commit_refuses_overdrafts_and_replays_keys(
+    session_maker: async_sessionmaker[AsyncSession],
+) -> None:
+    user = await new_wallet(session_maker)
+    uid = uuid.uuid4().hex
+    committer = GroupCommitter(session_maker, window=0.05, max_items=CONCURRENCY)
+    try:
+        outcomes = await asyncio.gather(
+            committer.add_transaction(deposit_of(100, uid), user),
+            committer.add_transaction(deposit_of(100, uid), user),
+            committer.add_transaction(deposit_of(50, uid), user),
+            committer.add_transaction(withdrawal_of(150), user),
+            committer.add_transaction(withdrawal_of(60), user),
+            return_exceptions=True,
+        )
+        replayed = await committer.add_transaction(deposit_of(100, uid), user)
+    finally:
+        await committer.close()
+
+    first, again, mismatched, overdraft, withdrawal = outcomes
+    assert again.id == first.id
+    assert replayed.id == first.id
+    assert isinstance(mismatched, PaymentError)
+    assert str(mismatched) == "Transaction already exists"
+    # Checked against the balance the earlier items of the batch left
+    assert isinstance(overdraft, PaymentError)
+    assert str(overdraft) == "Insufficient funds"
+    assert not isinstance(withdrawal, Exception)
+    assert await balances(session_maker, user) == [40]
+
+
+def ingest_lines(*items: dict[str, typing.Any] | str) -> typing.AsyncIterator[bytes]:
+    async def lines() -> typing.AsyncIterator[bytes]:
+        for item in items:
+            yield (item if isinstance(item, str) else json.dumps(item)).encode()
+
+    return lines()
+
+
+async def test_ingest_rejects_rows_and_replays_keys(session_maker: async_sessionmaker[AsyncSession]) -> None:
+    user = await new_wallet(session_maker, deposit=1000)
+    uid = uuid.uuid4().hex
+    tomorrow = (datetime.now(timezone.utc) + timedelta(days=1)).isoformat()
+    items = (
+        {"user_id": user.id, "type": "DEPOSIT", "amount": "5.00", "uid": f"{uid}-1"},
+        {"user_id": user.id, "type": "WITHDRAW", "amount": "15.01", "uid": f"{uid}-2"},
+        {"user_id": user.id, "type": "WITHDRAW", "amount": "15.00", "uid": f"{uid}-3"},
+        {"user_id": user.id, "type": "DEPOSIT", "amount": "1.00", "uid": f"{uid}-1"},
+        {"user_id": 2**31 - 1, "type": "DEPOSIT", "amount": "1.00", "uid": f"{uid}-5"},
+        {"user_id": user.id, "type": "DEPOSIT", "amount": "1.001", "uid": f"{uid}-6"},
+        {"user_id": user.id, "type": "DEPOSIT", "amount": "1.00", "uid": f"{uid}-7", "created_at": tomorrow},
+        "not json",
+    )
+
+    report = await ingest_ndjson(session_maker, ingest_lines(*items), batch_size=100)
+    assert report.accepted == len(items) - len(report.rejected)
+    assert [(rejection.line, rejection.reason) for rejection in report.rejected] == [
+        (2, RejectionReason.INSUFFICIENT_FUNDS),
+        (4, RejectionReason.DUPLICATE),
+        (5, RejectionReason.UNKNOWN_USER),
+        (6, RejectionReason.INVALID),
+        (7, RejectionReason.OUT_OF_RANGE),
+        (8, RejectionReason.INVALID),
+    ]
+    assert await balances(session_maker, user) == [0]
+    # An overdraft's key is given back, so the row can be sent again once covered
+    assert not await key_is_claimed(session_maker, f"{uid}-2")
+
+    again = await ingest_ndjson(session_maker, ingest_lines(*items[:3]), batch_size=100)
+    assert again.accepted == 0
+    assert [(rejection.line, rejection.reason) for rejection in again.rejected] == [
+        (1, RejectionReason.DUPLICATE),
+        (2, RejectionReason.INSUFFICIENT_FUNDS),
+        (3, RejectionReason.DUPLICATE),
+    ]
+    assert await balances(session_maker, user) == [0]
+
+
+async def test_concurrent_ingests_apply_each_key_once(session_maker: async_sessionmaker[AsyncSession]) -> None:
+    users = [await new_wallet(session_maker, deposit=10_000) for _ in range(4)]
+    uid = uuid.uuid4().hex
+    # Every fifth row is a deposit; the withdrawals never take more than the wallets start with
+    items = [
+        {
+            "user_id": user.id,
+            "type": "WITHDRAW" if index % 5 else "DEPOSIT",
+            "amount": "1.00",
+            "uid": f"{uid}-{user.id}-{index}",
+        }
+        for index in range(50)
+        for user in users
+    ]
+
+    async def ingest(order: list[dict[str, typing.Any]]) -> schemas.IngestReport:
+        return await ingest_ndjson(session_maker, ingest_lines(*order), batch_size=20)
+
+    # The same rows, in different orders and batches, so batches wait on each other's keys and wallets
+    reports = await asyncio.gather(*(ingest(random.Random(seed).sample(items, len(items))) for seed in range(4)))
+
+    assert sum(report.accepted for report in reports) == len(items)
+    assert all(
+        rejection.reason == RejectionReason.DUPLICATE for report in reports for rejection in report.rejected
+    )
+    assert await balances(session_maker, *users) == [10_000 + 10 * 100 - 40 * 100] * 4